@@ -0,0 +1,105 @@
+import glob
+import gzip
+import os
+import pickle
+import queue
+import threading
+import time
+
+# Background autosave for the map editor.
+#
+# The main thread only takes a snapshot of the object records, which is a
+# shallow copy of a list of immutable tuples. Pickling, compression and the
+# atomic rename into one of the rotating autosave files happen on a worker
+# thread. Records are pickled in small batches so the worker never holds the
+# interpreter for long enough to stall a frame.
+
+BATCH_SIZE = 2000  # Records pickled per call on the worker
+
+
+class AutosaveService:
+    """Writes snapshots of the map to autosave/autosave_<n>.dbo.gz every interval seconds."""
+
+    def __init__(self, directory='autosave', slots=3, interval=120):
+        self.directory = directory
+        self.slots = slots
+        self.interval = interval
+        self.last_time = time.time()
+        self.last_revision = None
+        self.queue = queue.Queue(maxsize=1)
+        os.makedirs(directory, exist_ok=True)
+
+        # Continue the rotation after the newest existing autosave
+        newest = latest_autosave(directory)
+        self.slot = (int(newest.rsplit('_', 1)[1].split('.')[0]) + 1) % slots if newest else 0
+
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def mark_saved(self, revision):
+        """Treat a revision as already saved, call with the journal's revision after loading."""
+        self.last_revision = revision
+
+    def tick(self, snapshot, revision):
+        """Call every frame. snapshot() must return the records to save and
+        revision must change whenever the map changes."""
+        if time.time() - self.last_time < self.interval:
+            return
+        self.last_time = time.time()
+
+        # Nothing changed, or the previous autosave is still being written
+        if revision == self.last_revision or self.queue.full():
+            return
+        self.last_revision = revision
+        self.queue.put_nowait((self.slot, snapshot()))
+        self.slot = (self.slot + 1) % self.slots
+
+    def _worker(self):
+        while True:
+            slot, records = self.queue.get()
+            try:
+                self._write(slot, records)
+            except OSError as error:
+                print(f'Autosave failed: {error}')
+
+    def _write(self, slot, records):
+        path = os.path.join(self.directory, f'autosave_{slot}.dbo.gz')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as file:
+                for start in range(0, len(records), BATCH_SIZE):
+                    file.write(pickle.dumps(records[start:start + BATCH_SIZE], protocol=pickle.HIGHEST_PROTOCOL))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+        print(f'Autosaved {len(records)} objects to {path}')
+
+
+def latest_autosave(directory='autosave', skip_empty=False):
+    """Return the path of the newest autosave, or None. skip_empty passes over snapshots without objects."""
+    paths = sorted(glob.glob(os.path.join(directory, 'autosave_*.dbo.gz')), key=os.path.getmtime, reverse=True)
+    for path in paths:
+        if not skip_empty or not is_empty(path):
+            return path
+    return None
+
+
+def is_empty(path):
+    """True when an autosave holds no objects, an empty map pickles no batches at all."""
+    try:
+        with gzip.open(path, 'rb') as file:
+            return not file.read(1)
+    except (OSError, EOFError):
+        return True
+
+
+def load_autosave(path):
+    """Read the object records of an autosave file."""
+    records = []
+    with gzip.open(path, 'rb') as file:
+        while True:
+            try:
+                records.extend(pickle.load(file))
+            except EOFError:
+                break
+    return records
@@ -0,0 +1,188 @@
+import math
+from collections import namedtuple
+
+from voxel_grid import position_of, BLOCK_HALF_EXTENT
+
+# Chunk meshing for grid-aligned blocks.
+#
+# Blocks are collected per chunk and turned into one mesh per block type.
+# Faces pressed against a neighbouring block are dropped, and the remaining
+# coplanar faces of the same type and colour are merged into larger quads
+# (greedy meshing). Blocks are 2 units wide on a 1 unit grid, so a face is
+# only hidden by a neighbour exactly one block width away and only faces that
+# sit on the same 2 unit lattice are merged together.
+
+CHUNK_SIZE = 16  # Width of a chunk in world units (x and z)
+TRANSPARENT_TYPES = {'glass', 'leaf'}
+
+MeshData = namedtuple('MeshData', ['vertices', 'triangles', 'uvs', 'normals', 'colors'])
+
+# Face directions: (axis, sign). Axis 0 is x, 1 is the stacking layer, 2 is z.
+DIRECTIONS = [(0, 1), (0, -1), (1, 1), (1, -1), (2, 1), (2, -1)]
+# Cell offset of the neighbour that hides a face in each direction
+NEIGHBOUR_STEP = (2, 1, 2)
+
+
+def chunk_of(cell):
+    """Return the chunk a cell belongs to."""
+    return (math.floor(cell[0] / CHUNK_SIZE), math.floor(cell[2] / CHUNK_SIZE))
+
+
+def is_transparent(obj_type):
+    return obj_type in TRANSPARENT_TYPES
+
+
+def _face_hidden(obj_type, neighbour):
+    # Opaque neighbours hide everything, transparent ones only hide their own type
+    if neighbour is None:
+        return False
+    return not is_transparent(neighbour[0]) or neighbour[0] == obj_type
+
+
+def _greedy_rectangles(cells):
+    """Merge a set of (u, v) lattice cells into as few rectangles as possible."""
+    remaining = set(cells)
+    rectangles = []
+    for u, v in sorted(cells, key=lambda c: (c[1], c[0])):
+        if (u, v) not in remaining:
+            continue
+        width = 1
+        while (u + width, v) in remaining:
+            width += 1
+        height = 1
+        while all((u + i, v + height) in remaining for i in range(width)):
+            height += 1
+        for j in range(height):
+            for i in range(width):
+                remaining.discard((u + i, v + j))
+        rectangles.append((u, v, width, height))
+    return rectangles
+
+
+class ChunkMesher:
+    """Keeps the meshable blocks of a map and rebuilds the chunks that changed."""
+
+    def __init__(self):
+        self.blocks = {}  # cell -> (obj_type, color)
+        self.chunks = {}  # chunk -> set of cells
+        self.dirty = set()
+
+    def set_block(self, cell, obj_type, color):
+        if self.blocks.get(cell) == (obj_type, color):
+            return
+        self.remove_block(cell)
+        self.blocks[cell] = (obj_type, color)
+        self.chunks.setdefault(chunk_of(cell), set()).add(cell)
+        self._mark_dirty(cell)
+
+    def remove_block(self, cell):
+        if self.blocks.pop(cell, None) is None:
+            return
+        chunk = chunk_of(cell)
+        self.chunks[chunk].discard(cell)
+        if not self.chunks[chunk]:
+            del self.chunks[chunk]
+        self._mark_dirty(cell)
+
+    def clear(self):
+        self.dirty.update(self.chunks)
+        self.blocks.clear()
+        self.chunks.clear()
+
+    def _mark_dirty(self, cell):
+        # Neighbours across a chunk border may have gained or lost a face
+        for dx in (-2, 0, 2):
+            for dz in (-2, 0, 2):
+                self.dirty.add(chunk_of((cell[0] + dx, cell[1], cell[2] + dz)))
+
+    def take_dirty(self):
+        """Return the chunks that need rebuilding and forget them."""
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+
+    def build_chunk(self, chunk):
+        """Build the meshes of a chunk, returns {obj_type: MeshData}."""
+        # Visible faces grouped by everything that has to match for a merge
+        groups = {}
+        for cell in self.chunks.get(chunk, ()):
+            obj_type, color = self.blocks[cell]
+            for axis, sign in DIRECTIONS:
+                neighbour = list(cell)
+                neighbour[axis] += sign * NEIGHBOUR_STEP[axis]
+                if _face_hidden(obj_type, self.blocks.get(tuple(neighbour))):
+                    continue
+
+                # The two in-plane axes, on a lattice of one block width
+                u_axis, v_axis = [a for a in range(3) if a != axis]
+                u_parity = cell[u_axis] % NEIGHBOUR_STEP[u_axis]
+                v_parity = cell[v_axis] % NEIGHBOUR_STEP[v_axis]
+                key = (obj_type, color, axis, sign, cell[axis], u_parity, v_parity)
+                lattice = (cell[u_axis] // NEIGHBOUR_STEP[u_axis], cell[v_axis] // NEIGHBOUR_STEP[v_axis])
+                groups.setdefault(key, []).append(lattice)
+
+        meshes = {}
+        for key, faces in groups.items():
+            obj_type, color, axis, sign, plane, u_parity, v_parity = key
+            mesh = meshes.get(obj_type)
+            if mesh is None:
+                mesh = meshes[obj_type] = MeshData([], [], [], [], [])
+            u_axis, v_axis = [a for a in range(3) if a != axis]
+            for u, v, width, height in _greedy_rectangles(faces):
+                first = [0, 0, 0]
+                last = [0, 0, 0]
+                first[axis] = last[axis] = plane
+                first[u_axis] = u * NEIGHBOUR_STEP[u_axis] + u_parity
+                first[v_axis] = v * NEIGHBOUR_STEP[v_axis] + v_parity
+                last[u_axis] = (u + width - 1) * NEIGHBOUR_STEP[u_axis] + u_parity
+                last[v_axis] = (v + height - 1) * NEIGHBOUR_STEP[v_axis] + v_parity
+                _add_quad(mesh, axis, sign, u_axis, v_axis, first, last, width, height, color)
+        return meshes
+
+
+def _add_quad(mesh, axis, sign, u_axis, v_axis, first_cell, last_cell, width, height, color):
+    # World space corners of the merged rectangle
+    low = position_of(first_cell)
+    high = position_of(last_cell)
+    h = BLOCK_HALF_EXTENT
+    plane = low[axis] + sign * h
+    u0, u1 = low[u_axis] - h, high[u_axis] + h
+    v0, v1 = low[v_axis] - h, high[v_axis] + h
+
+    corners = []
+    for u, v in ((u0, v0), (u1, v0), (u1, v1), (u0, v1)):
+        point = [0.0, 0.0, 0.0]
+        point[axis] = plane
+        point[u_axis] = u
+        point[v_axis] = v
+        corners.append(tuple(point))
+
+    normal = [0.0, 0.0, 0.0]
+    normal[axis] = float(sign)
+
+    # Ursina is left-handed, front faces wind clockwise around the normal
+    # when looking at it from the outside
+    if _winding_matches(corners, normal):
+        corners.reverse()
+        uvs = [(0, height), (width, height), (width, 0), (0, 0)]
+    else:
+        uvs = [(0, 0), (width, 0), (width, height), (0, height)]
+
+    start = len(mesh.vertices)
+    mesh.vertices.extend(corners)
+    mesh.uvs.extend(uvs)
+    mesh.normals.extend([tuple(normal)] * 4)
+    mesh.colors.extend([color] * 4)
+    mesh.triangles.extend([(start, start + 1, start + 2), (start, start + 2, start + 3)])
+
+
+def _winding_matches(corners, normal):
+    a, b, c = corners[0], corners[1], corners[2]
+    e1 = (b[0] - a[0], b[1] - a[1], b[2] - a[2])
+    e2 = (c[0] - a[0], c[1] - a[1], c[2] - a[2])
+    cross = (
+        e1[1] * e2[2] - e1[2] * e2[1],
+        e1[2] * e2[0] - e1[0] * e2[2],
+        e1[0] * e2[1] - e1[1] * e2[0],
+    )
+    return cross[0] * normal[0] + cross[1] * normal[1] + cross[2] * normal[2] > 0
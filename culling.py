@@ -0,0 +1,149 @@
+import math
+
+# Frustum and distance culling.
+#
+# Nodes are registered with a category and a bounding sphere. Every update
+# the sphere is tested against the camera's draw distance for its category
+# and the six planes of the view frustum, and the node is hidden from the
+# main camera when it fails either test. Hidden nodes are skipped by Panda's
+# cull traversal, so nothing under them gets submitted. Other cameras (the
+# shadow camera) still see them.
+#
+# Static nodes (chunk meshes) keep the sphere they were registered with,
+# moving ones (clouds, enemies, effects) read their position every update.
+
+# Draw distance per category in world units, None means no distance limit
+DRAW_DISTANCES = {
+    'chunk': 400,
+    'object': 250,
+    'cloud': 700,
+    'effect': 120,
+    'enemy': 300,
+}
+
+
+def matrix_rows(matrix):
+    """Return a Panda3D 4x4 matrix as nested rows."""
+    return [[matrix.get_cell(row, column) for column in range(4)] for row in range(4)]
+
+
+def frustum_planes(matrix):
+    """Return the six frustum planes (a, b, c, d) of a row-vector view-projection matrix.
+
+    A point is inside a plane when a*x + b*y + c*z + d >= 0.
+    """
+    columns = [[matrix[row][column] for row in range(4)] for column in range(4)]
+    w = columns[3]
+    planes = []
+    for axis in range(3):
+        for sign in (1, -1):
+            plane = [w[i] + sign * columns[axis][i] for i in range(4)]
+            length = math.sqrt(plane[0] ** 2 + plane[1] ** 2 + plane[2] ** 2) or 1.0
+            planes.append(tuple(value / length for value in plane))
+    return planes
+
+
+def sphere_in_frustum(planes, center, radius):
+    x, y, z = center
+    for a, b, c, d in planes:
+        if a * x + b * y + c * z + d < -radius:
+            return False
+    return True
+
+
+def bounds_sphere(vertices):
+    """Return the (center, radius) of a sphere around a list of vertices."""
+    low = [min(v[axis] for v in vertices) for axis in range(3)]
+    high = [max(v[axis] for v in vertices) for axis in range(3)]
+    center = tuple((low[axis] + high[axis]) / 2 for axis in range(3))
+    radius = math.sqrt(sum((high[axis] - low[axis]) ** 2 for axis in range(3))) / 2
+    return center, radius
+
+
+def node_radius(node, default=1.0):
+    """Estimate the world space radius of a node from its bounds."""
+    bounds = node.get_bounds()
+    if bounds.is_empty() or bounds.is_infinite():
+        return default
+    scale = node.get_scale(node.get_top())
+    return bounds.get_radius() * max(abs(scale[0]), abs(scale[1]), abs(scale[2]))
+
+
+class CullingSystem:
+    """Hides registered nodes that are off screen or past their category's draw distance."""
+
+    def __init__(self, draw_distances=None, camera_mask=None):
+        self.draw_distances = dict(DRAW_DISTANCES)
+        if draw_distances:
+            self.draw_distances.update(draw_distances)
+        self.camera_mask = camera_mask  # Only hide from this camera, None hides from all
+        self.entries = {}  # id(node) -> [node, category, center or None, radius, visible]
+        self.counts = {}  # category -> [visible, total]
+
+    def add(self, node, category, radius=None, center=None):
+        """Register a node. Pass center for nodes that never move."""
+        if radius is None:
+            radius = node_radius(node)
+        self.entries[id(node)] = [node, category, center, radius, True]
+        node.culled = False
+
+    def remove(self, node):
+        entry = self.entries.pop(id(node), None)
+        if entry and not entry[4]:
+            self._show(node)
+
+    def clear(self):
+        for node, category, center, radius, visible in self.entries.values():
+            if not visible:
+                self._show(node)
+        self.entries.clear()
+
+    def set_draw_distance(self, category, distance):
+        self.draw_distances[category] = distance
+
+    def _show(self, node):
+        if self.camera_mask is None:
+            node.show()
+        else:
+            node.show(self.camera_mask)
+        node.culled = False
+
+    def _hide(self, node):
+        if self.camera_mask is None:
+            node.hide()
+        else:
+            node.hide(self.camera_mask)
+        node.culled = True
+
+    def update(self, camera_position, matrix):
+        """Cull every registered node against the camera. matrix is the view-projection in rows."""
+        planes = frustum_planes(matrix)
+        cx, cy, cz = camera_position
+        counts = {category: [0, 0] for category in self.draw_distances}
+
+        for entry in self.entries.values():
+            node, category, center, radius, visible = entry
+            if center is None:
+                position = node.get_pos(node.get_top())
+                center = (position[0], position[1], position[2])
+
+            limit = self.draw_distances.get(category)
+            dx, dy, dz = center[0] - cx, center[1] - cy, center[2] - cz
+            in_range = limit is None or dx * dx + dy * dy + dz * dz <= (limit + radius) ** 2
+            now_visible = in_range and sphere_in_frustum(planes, center, radius)
+
+            if now_visible != visible:
+                if now_visible:
+                    self._show(node)
+                else:
+                    self._hide(node)
+                entry[4] = now_visible
+
+            count = counts.setdefault(category, [0, 0])
+            count[0] += now_visible
+            count[1] += 1
+        self.counts = counts
+
+    def summary(self):
+        """Visible/total counts as one line of text."""
+        return '  '.join(f'{category} {visible}/{total}' for category, (visible, total) in self.counts.items() if total)
@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import multiprocessing
+import random
+import time
+from collections import deque
+
+from fixed_timestep import FixedTimestep
+from game_rules import ENEMY, IDLE_INPUT, SHOOT, World, load_blocks
+from netcode import (
+    CONNECT, CONNECT_PACKET, DISCONNECT, HISTORY, INPUT, PROTOCOL_VERSION, WELCOME_PACKET, WELCOME,
+    SnapshotHistory, bearing, decode_inputs, delta_entries, encode_snapshot_header, open_client, pack_delta,
+    quantize_state
+)
+
+# Headless authoritative server for game3DUFPSN.py matches.
+#
+# The server owns the world and runs the game rules in fixed ticks. Clients
+# only send inputs; each tick the server applies one pending input per player,
+# steps the world and, every few ticks, sends each client a snapshot
+# delta-compressed against the last snapshot that client acknowledged. Clients
+# that acked the same snapshot share the same encoded bodies, so the delta is
+# encoded once per distinct baseline rather than once per client; only the
+# order the bodies are split into packets in is per client, nearest first.
+#
+# Each client keeps the snapshot it last acked, so an ack older than the
+# server's history just leaves that client on its previous baseline. Only a
+# client that hasn't acked anything for HISTORY snapshots, which has dropped
+# its baseline by then, is sent the full state again.
+#
+# Run with --bots N to start N bot clients on loopback against the server and
+# print bandwidth and tick times. The bots run in their own process so they
+# don't steal the server's event loop.
+
+MAX_PENDING_INPUTS = 4  # Inputs queued per client, older ones are dropped
+CLIENT_TIMEOUT = 10.0  # Seconds of silence before a client is dropped
+
+
+class RemoteClient:
+    """A connected client as the server sees it."""
+
+    def __init__(self, address, player_id):
+        self.address = address
+        self.player_id = player_id
+        self.pending = deque()  # Inputs not simulated yet, oldest first
+        self.last_sequence = 0  # Newest input received
+        self.applied_sequence = 0  # Newest input simulated
+        self.last_input = IDLE_INPUT
+        self.acked_tick = 0
+        self.baseline_tick = 0  # Newest acked snapshot the server still has, and its state
+        self.baseline = {}
+        self.last_heard = time.monotonic()
+
+
+class GameServer(asyncio.DatagramProtocol):
+    """Runs a World and keeps its clients in sync."""
+
+    def __init__(self, world, tick_rate=60, snapshot_rate=20, max_players=128):
+        self.world = world
+        self.timestep = FixedTimestep(tick_rate=tick_rate, max_steps=5)
+        self.tick_rate = tick_rate
+        self.snapshot_interval = max(1, round(tick_rate / snapshot_rate))
+        self.max_players = max_players
+        self.clients = {}  # address -> RemoteClient
+        self.history = SnapshotHistory()
+        self.transport = None
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.tick_time = 0.0  # Seconds spent simulating and sending, reset by stats()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if not data:
+            return
+        client = self.clients.get(address)
+        packet_type = data[0]
+        if packet_type == CONNECT:
+            if len(data) < CONNECT_PACKET.size or data[1] != PROTOCOL_VERSION:
+                return
+            if client is None:
+                if len(self.clients) >= self.max_players:
+                    return
+                client = RemoteClient(address, self.world.add_player())
+                self.clients[address] = client
+            self.transport.sendto(WELCOME_PACKET.pack(WELCOME, client.player_id, self.world.tick, self.tick_rate), address)
+        elif client is None:
+            return
+        elif packet_type == INPUT:
+            try:
+                ack_tick, inputs = decode_inputs(data)
+            except Exception:
+                return
+            client.last_heard = time.monotonic()
+            # Acks can arrive out of order, only ever move forward
+            if ack_tick > client.acked_tick:
+                client.acked_tick = ack_tick
+                acked = self.history.get(ack_tick)
+                if acked is not None:
+                    client.baseline_tick, client.baseline = ack_tick, acked
+            for player_input in inputs:
+                if player_input.sequence > client.last_sequence:
+                    client.pending.append(player_input)
+                    client.last_sequence = player_input.sequence
+            while len(client.pending) > MAX_PENDING_INPUTS:
+                client.pending.popleft()
+        elif packet_type == DISCONNECT:
+            self.drop(client)
+
+    def drop(self, client):
+        self.clients.pop(client.address, None)
+        self.world.remove_player(client.player_id)
+
+    def step(self, dt):
+        """Apply one input per client and advance the world one tick."""
+        now = time.monotonic()
+        for client in list(self.clients.values()):
+            if now - client.last_heard > CLIENT_TIMEOUT:
+                self.drop(client)
+                continue
+            if client.pending:
+                client.last_input = client.pending.popleft()
+                client.applied_sequence = client.last_input.sequence
+                player_input = client.last_input
+            else:
+                # Nothing arrived in time, keep walking but don't repeat shots
+                player_input = client.last_input._replace(buttons=0)
+            self.world.apply_input(client.player_id, player_input, dt)
+        self.world.step(dt)
+
+        if self.world.tick % self.snapshot_interval == 0:
+            self.send_snapshots()
+
+    def send_snapshots(self):
+        tick = self.world.tick
+        state = quantize_state(self.world.state())
+        self.history.add(tick, state)
+        deltas = {}  # baseline tick -> (changed, removed, parts if one packet holds it all), shared by every client on that baseline
+        for client in self.clients.values():
+            if tick - client.baseline_tick > HISTORY * self.snapshot_interval:
+                # The client has dropped this baseline by now, start it over from the empty one
+                client.baseline_tick, client.baseline = 0, {}
+            delta = deltas.get(client.baseline_tick)
+            if delta is None:
+                changed, removed = delta_entries(state, client.baseline)
+                parts = pack_delta(changed, removed, changed)
+                delta = deltas[client.baseline_tick] = (changed, removed, parts if len(parts) == 1 else None)
+            changed, removed, parts = delta
+            if parts is None:
+                # Doesn't fit one packet, so the order matters
+                parts = pack_delta(changed, removed, self.priority(client, changed, state))
+            for part, body in enumerate(parts):
+                packet = encode_snapshot_header(tick, client.baseline_tick, client.applied_sequence, part, len(parts)) + body
+                self.transport.sendto(packet, client.address)
+                self.bytes_sent += len(packet)
+                self.packets_sent += 1
+
+    def priority(self, client, changed, state):
+        """Changed body ids in the order they're sent: the client's own body, then nearest first."""
+        me = state.get(client.player_id)
+        if me is None:
+            return list(changed)
+        x, z = me[1], me[3]
+        return sorted(changed, key=lambda body_id: (
+            body_id != client.player_id, (state[body_id][1] - x) ** 2 + (state[body_id][3] - z) ** 2
+        ))
+
+    async def run(self, duration=None):
+        """Tick the world in real time until cancelled or duration seconds have passed."""
+        loop = asyncio.get_running_loop()
+        start = last = loop.time()
+        while duration is None or last - start < duration:
+            now = loop.time()
+            began = time.perf_counter()
+            self.timestep.run(now - last, self.step)
+            self.tick_time += time.perf_counter() - began
+            last = now
+            await asyncio.sleep(max(0.0, self.timestep.dt - self.timestep.accumulator))
+
+    def stats(self, seconds):
+        """One line of bandwidth and CPU numbers, then reset the counters."""
+        line = (
+            f'tick {self.world.tick}  clients {len(self.clients)}  bodies {len(self.world.bodies)}  '
+            f'sent {self.bytes_sent / seconds / 1024:.1f} KiB/s in {self.packets_sent / seconds:.0f} packets/s  '
+            f'busy {self.tick_time / seconds * 100:.1f}%'
+        )
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.tick_time = 0.0
+        return line
+
+
+async def run_bot(host, port, tick_rate, duration, seed):
+    """A client that wanders around and shoots at the nearest enemy."""
+    rng = random.Random(seed)
+    client = await open_client(host, port)
+    move_x = rng.uniform(-1, 1)
+    move_z = rng.uniform(-1, 1)
+    loop = asyncio.get_running_loop()
+    end = loop.time() + duration
+    yaw = 0.0
+    buttons = 0
+    try:
+        while loop.time() < end:
+            # Pick a target a few times a second, like a player would
+            if client.sequence % 10 == 0:
+                state = client.state()
+                me = state.get(client.player_id)
+                enemies = [values for values in state.values() if values[0] == ENEMY]
+                if me and enemies:
+                    target = min(enemies, key=lambda values: (values[1] - me[1]) ** 2 + (values[3] - me[3]) ** 2)
+                    yaw = bearing(me[1:4], target[1:4])
+                    buttons = SHOOT
+            if rng.random() < 0.01:
+                move_x = rng.uniform(-1, 1)
+                move_z = rng.uniform(-1, 1)
+            client.send_input(move_x, move_z, yaw, 0.0, buttons)
+            await asyncio.sleep(1 / tick_rate)
+    finally:
+        client.disconnect()
+    return client
+
+
+async def run_bots(host, port, tick_rate, duration, count, seed):
+    clients = await asyncio.gather(*(run_bot(host, port, tick_rate, duration, seed + i) for i in range(count)))
+    received = sum(client.bytes_received for client in clients)
+    snapshots = sum(client.snapshots_received for client in clients)
+    return f'{len(clients)} bots received {snapshots} snapshots, {received / max(snapshots, 1):.0f} bytes each on average'
+
+
+def bot_process(host, port, tick_rate, duration, count, seed, results):
+    results.put(asyncio.run(run_bots(host, port, tick_rate, duration, count, seed)))
+
+
+async def main(args):
+    blocks = load_blocks(args.map) if args.map else None
+    world = World(seed=args.seed, blocks=blocks, enemy_count=args.enemies)
+    loop = asyncio.get_running_loop()
+    transport, server = await loop.create_datagram_endpoint(
+        lambda: GameServer(world, args.tick_rate, args.snapshot_rate, args.max_players),
+        local_addr=(args.host, args.port),
+    )
+    print(f'Server listening on {args.host}:{args.port} at {args.tick_rate} ticks/s')
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.stats_interval)
+            print(server.stats(args.stats_interval))
+
+    reporter = asyncio.ensure_future(report())
+    bots = None
+    if args.bots:
+        results = multiprocessing.Queue()
+        bots = multiprocessing.Process(
+            target=bot_process,
+            args=(args.host, args.port, args.tick_rate, args.duration or 10, args.bots, args.seed, results),
+            daemon=True,
+        )
+        bots.start()
+    try:
+        await server.run(args.duration if args.duration or not bots else 10)
+        if bots:
+            print(await loop.run_in_executor(None, results.get))
+    finally:
+        reporter.cancel()
+        transport.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless game3DUFPSN server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=27015)
+    parser.add_argument('--map', help='map file whose blocks bullets collide with (needs Ursina to read)')
+    parser.add_argument('--tick-rate', type=int, default=60)
+    parser.add_argument('--snapshot-rate', type=int, default=20, help='snapshots sent to each client per second')
+    parser.add_argument('--max-players', type=int, default=128)
+    parser.add_argument('--enemies', type=int, default=5, help='enemies kept alive in the match')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--duration', type=float, help='stop after this many seconds')
+    parser.add_argument('--bots', type=int, default=0, help='start this many loopback bot clients')
+    parser.add_argument('--stats-interval', type=float, default=2.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,232 @@
+import hashlib
+import os
+import pickle
+import struct
+
+# Append-only edit journal for map.dbo.
+#
+# The base map keeps its old format, a pickled list of
+# (obj_type, position, rotation, color, sound_file, play_on_awake, loop).
+# Every edit made in the editor is appended to <map>.journal as it happens,
+# so saving only has to push the journal to disk. Compaction folds the
+# journal into a new base map and starts an empty journal.
+#
+# Objects are identified by their index in the base map; objects placed
+# afterwards get the next free id. The journal header stores a hash of the
+# base it was written against, so a journal left over from an interrupted
+# compaction is recognised and ignored.
+
+JOURNAL_MAGIC = b'SUPEJRNL'
+LENGTH = struct.Struct('<I')
+
+# Journal operations
+PLACE = 'place'
+MOVE = 'move'
+COLOR = 'color'
+SOUND = 'sound'
+DELETE = 'delete'
+BATCH = 'batch'  # Full records of many objects at once, None deletes
+
+
+def journal_path(map_path):
+    return map_path + '.journal'
+
+
+def _hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def _write_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def _apply(records, entry):
+    op, object_id = entry[0], entry[1]
+    if op == BATCH:
+        for object_id, record in entry[2]:
+            if record is None:
+                records.pop(object_id, None)
+            else:
+                records[object_id] = record
+    elif op == PLACE:
+        records[object_id] = entry[2]
+    elif object_id not in records:
+        return
+    elif op == MOVE:
+        records[object_id] = (records[object_id][0], entry[2], entry[3]) + records[object_id][3:]
+    elif op == COLOR:
+        records[object_id] = records[object_id][:3] + (entry[2],) + records[object_id][4:]
+    elif op == SOUND:
+        records[object_id] = records[object_id][:4] + tuple(entry[2:5])
+    elif op == DELETE:
+        del records[object_id]
+
+
+def _read_journal(path, base_hash, records):
+    """Replay a journal into records.
+
+    Returns the offset after the last complete entry and the number of entries,
+    or None if the journal doesn't belong to this base map.
+    """
+    entries = 0
+    with open(path, 'rb') as file:
+        if file.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC or file.read(20) != base_hash:
+            return None  # Written against another base map, it's stale
+        offset = file.tell()
+        while True:
+            raw = file.read(LENGTH.size)
+            if len(raw) < LENGTH.size:
+                break
+            size = LENGTH.unpack(raw)[0]
+            payload = file.read(size)
+            if len(payload) < size:
+                break  # Entry cut short by a crash
+            try:
+                _apply(records, pickle.loads(payload))
+            except Exception:
+                break
+            offset = file.tell()
+            entries += 1
+    return offset, entries
+
+
+def read_records(map_path):
+    """Return the object id -> record dict of a map with its journal applied."""
+    with open(map_path, 'rb') as file:
+        records = dict(enumerate(pickle.load(file)))
+    if os.path.exists(journal_path(map_path)):
+        _read_journal(journal_path(map_path), _hash_file(map_path), records)
+    return records
+
+
+def read_map(map_path):
+    """Return the object records of a map with its journal applied."""
+    return list(read_records(map_path).values())
+
+
+class EditJournal:
+    """Tracks the object records of the open map and journals every edit."""
+
+    def __init__(self, map_path, records=None):
+        self.map_path = map_path
+        self.records = records if records is not None else {}  # object id -> record
+        self.next_id = max(self.records, default=-1) + 1
+        self.file = None
+        self.entries = 0  # Journal entries since the last compaction
+        self.compact_threshold = 5000
+        self.revision = 0  # Bumped on every edit
+
+    @classmethod
+    def fresh(cls, map_path):
+        """Start an empty map, the first save writes it out in full."""
+        return cls(map_path)
+
+    @classmethod
+    def load(cls, map_path):
+        """Open a saved map and keep appending to its journal."""
+        with open(map_path, 'rb') as file:
+            records = dict(enumerate(pickle.load(file)))
+        journal = cls(map_path, records)
+        base_hash = _hash_file(map_path)
+
+        path = journal_path(map_path)
+        replayed = _read_journal(path, base_hash, journal.records) if os.path.exists(path) else None
+        if replayed is None:
+            journal._start_journal(base_hash)
+        else:
+            offset, journal.entries = replayed
+            journal.next_id = max(journal.records, default=-1) + 1
+            journal.file = open(path, 'r+b')
+            journal.file.truncate(offset)  # Drop a torn entry at the end
+            journal.file.seek(offset)
+        return journal
+
+    def _start_journal(self, base_hash):
+        if self.file:
+            self.file.close()
+        path = journal_path(self.map_path)
+        _write_atomic(path, JOURNAL_MAGIC + base_hash)
+        self.file = open(path, 'ab')
+        self.entries = 0
+
+    def _append(self, entry):
+        _apply(self.records, entry)
+        self.entries += 1
+        self.revision += 1
+        if self.file:
+            payload = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+            self.file.write(LENGTH.pack(len(payload)) + payload)
+
+    def allocate_id(self):
+        object_id = self.next_id
+        self.next_id += 1
+        return object_id
+
+    def place(self, record):
+        """Journal a new object and return its id."""
+        object_id = self.allocate_id()
+        self._append((PLACE, object_id, tuple(record)))
+        return object_id
+
+    def restore(self, object_id, record):
+        """Journal the full record of an object under an existing id (used by undo/redo)."""
+        self.next_id = max(self.next_id, object_id + 1)
+        self._append((PLACE, object_id, tuple(record)))
+
+    def restore_many(self, items):
+        """Journal the full records of many objects as one entry, a None record deletes."""
+        items = [(object_id, tuple(record) if record is not None else None) for object_id, record in items]
+        if not items:
+            return
+        self.next_id = max(self.next_id, max(object_id for object_id, record in items) + 1)
+        self._append((BATCH, None, items))
+
+    def move(self, object_id, position, rotation):
+        self._append((MOVE, object_id, position, rotation))
+
+    def recolor(self, object_id, color):
+        self._append((COLOR, object_id, color))
+
+    def set_sound(self, object_id, sound_file, play_on_awake, loop):
+        self._append((SOUND, object_id, sound_file, play_on_awake, loop))
+
+    def delete(self, object_id):
+        self._append((DELETE, object_id))
+
+    def save(self):
+        """Push the journal to disk, compacting it first if it grew large.
+
+        Returns an old id -> new id mapping when ids changed, otherwise None.
+        """
+        if self.file is None or self.entries >= self.compact_threshold:
+            return self.compact()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return None
+
+    def compact(self):
+        """Fold the journal into a new base map and start an empty journal.
+
+        Objects are renumbered in order, returns the old id -> new id mapping.
+        """
+        remap = {object_id: i for i, object_id in enumerate(self.records)}
+        data = pickle.dumps(list(self.records.values()), protocol=pickle.HIGHEST_PROTOCOL)
+        _write_atomic(self.map_path, data)
+        self.records = {remap[object_id]: record for object_id, record in self.records.items()}
+        self.next_id = len(self.records)
+        self._start_journal(hashlib.sha1(data).digest())
+        return remap
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,82 @@
+# Fixed timestep simulation with render interpolation.
+#
+# Frame time is collected in an accumulator and the simulation is stepped
+# in whole ticks of a fixed length, so gameplay behaves the same at any frame
+# rate. Each frame runs at most max_steps ticks. If the game falls further
+# behind than that, the extra time is dropped and the game slows down instead
+# of spending ever more frames catching up.
+#
+# Entities that move in the simulation keep their simulated position in
+# sim_position and the one from the tick before in prev_position. Before a
+# tick their node is put back on sim_position. After the last tick of a frame
+# they are drawn between the two, by how far the frame is into the next tick.
+
+
+class FixedTimestep:
+    """Turns variable frame times into a number of fixed length ticks."""
+
+    def __init__(self, tick_rate=60, max_steps=5):
+        self.tick_rate = tick_rate
+        self.dt = 1 / tick_rate
+        self.max_steps = max_steps
+        self.accumulator = 0.0
+        self.tick = 0  # Ticks simulated so far
+        self.alpha = 0.0  # How far the frame is between the last two ticks (0..1)
+        self.dropped = 0.0  # Seconds skipped because the simulation fell behind
+
+    @property
+    def time(self):
+        """Simulated time in seconds."""
+        return self.tick * self.dt
+
+    def advance(self, frame_time):
+        """Add a frame's time and return how many ticks to run."""
+        self.accumulator += max(0.0, frame_time)
+        steps = int(self.accumulator / self.dt)
+        if steps > self.max_steps:
+            self.dropped += (steps - self.max_steps) * self.dt
+            self.accumulator -= (steps - self.max_steps) * self.dt
+            steps = self.max_steps
+        self.accumulator -= steps * self.dt
+        self.alpha = self.accumulator / self.dt
+        return steps
+
+    def run(self, frame_time, step):
+        """Call step(dt) for every tick due this frame. Returns the number of ticks."""
+        steps = self.advance(frame_time)
+        for _ in range(steps):
+            step(self.dt)
+            self.tick += 1
+        return steps
+
+    def step_now(self, step):
+        """Run one tick right away, whatever the frame time. Used to replay at full speed."""
+        step(self.dt)
+        self.tick += 1
+        self.accumulator = 0.0
+        self.alpha = 1.0
+
+
+def begin_tick(entities):
+    """Put entities back on their simulated positions before a tick."""
+    for entity in entities:
+        sim_position = getattr(entity, 'sim_position', None)
+        if sim_position is not None:
+            entity.position = sim_position
+        entity.prev_position = entity.position
+
+
+def end_tick(entities):
+    """Remember where a tick left the entities."""
+    for entity in entities:
+        entity.sim_position = entity.position
+
+
+def interpolate(entities, alpha):
+    """Draw entities between their last two simulated positions."""
+    for entity in entities:
+        sim_position = getattr(entity, 'sim_position', None)
+        if sim_position is None:
+            continue
+        prev_position = getattr(entity, 'prev_position', sim_position)
+        entity.position = prev_position + (sim_position - prev_position) * alpha
@@ -1,16 +1,45 @@
+# Timed first so the imports are part of the startup timeline
+from startup_timeline import StartupTimeline
+startup = StartupTimeline('game engine')
+
 from ursina import *
 from ursina.prefabs.editor_camera import EditorCamera
+startup.mark('import ursina')
 import random
-import pickle  # For saving and loading data
 import time
+import atexit
+from collections import deque
+from telemetry import TelemetryWriter
+from voxel_grid import OccupancyGrid, cell_of, position_of, BASE_Y, LAYER_HEIGHT
+from block_mesher import ChunkMesher, is_transparent
+from edit_journal import EditJournal
+from undo_stack import UndoStack, EditRecord
+from autosave import AutosaveService, latest_autosave, load_autosave
+from region_tools import Region, copy_region, offset_cell
+from selection import Selection, select_in_box, select_in_lasso, box_on_screen
+from culling import CullingSystem, matrix_rows, bounds_sphere, node_radius
+from mesh_lod import load_lods, bounding_radius, projected_size, select_level
+from shadow_cascades import CascadedShadows
+from texture_cache import cached_texture
+from map_bake import bake_records, read_baked, baked_path
+from type_registry import TypeRegistry
+from panda3d.core import CollisionRay, TransparencyAttrib
+startup.mark('import modules')
 
 app = Ursina()
+startup.mark('window')
+
+# Per-frame engine counters for monitor.py
+telemetry = TelemetryWriter()
+atexit.register(telemetry.close)
 
 
 # Define the 2D transparent flame texture
 flame_texture = 'flame.png'  # Make sure this image is in your assets folder
 
 class FlameParticleSystem(Entity):
+    live_particles = 0  # Particles alive across every flame, for telemetry
+
     def __init__(self, **kwargs):
         super().__init__()
         self.particles = []
@@ -21,7 +50,8 @@ class FlameParticleSystem(Entity):
             setattr(self, key, value)
 
     def update(self):
-        if time.time() - self.last_spawn_time > self.spawn_rate:
+        # No new particles while the flame is culled, the live ones still fade out
+        if not getattr(self, 'culled', False) and time.time() - self.last_spawn_time > self.spawn_rate:
             self.spawn_particle()
             self.last_spawn_time = time.time()
 
@@ -33,11 +63,12 @@ class FlameParticleSystem(Entity):
             if particle.alpha <= 0:
                 self.particles.remove(particle)
                 destroy(particle)
+                FlameParticleSystem.live_particles -= 1
 
     def spawn_particle(self):
         particle = Entity(
             model='quad',
-            texture=flame_texture,
+            texture=cached_texture(flame_texture),
             scale=0.2,
             position=self.position + Vec3(random.uniform(-0.1, 0.1), 0, random.uniform(-0.1, 0.1)),
             rotation=(random.uniform(-10, 10), random.uniform(-10, 10), random.uniform(-10, 10)),
@@ -46,21 +77,40 @@ class FlameParticleSystem(Entity):
         )
         particle.alpha = 1
         self.particles.append(particle)
+        FlameParticleSystem.live_particles += 1
+
+    # Called by destroy(), the particles aren't parented to the flame so they'd outlive it
+    def on_destroy(self):
+        FlameParticleSystem.live_particles -= len(self.particles)
+        for particle in self.particles:
+            destroy(particle)
+        self.particles.clear()
 
 # Skybox
 sky = Sky()
 
 # Lighting
-directional_light = DirectionalLight(shadows=True)
+directional_light = DirectionalLight()
 directional_light.look_at(Vec3(1, -1, -1))
 ambient_light = AmbientLight(color=color.rgba(100, 100, 100, 0.5))
 
+# Shadows from three cascades fitted to the camera instead of one map over the whole train
+shadows = CascadedShadows(base, scene, directional_light.forward)
+shadows.exclude(sky)
+sky.set_shader_off(20)  # The sky isn't lit
+sky.set_light_off(20)
+
+# Hides what's off screen or too far away from the main camera (set up after the shadow
+# cascades have taken their camera mask bits)
+culling = CullingSystem(camera_mask=base.cam.node().get_camera_mask())
+
 # Set the sky color
 camera.background_color = color.rgb(178, 216, 230)  # Light blue sky color
 
 # Create a mid-poly train with a collider, using dirt texture and repeat the texture
-train_texture = load_texture('dirt.png')
+train_texture = cached_texture('dirt.png')
 train = Entity(model='cube', scale=(500, 10, 500), texture=train_texture, collider='box')
+shadows.exclude(train)  # Nothing is under the ground for it to shadow
 
 # Repeat the texture on the cube
 train.texture_scale = (train.scale[0], train.scale[2])  # Repeat based on cube's size
@@ -87,12 +137,149 @@ models_data = {
     'brick': ('brick.obj', 'brick.png'),
     'flame': (None, flame_texture)  # Use None for model and add flame texture
 }
+registry = TypeRegistry(models_data)  # Loads each type once, placed objects are copies of it
 
 
 selected_object = None  # Keep track of selected object
 buttons = []  # List to store buttons
 object_placed = False  # To track whether the object is placed
 placed_objects = []  # List to store placed objects
+objects_by_id = {}  # Placed objects by journal object id
+journal = EditJournal.fresh('map.dbo')  # Records every edit, saving only flushes it
+baked_map = None  # Last baked package of map.dbo, the Bake button rebakes it
+history = UndoStack(limit=200)  # Undo/redo of edits (Ctrl+Z / Ctrl+Y)
+autosave = AutosaveService(interval=120)  # Snapshots the map in the background every 2 minutes
+autosave.mark_saved((id(journal), journal.revision))  # An unedited map is never snapshotted
+occupancy = OccupancyGrid()  # Placed objects by grid cell, used for picking instead of colliders
+
+# Outline showing where the next block will go
+placement_marker = Entity(model='wireframe_cube', color=color.yellow, scale=2.02, enabled=False)
+
+# Grid-aligned blocks are drawn as merged chunk meshes instead of one model each
+chunk_mesher = ChunkMesher()
+chunk_entities = {}  # chunk -> list of mesh entities
+
+# Blocks made by the region tools only exist as map data and chunk mesh faces,
+# they get an entity when they're picked for editing
+class VirtualBlock:
+    __slots__ = ('object_id',)
+
+    def __init__(self, object_id):
+        self.object_id = object_id
+
+virtual_blocks = {}  # object id -> VirtualBlock
+
+# Region tools (Shift + 1/2 set the corners, F fill, H hollow, R replace, C copy, V paste)
+region_corners = [None, None]
+region_marker = Entity(model='wireframe_cube', color=color.azure, enabled=False)
+region_jobs = deque()  # Running region operations, advanced a little every frame
+region_budget = 0.004  # Seconds of region work per frame
+region_batch = 64  # Cells handled between budget checks
+clipboard = []  # (offset from the low corner, record) pairs
+clipboard_origin = None  # Low corner of the copied region
+pending_selection_color = None  # Colour the material sliders picked while a selection edit was still running
+
+# Multi-selection (Alt + drag for a box, Alt + Shift + drag for a lasso)
+selection = Selection()
+selection_marker = Entity(model='wireframe_cube', color=color.orange, enabled=False)
+selection_drag = None  # 'box' or 'lasso' while dragging
+selection_path = []  # Mouse positions of the drag in device coordinates
+
+# Quarter turns around y keep a block on the grid, the chunk mesh can still draw it
+def is_grid_rotation(rotation):
+    return rotation[0] == 0 and rotation[2] == 0 and rotation[1] % 90 == 0
+
+# Function to check if a placed object can be drawn by its chunk mesh
+def is_meshable(entity):
+    obj_type = registry.type_of(entity)
+    if obj_type not in models_data or models_data[obj_type][0] is None:
+        return False
+    cell = occupancy.cell_of_item(entity)
+    if cell is None or not is_grid_rotation(entity.rotation) or entity.scale != Vec3(1, 1, 1):
+        return False
+    # The mesh has one block per cell, objects sharing a cell draw themselves
+    if len(occupancy.items_in(cell)) > 1:
+        return False
+    return distance(entity.position, Vec3(*position_of(cell))) < 0.01
+
+# Function to hand a placed object to the chunk meshes, or take it back
+def refresh_block(entity):
+    old_cell = getattr(entity, 'mesh_cell', None)
+    if old_cell is not None:
+        chunk_mesher.remove_block(old_cell)
+        entity.mesh_cell = None
+
+    if is_meshable(entity):
+        entity.mesh_cell = occupancy.cell_of_item(entity)
+        chunk_mesher.set_block(entity.mesh_cell, registry.type_of(entity), tuple(entity.color))
+        entity.model.hide()
+    elif entity.model:
+        entity.model.show()
+    track_object(entity)
+
+# Function to (re)register a placed object with culling and the shadow casters at
+# its current place. Blocks drawn by their chunk mesh are left out, the chunk
+# entity covers them.
+def track_object(entity):
+    culling.remove(entity)
+    shadows.remove_caster(entity)
+    if getattr(entity, 'mesh_cell', None) is None:
+        center = tuple(entity.world_position)
+        category = 'effect' if isinstance(entity, FlameParticleSystem) else 'object'
+        culling.add(entity, category, center=center)
+        shadows.add_caster(entity, node_radius(entity), static=True, center=center)
+
+# Function to refresh the objects of a cell after something entered or left it.
+# A virtual block sharing its cell gets an entity, the chunk mesh can't draw both.
+def settle_cell(cell):
+    items = occupancy.items_in(cell)
+    if len(items) > 1:
+        for item in items:
+            if isinstance(item, VirtualBlock):
+                materialize_block(item)  # Spawning it settles the cell again
+                return
+    for item in list(items):
+        if not isinstance(item, VirtualBlock):
+            refresh_block(item)
+
+# Function to re-key a placed object after it moved, both cells it touched are settled
+def relocate(entity):
+    old_cell = occupancy.cell_of_item(entity)
+    cell = occupancy.move_item(entity, entity.position)
+    settle_cell(cell)
+    if old_cell is not None and old_cell != cell:
+        settle_cell(old_cell)
+
+def forget_block(entity):
+    if getattr(entity, 'mesh_cell', None) is not None:
+        chunk_mesher.remove_block(entity.mesh_cell)
+        entity.mesh_cell = None
+
+# Function to rebuild the meshes of every chunk that changed since last time
+def rebuild_chunks():
+    for chunk in chunk_mesher.take_dirty():
+        for chunk_entity in chunk_entities.pop(chunk, []):
+            culling.remove(chunk_entity)
+            shadows.remove_caster(chunk_entity)
+            destroy(chunk_entity)
+
+        for obj_type, data in chunk_mesher.build_chunk(chunk).items():
+            chunk_entity = Entity(
+                model=Mesh(
+                    vertices=data.vertices,
+                    triangles=data.triangles,
+                    uvs=data.uvs,
+                    normals=data.normals,
+                    colors=[color.Color(*c) for c in data.colors]
+                ),
+                texture=registry.texture(obj_type)
+            )
+            if is_transparent(obj_type):
+                chunk_entity.set_transparency(TransparencyAttrib.M_alpha)
+            center, radius = bounds_sphere(data.vertices)
+            culling.add(chunk_entity, 'chunk', radius, center)
+            shadows.add_caster(chunk_entity, radius, static=True, center=center)
+            chunk_entities.setdefault(chunk, []).append(chunk_entity)
 
 # Function to check if the mouse is over a button
 def mouse_over_button():
@@ -104,6 +291,24 @@ def snap_to_grid(position, grid_size=1):
     z = round(position[2] / grid_size) * grid_size
     return Vec3(x, position[1], z)
 
+# Function to get the world space ray under the mouse cursor
+def mouse_ray():
+    picker_ray = CollisionRay()
+    picker_ray.set_from_lens(camera.lens_node, mouse.x * 2 / window.aspect_ratio, mouse.y * 2)
+    origin = render.get_relative_point(camera.lens_node, picker_ray.get_origin())
+    direction = render.get_relative_vector(camera.lens_node, picker_ray.get_direction())
+    return origin, direction
+
+# Function to find the placed object under the mouse with the occupancy grid
+def pick_placed_object():
+    origin, direction = mouse_ray()
+    hit = occupancy.raycast(origin, direction)
+    if hit is None:
+        return None
+    if isinstance(hit.item, VirtualBlock):
+        return materialize_block(hit.item)
+    return hit.item
+
 def place_object():
     global object_placed
 
@@ -111,35 +316,32 @@ def place_object():
         return
 
     if selected_object and not object_placed:
-        hit_info = mouse.hovered_entity
-
-        if hit_info in placed_objects or hit_info == train:
-            model, texture = models_data[selected_object]
+        origin, direction = mouse_ray()
+        cell = occupancy.placement_cell(origin, direction)
 
-            grid_position = snap_to_grid(mouse.world_point)
+        if cell is not None and cell not in occupancy:
+            obj_type = 'flameparticlesystem' if selected_object == 'flame' else selected_object
+            grid_position = Vec3(*position_of(cell))
+            record = (obj_type, grid_position, Vec3(0, 0, 0), color.white, None, False, False)
 
-            if hit_info != train:
-                grid_position.y = hit_info.world_y + hit_info.scale_y + 0.23
-
-            if selected_object == 'flame':
-                placed_object = FlameParticleSystem(
-                    position=grid_position + Vec3(0, 0.8, 0),
-                    scale=1,  # Adjust scale if necessary
-                    collider='box'
-                )
-            else:
-                placed_object = Entity(
-                    model=model,
-                    texture=texture,
-                    position=grid_position + Vec3(0, 0.8, 0),
-                    scale=1,
-                    collider='box'
-                )
-
-            placed_objects.append(placed_object)
+            object_id = journal.place(record)
+            spawn_placed_object(object_id, record)
+            history.push([EditRecord(object_id, cell, None, record)])
             print(f'Placed {selected_object} at {grid_position}')
             object_placed = True
 
+# Function to move the placement outline to the cell under the mouse
+def update_placement_marker():
+    if not selected_object or mouse_over_button():
+        placement_marker.enabled = False
+        return
+
+    origin, direction = mouse_ray()
+    cell = occupancy.placement_cell(origin, direction)
+    placement_marker.enabled = cell is not None
+    if cell is not None:
+        placement_marker.position = position_of(cell)
+
 
 # Function to select object when a button is clicked
 def select_object(object_name):
@@ -165,90 +367,537 @@ for i, name in enumerate(button_names):
     buttons.append(button)
 
 
+# Function to build the saved record of a placed object
+def object_record(obj):
+    obj_type = registry.type_of(obj)
+    sound_file = getattr(obj, 'sound_file', None)
+    play_on_awake = getattr(obj, 'play_on_awake', False)
+    loop = getattr(obj, 'loop', False)
+    return (obj_type, obj.position, obj.rotation, obj.color, sound_file, play_on_awake, loop)
+
+# Functions to journal edits of a placed object
+def journal_transform(obj):
+    journal.move(obj.object_id, obj.position, obj.rotation)
+
+def journal_sound(obj):
+    journal.set_sound(obj.object_id, getattr(obj, 'sound_file', None), getattr(obj, 'play_on_awake', False), getattr(obj, 'loop', False))
+
+# Function to check if a saved record is a plain grid-aligned block
+def is_block_record(record):
+    obj_type, position, rotation = record[:3]
+    if obj_type not in models_data or models_data[obj_type][0] is None:
+        return False
+    position = Vec3(*position)
+    return is_grid_rotation(rotation) and distance(position, Vec3(*position_of(cell_of(position)))) < 0.01
+
+# Functions to add and remove blocks that have no entity
+def add_virtual_block(object_id, record):
+    block = VirtualBlock(object_id)
+    cell = cell_of(record[1])
+    virtual_blocks[object_id] = block
+    occupancy.add(cell, block)
+    chunk_mesher.set_block(cell, record[0], tuple(record[3]))
+
+def remove_virtual_block(block):
+    cell = occupancy.cell_of_item(block)
+    occupancy.remove_item(block)
+    if cell is not None:
+        chunk_mesher.remove_block(cell)
+    del virtual_blocks[block.object_id]
+
+# Function to give a virtual block an entity so it can be edited
+def materialize_block(block):
+    remove_virtual_block(block)
+    return spawn_placed_object(block.object_id, journal.records[block.object_id])
+
+# Function to create a placed object from its saved record
+def spawn_placed_object(object_id, record):
+    obj_type, position, rotation, color_data, sound_file, play_on_awake, loop = record
+    if obj_type == 'flameparticlesystem':
+        placed_object = FlameParticleSystem(
+            position=position,
+            rotation=rotation,
+            color=color_data
+        )
+        registry.register(placed_object, obj_type)
+    else:
+        if obj_type not in registry:
+            print(f"Warning: Unknown object type '{obj_type}'. Using default model and texture.")
+        placed_object = registry.instantiate(
+            obj_type,
+            position=position,
+            rotation=rotation,
+            scale=1,
+            color=color_data
+        )
+
+    placed_object.object_id = object_id
+    # Attach sound settings
+    placed_object.sound_file = sound_file
+    placed_object.play_on_awake = play_on_awake
+    placed_object.loop = loop
+
+    if sound_file:
+        placed_object.audio = Audio(sound_file, autoplay=play_on_awake, loop=loop)
+
+    placed_object.placed_index = len(placed_objects)
+    placed_objects.append(placed_object)
+    objects_by_id[object_id] = placed_object
+    occupancy.add(cell_of(placed_object.position), placed_object)
+    settle_cell(cell_of(placed_object.position))
+    return placed_object
+
+# Function to remove a placed object from the scene and every index
+def remove_placed_object(entity):
+    if entity == selected_entity:
+        destroy_property_ui()
+        destroy_sound_window()
+
+    forget_block(entity)
+    culling.remove(entity)
+    shadows.remove_caster(entity)
+    cell = occupancy.remove_item(entity)
+    objects_by_id.pop(entity.object_id, None)
+    registry.forget(entity)
+
+    # Swap with the last object so removal doesn't shift the whole list
+    last = placed_objects.pop()
+    if last is not entity:
+        placed_objects[entity.placed_index] = last
+        last.placed_index = entity.placed_index
+    destroy(entity)
+    if cell is not None:
+        settle_cell(cell)
+
+# Function to record an edit of a placed object for undo
+def record_edit(entity, before, merge_key=None):
+    history.push([EditRecord(entity.object_id, occupancy.cell_of_item(entity), before, object_record(entity))], merge_key)
+
+# Function to set placed objects to saved records in one pass (None deletes),
+# used by undo/redo and the region tools
+def apply_records(items):
+    journal.restore_many(items)
+
+    # Take every object off the grid first so they can move into each other's cells
+    touched = set()  # Cells objects left or entered, settled once everything is placed
+    kept = lift_records(items, touched)
+    place_records(items, kept, touched)
+    touched.discard(None)
+    for cell in touched:
+        settle_cell(cell)
+
+# First half of apply_records: take the objects of (id, record) items off the
+# grid, returns the entities that stay (None where there is none to keep)
+def lift_records(items, touched):
+    kept = []
+    for object_id, record in items:
+        block = virtual_blocks.get(object_id)
+        if block:
+            touched.add(occupancy.cell_of_item(block))
+            remove_virtual_block(block)
+        entity = objects_by_id.get(object_id)
+        if entity and (record is None or registry.type_of(entity) != record[0]):
+            remove_placed_object(entity)
+            entity = None
+        if entity:
+            forget_block(entity)
+            touched.add(occupancy.remove_item(entity))
+        kept.append(entity)
+    return kept
+
+# Second half of apply_records: put the lifted objects where their records say
+def place_records(items, kept, touched):
+    for (object_id, record), entity in zip(items, kept):
+        if record is None:
+            continue
+        if entity is None:
+            # Plain blocks stay as map data and chunk mesh until they're picked
+            if is_block_record(record) and cell_of(record[1]) not in occupancy:
+                add_virtual_block(object_id, record)
+            else:
+                spawn_placed_object(object_id, record)
+            continue
+
+        obj_type, position, rotation, color_data, sound_file, play_on_awake, loop = record
+        entity.position = position
+        entity.rotation = rotation
+        entity.color = color_data
+        entity.sound_file = sound_file
+        entity.play_on_awake = play_on_awake
+        entity.loop = loop
+        occupancy.add(cell_of(entity.position), entity)
+        touched.add(cell_of(entity.position))
+
+def apply_record(object_id, record):
+    apply_records([(object_id, record)])
+
+def undo_edit():
+    changes = []
+    command = history.undo(lambda object_id, record: changes.append((object_id, record)))
+    if command:
+        apply_records(changes)
+        refresh_selection()
+        print(f'Undo: {len(command.records)} object(s)')
+
+def redo_edit():
+    changes = []
+    command = history.redo(lambda object_id, record: changes.append((object_id, record)))
+    if command:
+        apply_records(changes)
+        refresh_selection()
+        print(f'Redo: {len(command.records)} object(s)')
+
+# Function to get the main camera's view-projection matrix as nested rows
+def view_projection_matrix():
+    return matrix_rows(render.get_mat(base.cam) * base.cam.node().get_lens().get_projection_mat())
+
+# Function to get the mouse position in device coordinates (-1..1 on both axes)
+def mouse_device_point():
+    return (mouse.x * 2 / window.aspect_ratio, mouse.y * 2)
+
+def update_selection_drag():
+    global selection_drag, selection_path
+    if held_keys['alt'] and mouse.left:
+        point = mouse_device_point()
+        if selection_drag is None:
+            selection_drag = 'lasso' if held_keys['shift'] else 'box'
+            selection_path = [point]
+        elif selection_drag == 'box' or distance_2d(point, selection_path[-1]) > 0.01:
+            selection_path.append(point)
+    elif selection_drag:
+        finish_selection()
+
+def finish_selection():
+    global selection_drag
+    matrix = view_projection_matrix()
+    # Only the objects of grid columns the drawn shape can reach are projected
+    rect_low = (min(p[0] for p in selection_path), min(p[1] for p in selection_path))
+    rect_high = (max(p[0] for p in selection_path), max(p[1] for p in selection_path))
+    items = [
+        (item.object_id, journal.records[item.object_id][1])
+        for low, high, cells in occupancy.column_bounds()
+        if box_on_screen(matrix, low, high, rect_low, rect_high)
+        for cell in cells
+        for item in occupancy.items_in(cell)
+    ]
+    if selection_drag == 'box':
+        ids = select_in_box(matrix, items, selection_path[0], selection_path[-1])
+    else:
+        ids = select_in_lasso(matrix, items, selection_path)
+    selection_drag = None
+
+    selection.set([(object_id, journal.records[object_id]) for object_id in ids])
+    update_selection_marker()
+    if ids:
+        # The material panel recolours the whole selection
+        destroy_property_ui()
+        destroy_sound_window()
+        create_material_ui(None)
+    print(f'Selected {len(ids)} object(s)')
+
+def clear_selection():
+    global pending_selection_color
+    pending_selection_color = None
+    selection.clear()
+    update_selection_marker()
+    destroy_material_ui()
+
+# Function to reload the selection's columns from the map data
+def refresh_selection():
+    if len(selection):
+        selection.set([(object_id, journal.records[object_id]) for object_id in selection.ids if object_id in journal.records])
+    update_selection_marker()
+
+def update_selection_marker():
+    if not len(selection):
+        selection_marker.enabled = False
+        return
+    low, high = selection.bounds()
+    selection_marker.position = [(low[axis] + high[axis]) / 2 for axis in range(3)]
+    selection_marker.scale = [high[axis] - low[axis] + 2.06 for axis in range(3)]
+    selection_marker.enabled = True
+
+# Function to write the selection's columns back to the map and the scene as one undo step.
+# Big selections take a while, so it runs as a region job: every object is taken
+# off the grid first, a batch per step, then put back where its record says.
+def flush_selection():
+    items = selection.records(journal.records, Vec3, color.Color)
+    edits = [EditRecord(object_id, cell_of(record[1]), journal.records[object_id], record) for object_id, record in items]
+    start_region_job(selection_job(items, edits))
+
+def selection_job(items, edits):
+    touched = set()
+    kept = []
+    for start in range(0, len(items), region_batch):
+        kept.extend(lift_records(items[start:start + region_batch], touched))
+        yield
+    for start in range(0, len(items), region_batch):
+        batch = items[start:start + region_batch]
+        journal.restore_many(batch)
+        place_records(batch, kept[start:start + region_batch], touched)
+        yield
+    touched.discard(None)
+    for i, cell in enumerate(touched):
+        settle_cell(cell)
+        if i % region_batch == 0:
+            yield
+    history.push(edits)
+    update_selection_marker()
+
+def move_selection(dx, dy, dz):
+    refresh_selection()
+    selection.translate(dx, dy, dz)
+    flush_selection()
+
+def rotate_selection(angle):
+    refresh_selection()
+    # Turn around the centre of a cell so blocks stay on the grid
+    pivot = position_of(cell_of(selection.center()))
+    selection.rotate_y(angle, pivot)
+    flush_selection()
+
+def recolor_selection(color_value):
+    global pending_selection_color
+    if region_jobs:
+        # A slider sweep would queue an edit per frame, only the last colour is applied
+        pending_selection_color = color_value
+        return
+    pending_selection_color = None
+    refresh_selection()
+    selection.recolor(color_value)
+    flush_selection()
+
+def delete_selection():
+    refresh_selection()
+    items = [(object_id, None) for object_id in selection.ids]
+    edits = [EditRecord(object_id, cell_of(journal.records[object_id][1]), journal.records[object_id], None) for object_id in selection.ids]
+    start_region_job(selection_job(items, edits))
+    print(f'Deleting {len(items)} object(s)')
+    clear_selection()
+
+# Functions to get the saved record of a placed object or virtual block, or of
+# the newest object in a cell
+def record_of(item):
+    if isinstance(item, VirtualBlock):
+        return journal.records[item.object_id]
+    return object_record(item)
+
+def record_at(cell):
+    item = occupancy.get(cell)
+    return record_of(item) if item is not None else None
+
+# Function to get the cell under the mouse: the block that was hit, else the ground
+def cursor_cell():
+    origin, direction = mouse_ray()
+    hit = occupancy.raycast(origin, direction)
+    return hit.cell if hit else occupancy.placement_cell(origin, direction)
+
+def set_region_corner(index):
+    cell = cursor_cell()
+    if cell is None:
+        return
+    region_corners[index] = cell
+    first, second = region_corners
+    region = Region(first or cell, second or cell)
+
+    # Outline around the outer faces of the region's blocks
+    low, high = region.low, region.high
+    region_marker.position = ((low[0] + high[0]) / 2, BASE_Y + (low[1] + high[1]) / 2 * LAYER_HEIGHT, (low[2] + high[2]) / 2)
+    region_marker.scale = (high[0] - low[0] + 2.04, (high[1] - low[1]) * LAYER_HEIGHT + 2.04, high[2] - low[2] + 2.04)
+    region_marker.enabled = True
+
+def selected_region():
+    if None in region_corners:
+        print('Set both region corners first (Shift+1 and Shift+2)')
+        return None
+    return Region(*region_corners)
+
+# Region operations are generators, each step handles a batch of cells and
+# applies its edits with one apply_records call. The edits of an operation are
+# pushed as one undo command when it finishes.
+def fill_region(region, obj_type):
+    edits = []
+    pending = []
+    for i, cell in enumerate(region.cells()):
+        if not occupancy.overlaps(cell):
+            record = (obj_type, Vec3(*position_of(cell)), Vec3(0, 0, 0), color.white, None, False, False)
+            object_id = journal.allocate_id()
+            pending.append((object_id, record))
+            edits.append(EditRecord(object_id, cell, None, record))
+        if i % region_batch == 0:
+            apply_records(pending)
+            pending.clear()
+            yield
+    apply_records(pending)
+    history.push(edits)
+    print(f'Filled {len(edits)} cell(s) with {obj_type}')
+
+def hollow_region(region):
+    edits = []
+    pending = []
+    for i, cell in enumerate(region.occupied(occupancy.cells)):
+        if cell is not None and region.is_interior(cell):
+            for item in occupancy.items_in(cell):
+                edits.append(EditRecord(item.object_id, cell, record_of(item), None))
+                pending.append((item.object_id, None))
+        if i % region_batch == 0:
+            apply_records(pending)
+            pending.clear()
+            yield
+    apply_records(pending)
+    history.push(edits)
+    print(f'Hollowed out {len(edits)} object(s)')
+
+def replace_region(region, from_type, to_type):
+    edits = []
+    pending = []
+    for i, cell in enumerate(region.occupied(occupancy.cells)):
+        for item in occupancy.items_in(cell) if cell is not None else ():
+            record = record_of(item)
+            if record[0] == from_type:
+                new_record = (to_type,) + tuple(record[1:])
+                pending.append((item.object_id, new_record))
+                edits.append(EditRecord(item.object_id, cell, record, new_record))
+        if i % region_batch == 0:
+            apply_records(pending)
+            pending.clear()
+            yield
+    apply_records(pending)
+    history.push(edits)
+    print(f'Replaced {len(edits)} {from_type} with {to_type}')
+
+def copy_region_job(region):
+    global clipboard_origin
+    copied = []
+    steps = copy_region(region, occupancy, record_of)
+    for i, pair in enumerate(steps):
+        if pair is not None:
+            copied.append(pair)
+        if i % region_batch == 0:
+            yield
+    # The clipboard only changes once the copy is whole, a paste meanwhile uses the old one
+    clipboard[:] = copied
+    clipboard_origin = region.low
+    print(f'Copied {len(clipboard)} object(s)')
+
+def paste_region(target):
+    # Records keep their position inside the region, only shifted to the target
+    delta = [target[i] - clipboard_origin[i] for i in range(3)]
+    shift = Vec3(delta[0], delta[1] * LAYER_HEIGHT, delta[2])
+    edits = []
+    pending = []
+    pasted = set()  # Copied objects may overlap each other, only what was there before blocks a paste
+    for i, (offset, record) in enumerate(clipboard):
+        cell = offset_cell(target, offset)
+        if not occupancy.overlaps(cell, pasted):
+            pasted.add(cell)
+            new_record = (record[0], Vec3(*record[1]) + shift) + tuple(record[2:])
+            object_id = journal.allocate_id()
+            pending.append((object_id, new_record))
+            edits.append(EditRecord(object_id, cell, None, new_record))
+        if i % region_batch == 0:
+            apply_records(pending)
+            pending.clear()
+            yield
+    apply_records(pending)
+    history.push(edits)
+    print(f'Pasted {len(edits)} object(s)')
+
+def start_region_job(job):
+    history.seal()
+    region_jobs.append(job)
+
+# Function to advance the running region operations within the frame budget
+def run_region_jobs():
+    deadline = time.perf_counter() + region_budget
+    while region_jobs and time.perf_counter() < deadline:
+        try:
+            next(region_jobs[0])
+        except StopIteration:
+            region_jobs.popleft()
+            history.seal()
+
 # Save function
 def save_map():
-    with open('map.dbo', 'wb') as file:
-        data = []
+    global objects_by_id
+    if region_jobs:
+        print("Wait for the region operation to finish before saving")
+        return
+    # Edits are already journaled, this only flushes them (or compacts the journal into map.dbo)
+    remap = journal.save()
+    if remap is not None:
         for obj in placed_objects:
-
-            
-            if isinstance(obj, FlameParticleSystem):
-                obj_type = 'flameparticlesystem'
-            else:
-                obj_type = None
-                for key, (model, texture) in models_data.items():
-                    if obj.model.name == model:
-                        obj_type = key
-                        break
-
-                if obj_type is None:
-                    print(f"Warning: Could not find obj_type for {obj}. Skipping.")
-                    continue
-
-            # Add sound settings to the saved data
-            sound_file = getattr(obj, 'sound_file', None)
-            play_on_awake = getattr(obj, 'play_on_awake', False)
-            loop = getattr(obj, 'loop', False)
-
-            print(f"Saving sound: {sound_file}, Play on Awake: {play_on_awake}, Loop: {loop}")
-
-            # Save object data with sound attributes
-            data.append((obj_type, obj.position, obj.rotation, obj.color, sound_file, play_on_awake, loop))
-        pickle.dump(data, file)
+            obj.object_id = remap[obj.object_id]
+        objects_by_id = {obj.object_id: obj for obj in placed_objects}
+        clear_selection()
+        blocks = list(virtual_blocks.values())
+        virtual_blocks.clear()
+        for block in blocks:
+            block.object_id = remap[block.object_id]
+            virtual_blocks[block.object_id] = block
+        history.remap_ids(remap, journal.allocate_id)
     print("Map saved!")
 
 
+# Bake function, saves and then rebakes the package the game loads. It isn't part of
+# saving because a bake still visits every record; the game rebakes a stale package itself
+def bake_map_package():
+    global baked_map
+    if region_jobs:
+        print("Wait for the region operation to finish before baking")
+        return
+    save_map()
+    # Only the chunks edited since the last bake are meshed again
+    if baked_map is None:
+        baked_map = read_baked(baked_path('map.dbo'))
+    baked_map = bake_records('map.dbo', journal.records, registry.models(), baked_map)
+
+
+
+# Load function, recover=True loads the newest autosave instead of map.dbo
+def load_map(recover=False):
+    global placed_objects, journal
 
-# Load function
-def load_map():
-    global placed_objects
+    # Look for the autosave before tearing anything down, without one the scene stays as it is
+    if recover:
+        # Empty snapshots are skipped, they'd hide the one that still has the work
+        path = latest_autosave(skip_empty=True)
+        if path is None:
+            print("No autosave to recover")
+            return
 
+    destroy_property_ui()
+    destroy_sound_window()
     for obj in placed_objects:
+        culling.remove(obj)
+        shadows.remove_caster(obj)
+        registry.forget(obj)
         destroy(obj)
     placed_objects.clear()
+    objects_by_id.clear()
+    virtual_blocks.clear()
+    region_jobs.clear()
+    clear_selection()
+    occupancy.clear()
+    chunk_mesher.clear()
+    history.clear()
+
+    journal.close()
+    if recover:
+        # Recovered work isn't in map.dbo yet, the next save writes it out in full
+        journal = EditJournal('map.dbo', dict(enumerate(load_autosave(path))))
+    else:
+        journal = EditJournal.load('map.dbo')
+    autosave.mark_saved((id(journal), journal.revision))
+    data = journal.records
 
-    with open('map.dbo', 'rb') as file:
-        data = pickle.load(file)
-
-        for obj_type, position, rotation, color_data, sound_file, play_on_awake, loop in data:
-            if obj_type == 'flameparticlesystem':
-                placed_object = FlameParticleSystem(
-                    position=position,
-                    rotation=rotation,
-                    color=color_data
-                )
-            elif obj_type in models_data:
-                model, texture = models_data[obj_type]
-                placed_object = Entity(
-                    model=model,
-                    texture=texture,
-                    position=position,
-                    rotation=rotation,
-                    scale=1,
-                    collider='box',
-                    color=color_data
-                )
-            else:
-                print(f"Warning: Unknown object type '{obj_type}'. Using default model and texture.")
-                placed_object = Entity(
-                    model='cube',
-                    texture='white_cube',
-                    position=position,
-                    rotation=rotation,
-                    scale=1,
-                    collider='box',
-                    color=color_data
-                )
-
-            # Attach sound settings
-            placed_object.sound_file = sound_file
-            placed_object.play_on_awake = play_on_awake
-            placed_object.loop = loop
-
-            if sound_file:
-                placed_object.audio = Audio(sound_file, autoplay=play_on_awake, loop=loop)
-
-            placed_objects.append(placed_object)
+    for i, (object_id, record) in enumerate(data.items()):
+        spawn_placed_object(object_id, record)
+
+        if i % 64 == 0:
+            telemetry.publish(placed_objects=len(placed_objects), map_load_progress=i / len(data))
+    rebuild_chunks()
+    telemetry.publish(placed_objects=len(placed_objects) + len(virtual_blocks), map_load_progress=1.0)
     print("Map loaded!")
 
 
@@ -273,26 +922,91 @@ load_button = Button(
     on_click=load_map
 )
 
-# Generate fewer clouds, but spread across a larger area
+recover_button = Button(
+    text='Recover',
+    color=color.gray,
+    scale=(0.1, 0.05),
+    position=(0.35, 0.45),  # Next to the load button
+    parent=camera.ui,
+    on_click=lambda: load_map(recover=True)
+)
+
+bake_button = Button(
+    text='Bake',
+    color=color.gray,
+    scale=(0.1, 0.05),
+    position=(0.55, 0.45),  # Next to the recover button
+    parent=camera.ui,
+    on_click=bake_map_package
+)
+
+# Function to give an entity one child per level of detail, only the most detailed is shown
+def add_lod_levels(entity, lods):
+    entity.lod_nodes = [
+        Entity(parent=entity, model=Mesh(vertices=data.vertices, triangles=data.triangles, uvs=data.uvs, normals=data.normals))
+        for data in lods
+    ]
+    for node in entity.lod_nodes[1:]:
+        node.hide()
+    entity.lod_level = 0
+    entity.lod_radius = bounding_radius(lods[0]) * max(entity.scale)
+
+# Function to switch entities to the level of detail that fits their size on screen
+def update_lods(entities):
+    for entity in entities:
+        if getattr(entity, 'culled', False):
+            continue
+        size = projected_size(entity.lod_radius, distance(entity.world_position, camera.world_position), camera.fov)
+        level = select_level(entity.lod_level, size)
+        if level != entity.lod_level:
+            entity.lod_nodes[entity.lod_level].hide()
+            entity.lod_nodes[level].show()
+            entity.lod_level = level
+
+# Generate fewer clouds, but spread across a larger area. They're only scenery,
+# so they're made a few per frame after the first frame instead of at startup
 cloud_model = 'cloud.obj'
-for _ in range(40):  # Adjust the number of clouds (less mass)
-    cloud = Entity(
-        model=cloud_model,
-        scale=random.uniform(2, 5),  # Reduced mass by decreasing cloud scale
-        y=random.uniform(95, 120),  # Random height for sky clouds
-        x=random.uniform(-350, 350),  # Larger horizontal range for wider spread
-        z=random.uniform(-350, 350),  # Larger depth range to cover a larger sky
-        rotation_y=random.uniform(0, 360),  # Random rotation for cloud orientation
-        color=color.white,  # White material since it's textureless
-    )
+cloud_objects = []
+def create_clouds(count=40):  # Adjust the number of clouds (less mass)
+    cloud_lods = load_lods(cloud_model)  # Simplified copies are cached in lod_cache/
+    yield
+    for _ in range(count):
+        cloud = Entity(
+            scale=random.uniform(2, 5),  # Reduced mass by decreasing cloud scale
+            y=random.uniform(95, 120),  # Random height for sky clouds
+            x=random.uniform(-350, 350),  # Larger horizontal range for wider spread
+            z=random.uniform(-350, 350),  # Larger depth range to cover a larger sky
+            rotation_y=random.uniform(0, 360),  # Random rotation for cloud orientation
+            color=color.white,  # White material since it's textureless
+        )
+        add_lod_levels(cloud, cloud_lods)
+        cloud_objects.append(cloud)
+        culling.add(cloud, 'cloud')
+        shadows.add_caster(cloud, cloud.lod_radius)
+        yield
+
+startup.defer('clouds', create_clouds())
+
+shadow_revision = None  # Journal revision the static shadow cascade was drawn for
+
+# Visible/total counts of the culled categories, toggled with F3
+culling_text = Text(parent=camera.ui, position=(-0.6, 0.47), scale=0.8, enabled=False)
 
-# Define the UI panel and fields for editing object properties
+# Define the UI panel and fields for editing object properties.
+# The panels and gizmos are built the first time an object is selected and
+# then stay alive; selecting another object only rebinds them to it and
+# refreshes the field values.
 property_ui = None
 name_field = None
 position_fields = None
 rotation_fields = None
+y_rotation_slider = None
 selected_entity = None  # Keep track of the currently selected entity for editing
 material_ui = None  # To keep track of the material UI window
+r_slider = None
+g_slider = None
+b_slider = None
+a_slider = None
 gizmo_x = None
 gizmo_y = None
 gizmo_z = None
@@ -300,48 +1014,51 @@ is_dragging = False
 current_axis = None
 drag_start_position = None
 sound_window = None
+play_on_awake_button = None
+loop_button = None
+sound_file_input = None
+binding_panels = False  # Set while fields are refreshed so their callbacks don't record edits
 
 
 
 def destroy_property_ui():
-    """Function to destroy the current property UI if it exists."""
-    global property_ui
+    """Function to hide the property UI and release its target."""
+    global selected_entity
     if property_ui:
-        destroy(property_ui)
-        property_ui = None
+        property_ui.enabled = False
     setup_gizmos_for_selected_object(None)
     destroy_material_ui()
+    selected_entity = None
 
-def setup_gizmos_for_selected_object(selected_object):
+def build_gizmos():
     global gizmo_x, gizmo_y, gizmo_z
 
-    # Destroy previous gizmos if they exist
-    if gizmo_x:
-        destroy(gizmo_x)
-    if gizmo_y:
-        destroy(gizmo_y)
-    if gizmo_z:
-        destroy(gizmo_z)
-
-    if selected_object and property_ui:
-        # Create the gizmos for each axis
-        gizmo_x = Entity(model='gizmos.obj', color=color.red, scale=0.5, collider='gizmos.obj', parent=selected_object, rotation=Vec3(0, 0, -90))  # X-axis
-        gizmo_y = Entity(model='gizmos.obj', color=color.green, scale=0.5, collider='gizmos.obj', parent=selected_object)  # Y-axis
-        gizmo_z = Entity(model='gizmos.obj', color=color.blue, scale=0.5, collider='gizmos.obj', parent=selected_object, rotation=Vec3(90, 0, 0))  # Z-axis
-
-        # Update gizmo click handling to use raycasting
-        gizmo_x.on_mouse_drag = lambda: move_gizmo(gizmo_x, 'x')
-        gizmo_y.on_mouse_drag = lambda: move_gizmo(gizmo_y, 'y')
-        gizmo_z.on_mouse_drag = lambda: move_gizmo(gizmo_z, 'z')
+    # Create the gizmos for each axis
+    gizmo_x = Entity(model='gizmos.obj', color=color.red, scale=0.5, collider='gizmos.obj', rotation=Vec3(0, 0, -90), enabled=False)  # X-axis
+    gizmo_y = Entity(model='gizmos.obj', color=color.green, scale=0.5, collider='gizmos.obj', enabled=False)  # Y-axis
+    gizmo_z = Entity(model='gizmos.obj', color=color.blue, scale=0.5, collider='gizmos.obj', rotation=Vec3(90, 0, 0), enabled=False)  # Z-axis
+
+    # Update gizmo click handling to use raycasting
+    gizmo_x.on_mouse_drag = lambda: move_gizmo(gizmo_x, 'x')
+    gizmo_y.on_mouse_drag = lambda: move_gizmo(gizmo_y, 'y')
+    gizmo_z.on_mouse_drag = lambda: move_gizmo(gizmo_z, 'z')
+
+def setup_gizmos_for_selected_object(selected_object):
+    global is_dragging, current_axis, drag_start_position
+
+    if selected_object and property_ui and property_ui.enabled:
+        # Move the gizmos over to the selected object
+        for gizmo in (gizmo_x, gizmo_y, gizmo_z):
+            gizmo.parent = selected_object
+            gizmo.position = Vec3(0, 0, 0)
+            gizmo.enabled = True
 
     else:
-        # Deactivate gizmos if no object is selected
-        if gizmo_x:
-            destroy(gizmo_x)
-        if gizmo_y:
-            destroy(gizmo_y)
-        if gizmo_z:
-            destroy(gizmo_z)
+        # Park the gizmos in the scene so they aren't destroyed with their object
+        for gizmo in (gizmo_x, gizmo_y, gizmo_z):
+            if gizmo:
+                gizmo.parent = scene
+                gizmo.enabled = False
         is_dragging = False
         current_axis = None
         drag_start_position = None
@@ -359,31 +1076,30 @@ def move_gizmo(axis):
     mouse_world_position = mouse.world_point
     if mouse_world_position:
         movement = mouse_world_position
+        before = object_record(selected_entity)
         if axis == 'x':
             selected_entity.x -= 0.25
         elif axis == 'y':
             selected_entity.y += 0.25
         elif axis == 'z':
             selected_entity.z += 0.25
+        relocate(selected_entity)
+        journal_transform(selected_entity)
+        record_edit(selected_entity, before, merge_key=('move', selected_entity.object_id))
 
 
 
-def create_property_ui(entity):
-    """Function to create a property UI for the given entity."""
-    global property_ui, name_field, position_fields, rotation_fields, y_rotation_slider, selected_entity
-
-    # Destroy the previous UI if it exists
-    destroy_property_ui()
-
-    selected_entity = entity
+def build_property_ui():
+    """Function to build the property UI once, hidden until an object is selected."""
+    global property_ui, name_field, position_fields, rotation_fields, y_rotation_slider
 
     # Create a transparent UI background
-    property_ui = Entity(parent=camera.ui, model='quad', scale=(0.4, 0.6), position=(0.7, 0), color=color.gray)
+    property_ui = Entity(parent=camera.ui, model='quad', scale=(0.4, 0.6), position=(0.7, 0), color=color.gray, enabled=False)
 
     image_entity11 = Entity(parent=property_ui, model='quad', texture='properties.png', scale=(1, 0.06), position=(0, 0.5), z=-0.2)
 
     # Display the object's name
-    name_field = Text(f'Object Name: {entity.model.name}' if not isinstance(entity, FlameParticleSystem) else 'Object Name: Flame', parent=property_ui, position=(-0.1, 0.35), scale=2, origin=(0, 0), z=-0.1)
+    name_field = Text('Object Name:', parent=property_ui, position=(-0.1, 0.35), scale=2, origin=(0, 0), z=-0.1)
 
     # Rotation fields
     Text('Rotation:', parent=property_ui, position=(-0.35, 0.25), scale=1, origin=(0, 0), z=-0.1)
@@ -392,9 +1108,9 @@ def create_property_ui(entity):
     Text('Z:', parent=property_ui, position=(-0.35, 0.1), scale=1, origin=(0, 0), z=-0.1)
 
     rotation_fields = [
-        InputField(default_value=str(entity.rotation.x), parent=property_ui, position=(-0.15, 0.2), scale=(0.2, 0.1), submit=update_property_values, z=-0.1),
-        InputField(default_value=str(entity.rotation.y), parent=property_ui, position=(-0.15, 0.15), scale=(0.2, 0.1), submit=update_property_values, z=-0.1),
-        InputField(default_value=str(entity.rotation.z), parent=property_ui, position=(-0.15, 0.1), scale=(0.2, 0.1), submit=update_property_values, z=-0.1)
+        InputField(parent=property_ui, position=(-0.15, 0.2), scale=(0.2, 0.1), submit=update_property_values, z=-0.1),
+        InputField(parent=property_ui, position=(-0.15, 0.15), scale=(0.2, 0.1), submit=update_property_values, z=-0.1),
+        InputField(parent=property_ui, position=(-0.15, 0.1), scale=(0.2, 0.1), submit=update_property_values, z=-0.1)
     ]
 
     # Position fields
@@ -404,47 +1120,64 @@ def create_property_ui(entity):
     Text('Z:', parent=property_ui, position=(-0.35, -0.20), scale=1, origin=(0, 0), z=-0.1)
 
     position_fields = [
-        InputField(default_value=str(entity.position.x), parent=property_ui, position=(-0.15, -0.1), scale=(0.2, 0.1), submit=update_property_values, z=-0.1),
-        InputField(default_value=str(entity.position.y), parent=property_ui, position=(-0.15, -0.15), scale=(0.2, 0.1), submit=update_property_values, z=-0.1),
-        InputField(default_value=str(entity.position.z), parent=property_ui, position=(-0.15, -0.20), scale=(0.2, 0.1), submit=update_property_values, z=-0.1)
+        InputField(parent=property_ui, position=(-0.15, -0.1), scale=(0.2, 0.1), submit=update_property_values, z=-0.1),
+        InputField(parent=property_ui, position=(-0.15, -0.15), scale=(0.2, 0.1), submit=update_property_values, z=-0.1),
+        InputField(parent=property_ui, position=(-0.15, -0.20), scale=(0.2, 0.1), submit=update_property_values, z=-0.1)
     ]
 
     # Y Rotation Slider
     Text('Y Rotation:', parent=property_ui, position=(-0.35, -0.30), scale=1, origin=(0, 0), z=-0.1)
-    y_rotation_slider = Slider(min=0, max=360, default=entity.rotation.y, parent=property_ui, position=(-0.15, -0.30), scale=(0.8, 0.4), step=10, dynamic=True, z=-0.1)
-    y_rotation_slider.on_value_changed = lambda: update_y_rotation(entity)
+    y_rotation_slider = Slider(min=0, max=360, default=0, parent=property_ui, position=(-0.15, -0.30), scale=(0.8, 0.4), step=10, dynamic=True, z=-0.1)
+    y_rotation_slider.on_value_changed = lambda: update_y_rotation(selected_entity)
 
     # Delete button
-    Button(text='Delete', color=color.red, scale=(0.2, 0.08), position=(-0.15, -0.40), parent=property_ui, on_click=lambda: delete_selected_entity(entity), z=-0.1)
+    Button(text='Delete', color=color.red, scale=(0.2, 0.08), position=(-0.15, -0.40), parent=property_ui, on_click=lambda: delete_selected_entity(selected_entity), z=-0.1)
+
+def create_property_ui(entity):
+    """Function to show the property UI for the given entity."""
+    global selected_entity, binding_panels
+
+    if property_ui is None:
+        build_gizmos()
+        build_property_ui()
+    selected_entity = entity
+    binding_panels = True
+    name_field.text = f'Object Name: {entity.model.name}' if not isinstance(entity, FlameParticleSystem) else 'Object Name: Flame'
+    for field, value in zip(rotation_fields, entity.rotation):
+        field.text = str(value)
+    for field, value in zip(position_fields, entity.position):
+        field.text = str(value)
+    y_rotation_slider.value = entity.rotation.y
+    binding_panels = False
+
+    property_ui.enabled = True
     setup_gizmos_for_selected_object(selected_entity)
 
 def update_y_rotation(entity):
     """Update the Y rotation of the selected entity based on the slider value."""
     global selected_entity
 
-    if selected_entity:
+    if selected_entity and not binding_panels:
         # Update the rotation of the entity
+        before = object_record(selected_entity)
         selected_entity.rotation_y = y_rotation_slider.value
+        refresh_block(selected_entity)
+        journal_transform(selected_entity)
+        record_edit(selected_entity, before, merge_key=('rotate', selected_entity.object_id))
 
         # Update the position fields to reflect the new values
         rotation_fields[1].text = str(selected_entity.rotation_y)
         print(f'Updated Y rotation to: {selected_entity.rotation_y}')
 
 def destroy_material_ui():
-    """Destroy the current material UI if it exists."""
-    global material_ui
+    """Hide the material UI if it's showing."""
     if material_ui:
-        destroy(material_ui)
-        material_ui = None
+        material_ui.enabled = False
 
-def create_material_ui(entity):
-    global material_ui, r_slider, g_slider, b_slider, a_slider, selected_entity
+def build_material_ui():
+    global material_ui, r_slider, g_slider, b_slider, a_slider
 
-    destroy_material_ui()
-
-    selected_entity = entity
-
-    material_ui = Entity(parent=camera.ui, model='quad', scale=(0.3, 0.25), position=(0.75, -0.4), color=color.gray)
+    material_ui = Entity(parent=camera.ui, model='quad', scale=(0.3, 0.25), position=(0.75, -0.4), color=color.gray, enabled=False)
 
     image_entity = Entity(parent=material_ui, model='quad', texture='material.png', scale=(1.4, 0.14), position=(0.2, 0.38), z=-0.1)
 
@@ -453,47 +1186,57 @@ def create_material_ui(entity):
     Text('B:', parent=material_ui, position=(-0.4, -0.1), scale=3, z=-0.1)
     Text('A:', parent=material_ui, position=(-0.4, -0.2), scale=3, z=-0.1)
 
-    if isinstance(selected_entity, FlameParticleSystem):
-        r_slider = Slider(min=0, max=255, default=selected_entity.color.r*255, parent=material_ui, position=(-0.2, 0.1), step=1, dynamic=True, z=-0.1)
-        g_slider = Slider(min=0, max=255, default=selected_entity.color.g*255, parent=material_ui, position=(-0.2, 0), step=1, dynamic=True, z=-0.1)
-        b_slider = Slider(min=0, max=255, default=selected_entity.color.b*255, parent=material_ui, position=(-0.2, -0.1), step=1, dynamic=True, z=-0.1)
-        a_slider = Slider(min=0, max=255, default=selected_entity.color.a*255, parent=material_ui, position=(-0.2, -0.2), step=1, dynamic=True, z=-0.1)
+    r_slider = Slider(min=0, max=255, default=255, parent=material_ui, position=(-0.2, 0.1), step=1, dynamic=True, z=-0.1)
+    g_slider = Slider(min=0, max=255, default=255, parent=material_ui, position=(-0.2, 0), step=1, dynamic=True, z=-0.1)
+    b_slider = Slider(min=0, max=255, default=255, parent=material_ui, position=(-0.2, -0.1), step=1, dynamic=True, z=-0.1)
+    a_slider = Slider(min=0, max=255, default=255, parent=material_ui, position=(-0.2, -0.2), step=1, dynamic=True, z=-0.1)
 
-        r_slider.on_value_changed = update_material_values
-        g_slider.on_value_changed = update_material_values
-        b_slider.on_value_changed = update_material_values
-        a_slider.on_value_changed = update_material_values
-    else:
-        r_slider = Slider(min=0, max=255, default=selected_entity.color.r*255, parent=material_ui, position=(-0.2, 0.1), step=1, dynamic=True, z=-0.1)
-        g_slider = Slider(min=0, max=255, default=selected_entity.color.g*255, parent=material_ui, position=(-0.2, 0), step=1, dynamic=True, z=-0.1)
-        b_slider = Slider(min=0, max=255, default=selected_entity.color.b*255, parent=material_ui, position=(-0.2, -0.1), step=1, dynamic=True, z=-0.1)
-        a_slider = Slider(min=0, max=255, default=selected_entity.color.a*255, parent=material_ui, position=(-0.2, -0.2), step=1, dynamic=True, z=-0.1)
+    r_slider.on_value_changed = update_material_values
+    g_slider.on_value_changed = update_material_values
+    b_slider.on_value_changed = update_material_values
+    a_slider.on_value_changed = update_material_values
 
-        r_slider.on_value_changed = update_material_values
-        g_slider.on_value_changed = update_material_values
-        b_slider.on_value_changed = update_material_values
-        a_slider.on_value_changed = update_material_values
+def create_material_ui(entity):
+    """Show the material UI with the colour of the given entity, or of the first selected object if entity is None."""
+    global binding_panels
+
+    if material_ui is None:
+        build_material_ui()
+    color_value = entity.color if entity else journal.records[selection.ids[0]][3]
+    binding_panels = True
+    r_slider.value = color_value[0] * 255
+    g_slider.value = color_value[1] * 255
+    b_slider.value = color_value[2] * 255
+    a_slider.value = color_value[3] * 255
+    # Recolouring a selection is a batch edit, only apply it when the knob is released
+    for slider in (r_slider, g_slider, b_slider, a_slider):
+        slider.dynamic = entity is not None
+    binding_panels = False
+    material_ui.enabled = True
 
 
 def update_material_values():
     """Update the RGB values of the selected entity in real-time."""
     global selected_entity
 
+    if binding_panels:
+        return
     if selected_entity:
-        r = r_slider.value / 255
-        g = g_slider.value / 255
-        b = b_slider.value / 255
-        a = a_slider.value / 255
-
+        before = object_record(selected_entity)
         selected_entity.color = color.rgba(r_slider.value, g_slider.value, b_slider.value, a_slider.value)
-        print(f'Updated material: R={r}, G={g}, B={b}, A={a}')
+        refresh_block(selected_entity)
+        journal.recolor(selected_entity.object_id, selected_entity.color)
+        record_edit(selected_entity, before, merge_key=('color', selected_entity.object_id))
+    elif len(selection):
+        recolor_selection(color.rgba(r_slider.value, g_slider.value, b_slider.value, a_slider.value))
 
 
 def update_property_values():
     """Update the properties of the selected entity based on the input fields."""
     global selected_entity
 
-    if selected_entity:
+    if selected_entity and not binding_panels:
+        before = object_record(selected_entity)
         # Update rotation values
         selected_entity.rotation = Vec3(
             float(rotation_fields[0].text),
@@ -506,13 +1249,15 @@ def update_property_values():
             float(position_fields[1].text),
             float(position_fields[2].text)
         )
+        relocate(selected_entity)
+        journal_transform(selected_entity)
+        record_edit(selected_entity, before)
 
-def create_sound_window(entity):
-    global sound_window
+def build_sound_window():
+    """Function to build the sound options window once, for attaching and playing sound on objects."""
+    global sound_window, play_on_awake_button, loop_button, sound_file_input
 
-    destroy_sound_window()
-    """Function to create a sound options window for attaching and playing sound on objects."""
-    sound_window = Entity(parent=camera.ui, model='quad', scale=(0.3, 0.2), position=(0.7, 0.383), color=color.gray, z=-0.1)
+    sound_window = Entity(parent=camera.ui, model='quad', scale=(0.3, 0.2), position=(0.7, 0.383), color=color.gray, z=-0.1, enabled=False)
 
     image_entity = Entity(parent=sound_window, model='quad', texture='volume.png', scale=(1, 0.18), position=(0, 0.44), z=-0.1)
 
@@ -520,20 +1265,26 @@ def create_sound_window(entity):
 
     # Function to toggle and print button state (works for both buttons)
     def toggle_button(button, attribute_name):
+        entity = selected_entity
+        if not entity:
+            return
         # Toggle the entity attribute and button text
         current_value = getattr(entity, attribute_name, False)
         new_value = not current_value
+        before = object_record(entity)
         setattr(entity, attribute_name, new_value)
+        journal_sound(entity)
+        record_edit(entity, before)
         button.text = f"{attribute_name.replace('_', ' ').title()}: {new_value}"
         print(f"{button.text}: {new_value}")  # Print the current state
 
     # Button for 'Play on Awake'
-    play_on_awake_button = Button(text=f"Play on Awake: {entity.play_on_awake if hasattr(entity, 'play_on_awake') else False}", parent=sound_window,
+    play_on_awake_button = Button(text="Play on Awake: False", parent=sound_window,
                                   position=(-0.25, 0.25), scale=(0.48, 0.1), color=color.dark_gray, z=-0.1)
     play_on_awake_button.text_entity.scale *= 0.6
 
     # Button for 'Loop'
-    loop_button = Button(text=f"Loop: {entity.loop if hasattr(entity, 'loop') else False}", parent=sound_window,
+    loop_button = Button(text="Loop: False", parent=sound_window,
                          position=(0.3, 0.25), scale=(0.3, 0.1), color=color.dark_gray, z=-0.1)
     loop_button.text_entity.scale *= 0.6
 
@@ -546,16 +1297,22 @@ def create_sound_window(entity):
 
     # Input field for sound file name with consistent style
     sound_file_input = InputField(parent=sound_window, position=(0.08, -0.19), scale=(0.7, 0.14), color=color.black,
-                                  default_value=entity.sound_file if hasattr(entity, 'sound_file') else "test.mp3", z=-0.1)
+                                  default_value="test.mp3", z=-0.1)
 
     # Add border and shadow to the input field
     sound_file_input.bg = Entity(parent=sound_file_input, model='quad', scale=sound_file_input.scale * 1.02, color=color.black33, z=0.01)
 
     # Function to handle attaching the sound to the object
     def attach_sound_to_object():
+        entity = selected_entity
+        if not entity:
+            return
+        before = object_record(entity)
         entity.sound_file = sound_file_input.text
         entity.play_on_awake = entity.play_on_awake if hasattr(entity, 'play_on_awake') else False
         entity.loop = entity.loop if hasattr(entity, 'loop') else False
+        journal_sound(entity)
+        record_edit(entity, before)
 
         # Attach the sound to the entity
         if entity.sound_file:
@@ -572,52 +1329,81 @@ def create_sound_window(entity):
     # Set up the button's action
     confirm_button.on_click = on_confirm
 
+def create_sound_window(entity):
+    """Show the sound options window with the settings of the given entity."""
+    if sound_window is None:
+        build_sound_window()
+    play_on_awake_button.text = f"Play on Awake: {entity.play_on_awake if hasattr(entity, 'play_on_awake') else False}"
+    loop_button.text = f"Loop: {entity.loop if hasattr(entity, 'loop') else False}"
+    sound_file_input.text = (entity.sound_file if getattr(entity, 'sound_file', None) else "test.mp3")
+    sound_window.enabled = True
     return sound_window
 
 
 
 
 def destroy_sound_window():
-    """Destroy the current material UI if it exists."""
-    global sound_window
+    """Hide the sound options window if it's showing."""
     if sound_window:
-        destroy(sound_window)
-        sound_window = None
+        sound_window.enabled = False
+
 
 def delete_selected_entity(entity):
     """Function to delete the selected entity using its name."""
-    global placed_objects
-    placed_objects = [obj for obj in placed_objects if obj != entity]
-    destroy(entity)
+    history.push([EditRecord(entity.object_id, occupancy.cell_of_item(entity), object_record(entity), None)])
+    journal.delete(entity.object_id)
+    name = registry.type_of(entity)
+    remove_placed_object(entity)
     destroy_property_ui()
     destroy_sound_window()
-    
-    print(f"Deleted {entity.model.name}")
+
+    print(f"Deleted {name}")
 
 
 
 def update():
     global object_placed
+    global shadow_revision
     global selected_object
     global is_dragging
     global current_axis
 
+    # Times the first frames, then builds what was left out of startup a little per frame
+    startup.frame()
+
+    # Alt + drag selects instead of placing
+    update_selection_drag()
 
     # Prevent placing multiple objects when holding the mouse button
-    if mouse.left and not object_placed:
+    if mouse.left and not object_placed and selection_drag is None:
         place_object()
 
     if not mouse.left:
         object_placed = False  # Reset the flag when the mouse is released
+        history.seal()  # A drag or slider sweep ends with the mouse button
+
+    update_placement_marker()
+
+    # Region operations run a slice per frame, the chunks are rebuilt once they're done
+    run_region_jobs()
+    if not region_jobs:
+        if pending_selection_color is not None and len(selection):
+            recolor_selection(pending_selection_color)
+        rebuild_chunks()
+
+    # Cheap snapshot here, the autosave worker thread does the writing
+    autosave.tick(lambda: list(journal.records.values()), (id(journal), journal.revision))
 
     # Right-click detection for showing/hiding the properties and material UI
     if mouse.right:
-        hit_info = mouse.hovered_entity
-        if hit_info in placed_objects:
+        hit_info = pick_placed_object()
+        # Only rebind the panels when the selection changes, not every frame the button is held
+        if hit_info and (hit_info is not selected_entity or not property_ui.enabled):
+            clear_selection()
             create_property_ui(hit_info)
             create_material_ui(hit_info)  # Show the RGB control window
             create_sound_window(hit_info)
-        elif hit_info == train:
+        elif not hit_info and mouse.hovered_entity == train:
             destroy_property_ui()
             destroy_material_ui()
             destroy_sound_window()
@@ -648,5 +1434,79 @@ def update():
     if not held_keys['left mouse']:
         is_dragging = False
 
+    # Hide what the camera can't see before the frame is drawn
+    culling.update(camera.world_position, view_projection_matrix())
+    update_lods(cloud_objects)
+
+    # Any edit can move a static caster, the static cascade is redrawn once per change
+    if (id(journal), journal.revision) != shadow_revision:
+        shadow_revision = (id(journal), journal.revision)
+        shadows.mark_static_dirty()
+    shadows.update(base.cam)
+    if culling_text.enabled:
+        culling_text.text = culling.summary()
+
+    # Publish this frame's counters to monitor.py
+    telemetry.publish(
+        frame_time=time.dt,
+        entities=len(scene.entities),
+        placed_objects=len(placed_objects) + len(virtual_blocks),
+        particles=FlameParticleSystem.live_particles
+    )
+
 
+# Keyboard shortcuts for the multi-selection: arrows and page up/down move it,
+# comma and period turn it, delete removes it, escape drops it
+selection_keys = {
+    'left arrow': lambda: move_selection(-2, 0, 0),
+    'right arrow': lambda: move_selection(2, 0, 0),
+    'up arrow': lambda: move_selection(0, 0, 2),
+    'down arrow': lambda: move_selection(0, 0, -2),
+    'page up': lambda: move_selection(0, LAYER_HEIGHT, 0),
+    'page down': lambda: move_selection(0, -LAYER_HEIGHT, 0),
+    ',': lambda: rotate_selection(-90),
+    '.': lambda: rotate_selection(90),
+    'delete': delete_selection,
+    'escape': clear_selection,
+}
+
+# Keyboard shortcuts for undo/redo, the selection and the region tools
+def input(key):
+    if key in selection_keys and len(selection) and not region_jobs:
+        selection_keys[key]()
+        return
+    if key == 'f3':
+        culling_text.enabled = not culling_text.enabled
+
+    if held_keys['control'] and key in ('z', 'y') and region_jobs:
+        print("Wait for the region operation to finish before undoing")
+    elif held_keys['control'] and key == 'z':
+        undo_edit()
+    elif held_keys['control'] and key == 'y':
+        redo_edit()
+    elif held_keys['shift'] and key in ('1', '2'):
+        set_region_corner(int(key) - 1)
+    elif held_keys['shift'] and key in ('f', 'h', 'r', 'c', 'v'):
+        if key == 'v':
+            cell = cursor_cell()
+            if clipboard and cell is not None:
+                start_region_job(paste_region(cell))
+            return
+
+        region = selected_region()
+        if region is None:
+            return
+        obj_type = 'flameparticlesystem' if selected_object == 'flame' else selected_object
+        if key == 'f' and selected_object in models_data and models_data[selected_object][0]:
+            start_region_job(fill_region(region, obj_type))
+        elif key == 'h':
+            start_region_job(hollow_region(region))
+        elif key == 'r' and selected_object and record_at(region_corners[0]):
+            # Replace the type of the block at the first corner with the selected type
+            start_region_job(replace_region(region, record_at(region_corners[0])[0], obj_type))
+        elif key == 'c':
+            start_region_job(copy_region_job(region))
+
+
+startup.mark('scene')
 app.run()
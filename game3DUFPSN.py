@@ -1,39 +1,89 @@
+# Timed first so the imports are part of the startup timeline
+from startup_timeline import StartupTimeline
+startup = StartupTimeline('game3DUFPSN')
+
 from ursina import *
 from ursina.prefabs.first_person_controller import FirstPersonController
 from ursina import Vec3
+startup.mark('import ursina')
 import random
 import math
-import pickle  # For saving and loading data
 import time
-
-app = Ursina()
+import atexit
+import argparse
+import os
+from telemetry import TelemetryWriter
+from block_mesher import is_transparent
+from map_bake import load_baked
+from static_collision import BoxSetCollider, sweep
+from culling import CullingSystem, matrix_rows, bounds_sphere, node_radius
+from mesh_lod import load_lods, bounding_radius, projected_size, select_level
+from shadow_cascades import CascadedShadows
+from fixed_timestep import FixedTimestep, begin_tick, end_tick, interpolate
+from navigation import FlowField
+from visibility import LineOfSight
+from hitscan import hitscan
+from spawn_director import SpatialHash, WaveDirector
+from texture_cache import cached_texture, set_quality, QUALITY_SCALES
+from type_registry import TypeRegistry
+from replay import (
+    SessionRecorder, TickTimer, read_header, read_ticks, map_hash, checksum, prune_recordings,
+    CHECK_INTERVAL, RECORDINGS_DIR, RECORDINGS_KEPT,
+)
+from panda3d.core import TransparencyAttrib
+startup.mark('import modules')
+
+# Command line options for recording and replaying sessions
+parser = argparse.ArgumentParser(description='First person shooter')
+parser.add_argument('--record', metavar='FILE', help='where to record the session (default recordings/session-<date>.rec)')
+parser.add_argument('--no-record', action='store_true', help="don't record the session")
+parser.add_argument('--replay', metavar='FILE', help='re-simulate a recorded session as fast as possible')
+parser.add_argument('--headless', action='store_true', help='replay offscreen and quit with the tick timings')
+parser.add_argument('--texture-quality', choices=sorted(QUALITY_SCALES), default='full', help='resolution of the world textures')
+args, _ = parser.parse_known_args()
+if args.headless and not args.replay:
+    parser.error('--headless needs --replay')
+set_quality(args.texture_quality)
+
+# Offscreen still has a graphics context for the shadow buffers, it just never opens a window
+app = Ursina(window_type='offscreen' if args.headless else 'onscreen')
+startup.mark('window')
+
+# Per-frame engine counters for monitor.py
+telemetry = TelemetryWriter()
+atexit.register(telemetry.close)
 
 # Define the 2D transparent flame texture
 flame_texture = 'flame.png'  # Make sure this image is in your assets folder
 
 class FlameParticleSystem(Entity):
+    live_particles = 0  # Particles alive across every flame, for telemetry
+
     def __init__(self, **kwargs):
         super().__init__()
         self.particles = []
         self.spawn_rate = 0.05  # Time between new particle spawns
-        self.last_spawn_time = time.time()
+        self.last_spawn_time = simulation.time
 
         for key, value in kwargs.items():
             setattr(self, key, value)
 
-    def update(self):
-        if time.time() - self.last_spawn_time > self.spawn_rate:
+    # Stepped by the fixed timestep gameplay loop instead of every frame
+    def tick(self, dt):
+        # No new particles while the flame is culled, the live ones still fade out
+        if not getattr(self, 'culled', False) and simulation.time - self.last_spawn_time > self.spawn_rate:
             self.spawn_particle()
-            self.last_spawn_time = time.time()
+            self.last_spawn_time = simulation.time
 
-        for particle in self.particles:
-            particle.position += particle.velocity * time.dt
+        for particle in self.particles[:]:
+            particle.position += particle.velocity * dt
             particle.scale *= 0.98
-            particle.alpha -= time.dt * 0.5
+            particle.alpha -= dt * 0.5
 
             if particle.alpha <= 0:
                 self.particles.remove(particle)
                 destroy(particle)
+                FlameParticleSystem.live_particles -= 1
 
     def spawn_particle(self):
         direction_to_player = (player.position - self.position).normalized()
@@ -41,7 +91,7 @@ class FlameParticleSystem(Entity):
 
         particle = Entity(
             model='quad',
-            texture=flame_texture,
+            texture=cached_texture(flame_texture),
             scale=0.2,
             position=self.position + Vec3(random.uniform(-0.1, 0.1), 0, random.uniform(-0.1, 0.1)),
             rotation=(random.uniform(-10, 10), -angle_to_player, random.uniform(-10, 10)),
@@ -50,6 +100,14 @@ class FlameParticleSystem(Entity):
         )
         particle.alpha = 1
         self.particles.append(particle)
+        FlameParticleSystem.live_particles += 1
+
+    # Called by destroy(), the particles aren't parented to the flame so they'd outlive it
+    def on_destroy(self):
+        FlameParticleSystem.live_particles -= len(self.particles)
+        for particle in self.particles:
+            destroy(particle)
+        self.particles.clear()
 
 
 models_data = {
@@ -61,58 +119,105 @@ models_data = {
     'brick': ('brick.obj', 'brick.png'),
     'flame': (None, flame_texture)  # Use None for model and add flame texture
 }
-
-
-# Load function
+registry = TypeRegistry(models_data)  # Loads each type once, map objects are copies of it
+
+
+# Grid-aligned blocks come from the baked map as merged chunk meshes, with one
+# collider per chunk holding a box for every axis aligned object in it
+chunk_entities = []  # Mesh and collider entities of the baked chunks
+
+# Function to make the entities of one baked chunk
+def add_baked_chunk(baked):
+    for obj_type, data in baked.meshes.items():
+        chunk_entity = Entity(
+            model=Mesh(
+                vertices=data.vertices,
+                triangles=data.triangles,
+                uvs=data.uvs,
+                normals=data.normals,
+                colors=[color.Color(*c) for c in data.colors]
+            ),
+            texture=registry.texture(obj_type)
+        )
+        if is_transparent(obj_type):
+            chunk_entity.set_transparency(TransparencyAttrib.M_alpha)
+        center, radius = bounds_sphere(data.vertices)
+        culling.add(chunk_entity, 'chunk', radius, center)
+        shadows.add_caster(chunk_entity, radius, static=True, center=center)
+        chunk_entities.append(chunk_entity)
+
+    # For the player controller's raycasts, bullets and hitscan shots use the baked BVH
+    collider_entity = Entity()
+    collider_entity.collider = BoxSetCollider(collider_entity, baked.boxes)
+    chunk_entities.append(collider_entity)
+
+
+# Load function. The map is baked into map.dbo.baked (see map_bake.py), so loading
+# only makes the chunk entities and the few objects that aren't plain blocks.
+# A missing or stale package is rebaked first, only the chunks that changed.
 def load_map():
-    global placed_objects
+    global placed_objects, flow_field, line_of_sight, static_bvh, spawn_points, map_object_count
 
-    for obj in placed_objects:
+    for obj in placed_objects + chunk_entities:
+        culling.remove(obj)
+        shadows.remove_caster(obj)
+        registry.forget(obj)
         destroy(obj)
     placed_objects.clear()
-
-    with open('map.dbo', 'rb') as file:
-        data = pickle.load(file)
-
-        for obj_type, position, rotation, color_data, sound_file, play_on_awake, loop in data:
-            if obj_type == 'flameparticlesystem':
-                placed_object = FlameParticleSystem(
-                    position=position,
-                    rotation=rotation,
-                    color=color_data
-                )
-            elif obj_type in models_data:
-                model, texture = models_data[obj_type]
-                placed_object = Entity(
-                    model=model,
-                    texture=texture,
-                    position=position,
-                    rotation=rotation,
-                    scale=1,
-                    collider='box',
-                    color=color_data
-                )
-            else:
+    chunk_entities.clear()
+    flame_systems.clear()
+    for sound in map_sounds:
+        destroy(sound)
+    map_sounds.clear()
+
+    # Includes the edits the editor journaled since the map was last compacted
+    package = load_baked('map.dbo', registry.models())
+    map_object_count = package.count
+    static_bvh = package.bvh
+    steps = len(package.chunks) + len(package.objects)
+    for i, baked in enumerate(package.chunks.values()):
+        add_baked_chunk(baked)
+        if i % 16 == 0:
+            telemetry.publish(placed_objects=map_object_count, map_load_progress=i / steps)
+
+    for i, baked in enumerate(package.objects, start=len(package.chunks)):
+        obj_type = baked.obj_type
+        if obj_type == 'flameparticlesystem':
+            placed_object = FlameParticleSystem(
+                position=baked.position,
+                rotation=baked.rotation,
+                color=baked.color
+            )
+        else:
+            if obj_type not in registry:
                 print(f"Warning: Unknown object type '{obj_type}'. Using default model and texture.")
-                placed_object = Entity(
-                    model='cube',
-                    texture='white_cube',
-                    position=position,
-                    rotation=rotation,
-                    scale=1,
-                    collider='box',
-                    color=color_data
-                )
-
-            # Attach sound settings
-            placed_object.sound_file = sound_file
-            placed_object.play_on_awake = play_on_awake
-            placed_object.loop = loop
-
-            if sound_file:
-                placed_object.audio = Audio(sound_file, autoplay=play_on_awake, loop=loop)
-
-            placed_objects.append(placed_object)
+            placed_object = registry.instantiate(
+                obj_type,
+                collider=not baked.merged,  # Merged ones collide through their chunk
+                position=baked.position,
+                rotation=baked.rotation,
+                scale=1,
+                color=baked.color
+            )
+
+        placed_objects.append(placed_object)
+        if isinstance(placed_object, FlameParticleSystem):
+            flame_systems.append(placed_object)
+        culling.add(placed_object, 'effect' if obj_type == 'flameparticlesystem' else 'object')
+        shadows.add_caster(placed_object, node_radius(placed_object), static=True, center=baked.position)
+
+        if i % 64 == 0:
+            telemetry.publish(placed_objects=map_object_count, map_load_progress=i / steps)
+
+    # Only sounds that start on their own need an Audio, nothing else in the game plays them
+    for emitter in package.emitters:
+        if emitter.play_on_awake:
+            map_sounds.append(Audio(emitter.sound_file, autoplay=True, loop=emitter.loop))
+
+    spawn_points = package.spawn_points
+    flow_field = FlowField(package.walk_grid)
+    line_of_sight = LineOfSight.from_positions(package.sight_blockers)
+    telemetry.publish(placed_objects=map_object_count, map_load_progress=1.0)
     print("Map loaded!")
 
 
@@ -120,10 +225,20 @@ def load_map():
 sky = Sky()
 
 # Lighting
-directional_light = DirectionalLight(shadows=True)
+directional_light = DirectionalLight()
 directional_light.look_at(Vec3(1, -1, -1))
 ambient_light = AmbientLight(color=color.rgba(100, 100, 100, 0.5))
 
+# Shadows from three cascades fitted to the camera instead of one map over the whole train
+shadows = CascadedShadows(base, scene, directional_light.forward)
+shadows.exclude(sky)
+sky.set_shader_off(20)  # The sky isn't lit
+sky.set_light_off(20)
+
+# Hides what's off screen or too far away from the main camera (set up after the shadow
+# cascades have taken their camera mask bits)
+culling = CullingSystem(camera_mask=base.cam.node().get_camera_mask())
+
 # Set the sky color
 camera.background_color = color.rgb(178, 216, 230)  # Light blue sky color
 
@@ -131,7 +246,7 @@ camera.background_color = color.rgb(178, 216, 230)  # Light blue sky color
 crosshair = Entity(
     parent=camera.ui,  # Attach to the UI, so it stays on screen
     model='quad',  # Simple 2D quad for the crosshair
-    texture='crosshair.png',  # Custom crosshair image
+    texture=cached_texture('crosshair.png', ui=True),  # Custom crosshair image
     scale=(0.02, 0.02),  # Adjust the size of the crosshair
     position=(0, 0),  # Center of the screen
 )
@@ -140,14 +255,15 @@ crosshair = Entity(
 user_profile = Entity(
     parent=camera.ui,  # Attach to the UI, so it stays on screen
     model='quad',  # Simple 2D quad for the image
-    texture='General.png',  # Your user profile image
+    texture=cached_texture('General.png', ui=True),  # Your user profile image
     scale=(0.2, 0.2),  # Adjust the size of the image
     position=(0.789, -0.4)  # Position in the bottom-right corner
 )
 
 # Create a mid-poly train with a collider, using dirt texture and repeat the texture
-train_texture = load_texture('dirt.png')
+train_texture = cached_texture('dirt.png')
 train = Entity(model='cube', scale=(500, 10, 500), texture=train_texture, collider='box')
+shadows.exclude(train)  # Nothing is under the ground for it to shadow
 
 # Repeat the texture on the cube
 train.texture_scale = (train.scale[0], train.scale[2])  # Repeat based on cube's size
@@ -160,15 +276,52 @@ player.health = 5
 
 # Increase player speed by 2x
 player.speed *= 2
+if args.replay:
+    player.ignore = True  # The recording moves the player
 
-placed_objects = []  # Initialize the list for placed objects
+placed_objects = []  # Entities of the placed objects that aren't drawn by a chunk
+map_object_count = 0  # Every object in the map, blocks included
+map_sounds = []  # Audio of the objects whose sound plays on awake
+flame_systems = []  # Placed flames, their particles are stepped with the gameplay ticks
 
 # Global variable for enemy kill count
 enemy_kills = 0
 
+# Gameplay is simulated in fixed ticks, at most 5 per frame before the game slows down
+simulation = FixedTimestep(tick_rate=60, max_steps=5)
+
+# Gameplay randomness comes from its own seeded generator so a recording can replay it
+if args.replay:
+    recorded_map, seed, recorded_tick_rate = read_header(args.replay)
+    replay_ticks = read_ticks(args.replay)
+    replay_index = 0
+    replay_timer = TickTimer()
+    replay_diverged = None  # First tick whose state check didn't match
+    replay_done = False
+    if recorded_map != map_hash('map.dbo'):
+        print(f"Warning: {args.replay} was recorded on a different map, the replay won't match")
+    if recorded_tick_rate != simulation.tick_rate:
+        simulation = FixedTimestep(tick_rate=recorded_tick_rate, max_steps=5)
+    recorder = None
+else:
+    seed = random.randrange(1 << 63)
+    replay_ticks = None
+    recorder = None
+    if not args.no_record:
+        if not args.record:
+            # Default recordings would pile up every launch, only the newest few are kept
+            prune_recordings(keep=RECORDINGS_KEPT - 1)
+        recorder = SessionRecorder(
+            args.record or os.path.join(RECORDINGS_DIR, time.strftime('session-%Y%m%d-%H%M%S.rec')),
+            map_hash('map.dbo'), seed, simulation.tick_rate
+        )
+        atexit.register(recorder.close)
+rng = random.Random(seed)
+
 # Bullet settings
 bullet_speed = 20
 enemy_bullet_speed = 10
+bullet_radius = 0.1  # Bullets are spheres of scale 0.2
 player_bullets = []
 enemy_bullets = []
 
@@ -178,14 +331,23 @@ enemy_count = 5
 enemy_speed = 0.5
 enemy_shoot_interval = 1  # 1 bullet per second
 min_distance = 0.3  # Minimum distance between enemies
+enemy_index = SpatialHash(4)  # Living enemies by position, for spawn and separation checks
+spawn_points = []  # Free points of the spawn ring, baked with the map
+flow_field = None  # Leads enemies around the placed objects, built by load_map
+line_of_sight = None  # Answers whether enemies can see the player, built by load_map
+static_bvh = None  # Baked StaticBVH of the placed objects, bullets and shots are tested against it
 
 # Last time the player shot
-last_shoot_time = 0
+last_shoot_time = -1
 shoot_delay = 0.3  # Delay between shots in seconds
+hitscan_mode = False  # Toggled with H: automatic fire, each shot is one ray instead of a bullet
+hitscan_delay = 0.1
 mouse_held = False  # To track if the mouse was previously held
+shoot_requested = False  # Clicked since the last tick, the shot is fired by the next tick
 
 # Cloud settings
 cloud_model = 'cloud.obj'  # 3D cloud model
+cloud_lods = None  # Every level of detail, loaded with the first cloud (simplified copies are cached in lod_cache/)
 cloud_objects = []
 
 
@@ -199,12 +361,44 @@ kill_counter_text = Text(
     position=(0.38, -0.4)  # Position it near the general's picture
 )
 
-
+# Visible/total counts of the culled categories, toggled with F3
+culling_text = Text(parent=camera.ui, position=(-0.85, 0.47), scale=0.8, enabled=False)
+
+# Function to get the main camera's view-projection matrix as nested rows
+def view_projection_matrix():
+    return matrix_rows(render.get_mat(base.cam) * base.cam.node().get_lens().get_projection_mat())
+
+
+
+# Function to give an entity one child per level of detail, only the most detailed is shown
+def add_lod_levels(entity, lods):
+    entity.lod_nodes = [
+        Entity(parent=entity, model=Mesh(vertices=data.vertices, triangles=data.triangles, uvs=data.uvs, normals=data.normals))
+        for data in lods
+    ]
+    for node in entity.lod_nodes[1:]:
+        node.hide()
+    entity.lod_level = 0
+    entity.lod_radius = bounding_radius(lods[0]) * max(entity.scale)
+
+# Function to switch entities to the level of detail that fits their size on screen
+def update_lods(entities):
+    for entity in entities:
+        if getattr(entity, 'culled', False):
+            continue
+        size = projected_size(entity.lod_radius, distance(entity.world_position, camera.world_position), camera.fov)
+        level = select_level(entity.lod_level, size)
+        if level != entity.lod_level:
+            entity.lod_nodes[entity.lod_level].hide()
+            entity.lod_nodes[level].show()
+            entity.lod_level = level
 
 # Function to create cloud objects
 def create_cloud():
+    global cloud_lods
+    if cloud_lods is None:
+        cloud_lods = load_lods(cloud_model)
     cloud = Entity(
-        model=cloud_model,
         scale=random.uniform(2, 5),  # Reduced mass by decreasing cloud scale
         y=random.uniform(95, 120),  # Random height for sky clouds
         x=random.uniform(-350, 350),  # Larger horizontal range for wider spread
@@ -212,11 +406,19 @@ def create_cloud():
         rotation_y=random.uniform(0, 360),  # Random rotation for cloud orientation
         color=color.white,  # White material since it's textureless
     )
+    add_lod_levels(cloud, cloud_lods)
     cloud_objects.append(cloud)
+    culling.add(cloud, 'cloud')
+    shadows.add_caster(cloud, cloud.lod_radius)
+
+# Generate fewer clouds, but spread across a larger area. They're only scenery,
+# so they're made a few per frame after the first frame instead of at startup
+def create_clouds(count=40):  # Adjust the number of clouds (less mass)
+    for _ in range(count):
+        create_cloud()
+        yield
 
-# Generate fewer clouds, but spread across a larger area
-for _ in range(40):  # Adjust the number of clouds (less mass)
-    create_cloud()
+startup.defer('clouds', create_clouds())
 
 # Health hearts
 hearts = []
@@ -224,66 +426,73 @@ for i in range(5):
     heart = Entity(
         parent=camera.ui,
         model='quad',
-        texture='heart.png',
+        texture=cached_texture('heart.png', ui=True),
         scale=(0.05, 0.05),
         position=(-0.85 + i * 0.1, -0.45),  # Adjust position for each heart
         color=color.white
     )
     hearts.append(heart)
 
-# Function to check if the position is valid for spawning an enemy
-def is_valid_position(position):
-    for enemy in enemies:
-        if distance(enemy.position, position) < min_distance:
-            return False
-    return True
-
-# Function to spawn an enemy
-def spawn_enemy():
-    while True:
-        angle = random.uniform(0, 360)
-        x = math.cos(math.radians(angle)) * 100
-        z = math.sin(math.radians(angle)) * 100
-        position = Vec3(x, 7, z)  # Place enemies on the surface of the train (height = 7)
-        
-        if is_valid_position(position):
-            enemy = Entity(model='capsule', color=color.red, position=position, scale=1, collider='box')
-            enemy.name = 'enemy_' + str(len(enemies) + 1)
-            enemy.health = 5  # Each enemy has 5 health points
-            enemy.shoot_time = 0
-            enemies.append(enemy)
-            break
+# Function to spawn an enemy at a free spot the wave director picked
+def spawn_enemy(x, z):
+    position = Vec3(x, 7, z)  # Place enemies on the surface of the train (height = 7)
+    enemy = Entity(model='capsule', color=color.red, position=position, scale=1, collider='box')
+    enemy.name = 'enemy_' + str(len(enemies) + 1)
+    enemy.health = 5  # Each enemy has 5 health points
+    enemy.shoot_time = 0
+    enemies.append(enemy)
+    enemy_index.insert(enemy, x, z)
+    culling.add(enemy, 'enemy')
+    shadows.add_caster(enemy, node_radius(enemy))
+
+# Function to remove a dead enemy
+def remove_enemy(enemy):
+    enemies.remove(enemy)
+    enemy_index.remove(enemy)
+    culling.remove(enemy)
+    shadows.remove_caster(enemy)
+    destroy(enemy)
+
+startup.mark('assets')
 
 # Load the map using the function from your map editor
 load_map()  # Use the exact map load function from your editor
+startup.mark('map')
 
-# Spawn enemies
-for _ in range(enemy_count):
-    spawn_enemy()
+# Waves start with enemy_count enemies and spawn a few per tick from points around the ring,
+# tried in an order shuffled by the gameplay generator
+spawn_order = list(spawn_points)
+rng.shuffle(spawn_order)
+director = WaveDirector(spawn_order, first_wave=enemy_count)
 
 # Function to shoot a bullet from the player
 def shoot():
     global last_shoot_time
-    if time.time() - last_shoot_time >= shoot_delay:  # Ensure delay between shots
+    delay = hitscan_delay if hitscan_mode else shoot_delay
+    if simulation.time - last_shoot_time >= delay:  # Ensure delay between shots
         # Calculate shooting direction based on camera's rotation
         shooting_direction = camera.forward
 
-        # Position the bullet based on the player's position and shooting direction
-        bullet = Entity(
-            model='sphere',
-            color=color.orange,
-            position=player.position + Vec3(0, 1, 0) + shooting_direction * 2,
-            scale=0.2,
-            collider='box'
-        )
-        bullet.name = 'player_bullet_' + str(len(player_bullets) + 1)
-        bullet.shooting_direction = shooting_direction
-        bullet.shooting_sound = Audio('ak.mp3', loop=False, autoplay=True, position=bullet.position, parent=bullet, volume=0.6)  # Set volume to 0.6 for player bullets
-        player_bullets.append(bullet)
+        if hitscan_mode:
+            Audio('ak.mp3', loop=False, autoplay=True, volume=0.6, auto_destroy=True)
+            fire_hitscan(shooting_direction)
+        else:
+            # Position the bullet based on the player's position and shooting direction
+            bullet = Entity(
+                model='sphere',
+                color=color.orange,
+                position=player.position + Vec3(0, 1, 0) + shooting_direction * 2,
+                scale=0.2,
+                collider='box'
+            )
+            bullet.name = 'player_bullet_' + str(len(player_bullets) + 1)
+            bullet.shooting_direction = shooting_direction
+            bullet.shooting_sound = Audio('ak.mp3', loop=False, autoplay=True, position=bullet.position, parent=bullet, volume=0.6)  # Set volume to 0.6 for player bullets
+            player_bullets.append(bullet)
         # Create muzzle flash
         muzzle_flash = Entity(
             model='quad',
-            texture='muzzle.png',
+            texture=cached_texture('muzzle.png'),
             position=player.position + Vec3(0, 1.35, 0) + shooting_direction * 2,
             rotation=player.rotation,
             scale=(0.5, 0.5),
@@ -291,7 +500,33 @@ def shoot():
 
         # Destroy the muzzle flash after 0.3 seconds
         destroy(muzzle_flash, delay=0.3)
-        last_shoot_time = time.time()
+        last_shoot_time = simulation.time
+        return True
+    return False
+
+# Function to fire one hitscan shot: a single ray against the placed objects, enemies and train
+def fire_hitscan(direction):
+    hit = hitscan(static_bvh, enemy_index, tuple(camera.world_position), tuple(direction), max_distance=200)
+    if hit is None:
+        return None
+
+    if hit.entity is not None and hit.entity in enemy_index.keys:
+        damage_enemy(hit.entity)
+
+    # Impact flash just off the surface that was hit
+    impact = Entity(model='quad', texture=cached_texture('muzzle.png'), position=Vec3(*hit.point) + Vec3(*hit.normal) * 0.05, scale=0.3)
+    impact.look_at(impact.position - Vec3(*hit.normal))
+    destroy(impact, delay=0.1)
+    return hit
+
+# Function to take one health point off an enemy
+def damage_enemy(enemy):
+    global enemy_kills
+    enemy.health -= 1
+    if enemy.health <= 0:
+        print(f"{enemy.name} died!")
+        remove_enemy(enemy)
+        enemy_kills += 1
 
 # Function to shoot a bullet from an enemy
 def enemy_shoot(enemy):
@@ -308,10 +543,11 @@ gun_texture = 'PolygonApocalypse_Texture_04_A.png'
 # Instantiate the AK-47 and set its texture
 ak47 = Entity(
     model=gun_model,
-    texture=gun_texture,
+    texture=cached_texture(gun_texture),
     scale=(2, 2, 2),  # Adjust scale as needed
     position=player.position,  # Initial position will be updated in the update function
 )
+startup.mark('gun')
 
 # Add this function to handle bullet bouncing upon collision
 def bounce_bullet(bullet, normal):
@@ -338,41 +574,32 @@ def update_health():
     else:
         destroy(hearts[player.health])  # Destroy a heart from right to left
 
-# Update function to move bullets, check collisions, lock enemy positions, and move clouds
-def update():
-    global mouse_held
-    # Player shooting
-    if mouse.left and not mouse_held:  # Shoot only on new click, not hold
-        shoot()
-
-    mouse_held = mouse.left  # Update the held state
+# Entities whose position is simulated and drawn interpolated
+def moving_entities():
+    return player_bullets + enemy_bullets + enemies + cloud_objects
 
+# One fixed gameplay tick: bullets, enemies, clouds and flame particles
+def simulate(dt):
     # Move player bullets
     for bullet in player_bullets[:]:
-        bullet.position += bullet.shooting_direction * bullet_speed * time.dt
+        previous = tuple(bullet.position)
+        bullet.position += bullet.shooting_direction * bullet_speed * dt
 
         # Check collision with the train
         if bullet.intersects(train).hit:
             normal = bullet.intersects(train).world_normal  # Get the normal of the collision surface
             bounce_bullet(bullet, normal)  # Bounce the bullet
 
-        # Check collision with placed objects
-        for obj in placed_objects:
-            if bullet.intersects(obj).hit:
-                normal = bullet.intersects(obj).world_normal  # Get the normal of the collision surface
-                bounce_bullet(bullet, normal)  # Bounce the bullet
-                break
+        # Check collision with placed objects: this tick's path against the baked BVH
+        hit = sweep(static_bvh, previous, tuple(bullet.position), bullet_radius)
+        if hit:
+            # Back out to the surface so the bounce doesn't start inside the object
+            bullet.position = Vec3(*hit.point) + Vec3(*hit.normal) * bullet_radius
+            bounce_bullet(bullet, Vec3(*hit.normal))
         
         for enemy in enemies[:]:
             if bullet.intersects(enemy).hit:  # Check collision with enemy
-                enemy.health -= 1
-                if enemy.health <= 0:
-                    print(f"{enemy.name} died!")
-                    enemies.remove(enemy)
-                    destroy(enemy)
-                    # Add this line to increment the kill counter
-                    global enemy_kills
-                    enemy_kills += 1
+                damage_enemy(enemy)
                 destroy(bullet)
                 player_bullets.remove(bullet)
                 break  # Exit the loop after handling collision
@@ -382,7 +609,8 @@ def update():
 
     # Move enemy bullets
     for bullet in enemy_bullets[:]:
-        bullet.position += bullet.shooting_direction * enemy_bullet_speed * time.dt
+        previous = tuple(bullet.position)
+        bullet.position += bullet.shooting_direction * enemy_bullet_speed * dt
         
         if distance(bullet.position, player.position) < 2:  # Check if the bullet hits the player
             player.health -= 1
@@ -401,38 +629,134 @@ def update():
             destroy(bullet)
             enemy_bullets.remove(bullet)
 
-        # Check collision with placed objects
-        for obj in placed_objects:
-            if bullet.intersects(obj).hit:
-                destroy(bullet)
-                enemy_bullets.remove(bullet)
-                break  # Exit loop after handling collision  
+        # Check collision with placed objects: this tick's path against the baked BVH
+        if bullet in enemy_bullets and sweep(static_bvh, previous, tuple(bullet.position), bullet_radius):
+            destroy(bullet)
+            enemy_bullets.remove(bullet)
 
-    # Enemy movement, shooting, and position locking
+    # Enemy movement, shooting, and position locking. One shared flow field leads every
+    # enemy around the placed objects, it's only rebuilt when the player changes cell
+    flow_field.set_goal(player.x, player.z)
+    flow_field.update()
+    ready = []  # Enemies whose gun has reloaded
     for enemy in enemies:
-        enemy.look_at(player)
+        dx, dz = flow_field.direction(enemy.x, enemy.z, player.x, player.z)
+        if dx or dz:
+            enemy.look_at(enemy.position + Vec3(dx, 0, dz))
         enemy.rotation_x = 0  # Lock X-axis rotation
         enemy.rotation_z = 0  # Lock Z-axis rotation
-        enemy.position += enemy.forward * enemy_speed * time.dt
+        enemy.position += enemy.forward * enemy_speed * dt
 
         # Lock Y-axis position at 7 and prevent going underground
         enemy.position = Vec3(enemy.position.x, 7, enemy.position.z)
 
-        # Ensure enemies do not move inside each other
-        for other_enemy in enemies:
-            if enemy != other_enemy and distance(enemy.position, other_enemy.position) < min_distance:
-                direction = (enemy.position - other_enemy.position).normalized()
-                enemy.position += direction * enemy_speed * time.dt
-
-        if time.time() - enemy.shoot_time > enemy_shoot_interval:
-            enemy_shoot(enemy)
-            enemy.shoot_time = time.time()
+        # Ensure enemies do not move inside each other, only the ones in nearby cells are checked
+        enemy_index.move(enemy, enemy.x, enemy.z)
+        neighbours = [other_enemy for other_enemy, _ in enemy_index.query(enemy.x, enemy.z, min_distance) if other_enemy is not enemy]
+        for other_enemy in neighbours:
+            direction = (enemy.position - other_enemy.position).normalized()
+            enemy.position += direction * enemy_speed * dt
+        if neighbours:
+            enemy_index.move(enemy, enemy.x, enemy.z)
+
+        if simulation.time - enemy.shoot_time > enemy_shoot_interval:
+            ready.append(enemy)
+
+    # Enemies only fire when they can see the player, checked for all of them in one batch
+    if ready:
+        eye = tuple(player.position + Vec3(0, 1, 0))
+        sight = line_of_sight.resolve([(tuple(enemy.position), eye) for enemy in ready], simulation.tick)
+        for enemy, visible in zip(ready, sight):
+            if visible:
+                enemy_shoot(enemy)
+                enemy.shoot_time = simulation.time
 
     # Move clouds slowly across the sky
     for cloud in cloud_objects:
-        cloud.x += time.dt * 0.1  # Move clouds slowly to the right
+        cloud.x += dt * 0.1  # Move clouds slowly to the right
         if cloud.x > 300:  # Wrap around when cloud moves off screen
             cloud.x = -300
+            cloud.prev_position = cloud.position  # Or interpolation slides it back across the sky
+
+    for flame in flame_systems:
+        flame.tick(dt)
+
+# Function to hash what the gameplay state is after a tick, to check replays against
+def simulation_checksum():
+    values = [player.health, enemy_kills, len(player_bullets), len(enemy_bullets)]
+    for enemy in enemies:
+        values.extend((enemy.x, enemy.y, enemy.z, enemy.health))
+    return checksum(values)
+
+def simulate_tick(dt):
+    global shoot_requested, hitscan_mode, replay_index, replay_diverged
+    record = None
+    if replay_ticks is not None:
+        # The recorded pose and events drive the tick instead of the mouse and keyboard
+        record = replay_ticks[replay_index]
+        replay_index += 1
+        player.position = record.position
+        player.rotation_y = record.yaw
+        player.camera_pivot.rotation_x = record.pitch
+        shoot_requested = record.shoot
+        hitscan_mode = record.hitscan
+
+    # Next wave once the last one is dead, its enemies arrive a few per tick
+    if not enemies and not director.queued:
+        print(f"Wave {director.wave + 1}: {director.next_wave()} enemies")
+    spawns = director.spawns(enemy_index, (player.x, player.z))
+    for x, z in spawns:
+        spawn_enemy(x, z)
+    fired = shoot_requested and shoot()
+    shoot_requested = False
+
+    begin_tick(moving_entities())
+    simulate(dt)
+    end_tick(moving_entities())
+
+    check = simulation_checksum() if (simulation.tick + 1) % CHECK_INTERVAL == 0 else None
+    if recorder:
+        recorder.tick(player.position, player.rotation_y, player.camera_pivot.rotation_x, fired, len(spawns), check, hitscan_mode)
+    elif record and (len(spawns) != record.spawns or record.check is not None and check != record.check) and replay_diverged is None:
+        replay_diverged = simulation.tick
+        print(f"Replay diverged from the recording at tick {simulation.tick}")
+
+# Function to replay recorded ticks for one frame's worth of wall time
+def run_replay(budget=1 / 30):
+    global replay_done
+    start = time.perf_counter()
+    while replay_index < len(replay_ticks) and time.perf_counter() - start < budget:
+        began = time.perf_counter()
+        simulation.step_now(simulate_tick)
+        replay_timer.add(time.perf_counter() - began)
+
+    # Checked outside the loop, a recording without ticks has to finish too
+    if replay_index == len(replay_ticks) and not replay_done:
+        replay_done = True
+        print(f"Replay finished: {replay_timer.summary()}")
+        print("Replay matched the recording" if replay_diverged is None else f"Replay diverged at tick {replay_diverged}")
+        if args.headless:
+            application.quit()
+
+# Update function to move bullets, check collisions, lock enemy positions, and move clouds
+def update():
+    global mouse_held, shoot_requested
+    # Times the first frames, then builds what was left out of startup a little per frame
+    startup.frame()
+
+    # Player shooting
+    # Shoot only on new click, not hold, unless the weapon is automatic
+    if mouse.left and (hitscan_mode or not mouse_held) and replay_ticks is None:
+        shoot_requested = True
+
+    mouse_held = mouse.left  # Update the held state
+
+    # Gameplay runs in fixed ticks, moving entities are drawn between the last two
+    if replay_ticks is not None:
+        run_replay()
+    else:
+        simulation.run(time.dt, simulate_tick)
+    interpolate(moving_entities(), simulation.alpha)
 
     # Update AK-47 position and rotation
     ak47.position = player.position + Vec3(0.26, 1, 0) 
@@ -443,4 +767,30 @@ def update():
     # Update the kill counter text
     kill_counter_text.text = f'KILL COUNTER: {enemy_kills}'
 
+    # Hide what the camera can't see before the frame is drawn
+    culling.update(camera.world_position, view_projection_matrix())
+    update_lods(cloud_objects)
+    shadows.update(base.cam)
+    if culling_text.enabled:
+        culling_text.text = culling.summary()
+
+    # Publish this frame's counters to monitor.py
+    telemetry.publish(
+        frame_time=time.dt,
+        entities=len(scene.entities),
+        placed_objects=map_object_count,
+        player_bullets=len(player_bullets),
+        enemy_bullets=len(enemy_bullets),
+        enemies=len(enemies),
+        particles=FlameParticleSystem.live_particles
+    )
+
+def input(key):
+    global hitscan_mode
+    if key == 'f3':
+        culling_text.enabled = not culling_text.enabled
+    elif key == 'h' and replay_ticks is None:
+        hitscan_mode = not hitscan_mode
+        print(f"Weapon: {'hitscan' if hitscan_mode else 'bullets'}")
+
 app.run()
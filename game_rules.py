@@ -0,0 +1,364 @@
+import math
+import random
+from collections import namedtuple
+
+from voxel_grid import GROUND_Y
+
+# Headless game rules of game3DUFPSN.py for the dedicated server.
+#
+# Same rules as the single-player game, but for any number of players and
+# without Ursina: bodies are plain objects, collisions are distance tests and
+# the placed blocks come from an OccupancyGrid. Everything random goes
+# through the world's own seeded Random, and the world only moves when step()
+# is called with a fixed dt, so the same seed and inputs give the same match.
+#
+# Bullets fly in straight lines between bounces, so their state is where and
+# when they were launched plus their heading rather than where they are now.
+# It only changes when a bullet bounces and bullet_position() works out the
+# rest, which keeps moving bullets out of the snapshot deltas.
+#
+# Unlike the single-player game, bullets also expire after BULLET_LIFETIME and
+# at most MAX_BULLETS are alive at once, so a full server can't pile up
+# thousands of them for every snapshot and hit test to go through.
+
+# Kinds of bodies, sent to the clients with every entity
+PLAYER = 1
+ENEMY = 2
+PLAYER_BULLET = 3
+ENEMY_BULLET = 4
+
+# Same numbers as game3DUFPSN.py
+PLAYER_SPEED = 10  # FirstPersonController speed (5) doubled
+PLAYER_HEALTH = 5
+BULLET_SPEED = 20
+ENEMY_BULLET_SPEED = 10
+BULLET_RANGE = 200
+BULLET_LIFETIME = 5.0  # Seconds a bullet flies before it's removed, bounces don't reset it
+MAX_BULLETS = 256  # Bullets alive in the match, firing past this removes the oldest
+SHOOT_DELAY = 0.3
+ENEMY_COUNT = 5
+ENEMY_SPEED = 0.5
+ENEMY_HEALTH = 5
+ENEMY_Y = 7
+ENEMY_SPAWN_RADIUS = 100
+ENEMY_SHOOT_INTERVAL = 1
+MIN_DISTANCE = 0.3  # Minimum distance between enemies
+PLAYER_HIT_DISTANCE = 2  # Enemy bullets closer than this to a player hit them
+ENEMY_HIT_RADIUS = 0.6  # Capsule radius plus the bullet's
+ENEMY_HIT_HEIGHT = 1.1  # Half the capsule's height plus the bullet's
+GROUND_EXTENT = 250  # Half the size of the train
+RESPAWN_TIME = 3.0  # Seconds before a dead player comes back
+HIT_CELL = 4.0  # Size of the cells bullets look up their targets in
+
+SHOOT = 1  # Input button bits
+
+PlayerInput = namedtuple('PlayerInput', ['sequence', 'move_x', 'move_z', 'yaw', 'pitch', 'buttons'])
+IDLE_INPUT = PlayerInput(0, 0.0, 0.0, 0.0, 0.0, 0)
+
+
+def forward_vector(yaw, pitch=0.0):
+    """Return the direction an Ursina entity with rotation (pitch, yaw, 0) faces."""
+    yaw = math.radians(yaw)
+    pitch = math.radians(pitch)
+    return (math.sin(yaw) * math.cos(pitch), -math.sin(pitch), math.cos(yaw) * math.cos(pitch))
+
+
+def heading(direction):
+    """Return the (yaw, pitch) that forward_vector turns back into direction."""
+    x, y, z = direction
+    return math.degrees(math.atan2(x, z)) % 360, -math.degrees(math.asin(max(-1.0, min(1.0, y))))
+
+
+def bullet_speed(kind):
+    return BULLET_SPEED if kind == PLAYER_BULLET else ENEMY_BULLET_SPEED
+
+
+def bullet_position(kind, launch, yaw, pitch, launch_tick, tick, dt):
+    """Where a bullet launched from launch at launch_tick is at tick."""
+    dx, dy, dz = forward_vector(yaw, pitch)
+    distance = bullet_speed(kind) * dt * (tick - launch_tick)
+    return (launch[0] + dx * distance, launch[1] + dy * distance, launch[2] + dz * distance)
+
+
+def hit_buckets(bodies, radius):
+    """Bucket bodies by the HIT_CELL cells their hit circle overlaps.
+
+    A bullet then only tests the bodies in its own cell instead of all of them.
+    """
+    buckets = {}
+    for body in bodies:
+        for cx in range(math.floor((body.x - radius) / HIT_CELL), math.floor((body.x + radius) / HIT_CELL) + 1):
+            for cz in range(math.floor((body.z - radius) / HIT_CELL), math.floor((body.z + radius) / HIT_CELL) + 1):
+                buckets.setdefault((cx, cz), []).append(body)
+    return buckets
+
+
+def _normalized(x, y, z):
+    length = math.sqrt(x * x + y * y + z * z) or 1.0
+    return x / length, y / length, z / length
+
+
+class Body:
+    """A player, enemy or bullet."""
+
+    __slots__ = (
+        'id', 'kind', 'x', 'y', 'z', 'yaw', 'pitch', 'health', 'direction', 'origin',
+        'launch', 'launch_tick', 'owner', 'fire_time', 'shoot_time', 'dead_time',
+    )
+
+    def __init__(self, body_id, kind, position, yaw=0.0, health=0):
+        self.id = body_id
+        self.kind = kind
+        self.x, self.y, self.z = position
+        self.yaw = yaw
+        self.pitch = 0.0
+        self.health = health
+        self.direction = (0.0, 0.0, 0.0)  # Bullets only
+        self.origin = position  # Where a bullet was fired from
+        self.launch = position  # Where a bullet was fired from or last bounced
+        self.launch_tick = 0  # Tick at which the bullet was at launch
+        self.owner = 0  # Player who fired a bullet
+        self.fire_time = 0.0  # When a bullet was fired
+        self.shoot_time = 0.0  # Last shot of a player or enemy
+        self.dead_time = None  # When a player died
+
+    @property
+    def position(self):
+        return (self.x, self.y, self.z)
+
+
+class World:
+    """Bodies of one match and the rules that move them."""
+
+    def __init__(self, seed=0, blocks=None, enemy_count=ENEMY_COUNT):
+        self.random = random.Random(seed)
+        self.blocks = blocks  # OccupancyGrid of the map's blocks, or None for an empty train
+        self.enemy_count = enemy_count
+        self.bodies = {}  # body id -> Body, in creation order
+        self.players = {}  # player body id -> Body
+        self.enemies = {}
+        self.bullets = {}
+        self.next_id = 1
+        self.tick = 0
+        self.time = 0.0
+        self.events = []  # (name, data) of the last step, e.g. ('shoot', player id)
+
+    def _add(self, kind, position, yaw=0.0, health=0):
+        body = Body(self.next_id, kind, position, yaw, health)
+        self.next_id += 1
+        self.bodies[body.id] = body
+        return body
+
+    def _remove(self, body):
+        self.bodies.pop(body.id, None)
+        self.players.pop(body.id, None)
+        self.enemies.pop(body.id, None)
+        self.bullets.pop(body.id, None)
+
+    def add_player(self):
+        """Add a player near the middle of the train and return their body id."""
+        body = self._add(PLAYER, self._player_spawn(), health=PLAYER_HEALTH)
+        self.players[body.id] = body
+        return body.id
+
+    def remove_player(self, player_id):
+        body = self.players.get(player_id)
+        if body:
+            self._remove(body)
+
+    def _player_spawn(self):
+        angle = self.random.uniform(0, 2 * math.pi)
+        distance = self.random.uniform(0, 5)
+        return (math.cos(angle) * distance, GROUND_Y, math.sin(angle) * distance)
+
+    def spawn_enemy(self):
+        """Spawn an enemy on the ring around the middle, away from the others."""
+        for _ in range(32):
+            angle = math.radians(self.random.uniform(0, 360))
+            position = (math.cos(angle) * ENEMY_SPAWN_RADIUS, ENEMY_Y, math.sin(angle) * ENEMY_SPAWN_RADIUS)
+            if all(math.dist(position, enemy.position) >= MIN_DISTANCE for enemy in self.enemies.values()):
+                enemy = self._add(ENEMY, position, health=ENEMY_HEALTH)
+                self.enemies[enemy.id] = enemy
+                self.events.append(('spawn_enemy', enemy.id))
+                return enemy.id
+        return None
+
+    def apply_input(self, player_id, player_input, dt):
+        """Move and turn a player and fire when the input asks for it."""
+        player = self.players.get(player_id)
+        if player is None or player.health <= 0:
+            return
+        player.yaw = player_input.yaw % 360
+        player.pitch = max(-90.0, min(90.0, player_input.pitch))
+
+        move_x = max(-1.0, min(1.0, player_input.move_x))
+        move_z = max(-1.0, min(1.0, player_input.move_z))
+        length = math.sqrt(move_x * move_x + move_z * move_z)
+        if length > 0:
+            fx, _, fz = forward_vector(player.yaw)
+            # Right is forward turned a quarter clockwise seen from above
+            dx = (fx * move_z + fz * move_x) / max(length, 1.0)
+            dz = (fz * move_z - fx * move_x) / max(length, 1.0)
+            player.x = max(-GROUND_EXTENT, min(GROUND_EXTENT, player.x + dx * PLAYER_SPEED * dt))
+            player.z = max(-GROUND_EXTENT, min(GROUND_EXTENT, player.z + dz * PLAYER_SPEED * dt))
+
+        if player_input.buttons & SHOOT and self.time - player.shoot_time >= SHOOT_DELAY:
+            self._shoot(player, forward_vector(player.yaw, player.pitch))
+
+    def _shoot(self, player, direction):
+        position = (
+            player.x + direction[0] * 2,
+            player.y + 1 + direction[1] * 2,
+            player.z + direction[2] * 2,
+        )
+        bullet = self._add(PLAYER_BULLET, position)
+        self._launch(bullet, direction, self.tick)  # Moves in this tick's step
+        bullet.owner = player.id
+        self._track_bullet(bullet)
+        player.shoot_time = self.time
+        self.events.append(('shoot', player.id))
+
+    def _enemy_shoot(self, enemy, target):
+        fx, _, fz = forward_vector(enemy.yaw)
+        position = (enemy.x + 0.26 + fx * 2, enemy.y, enemy.z + fz * 2)
+        bullet = self._add(ENEMY_BULLET, position)
+        self._launch(bullet, _normalized(target.x - enemy.x, target.y - enemy.y, target.z - enemy.z), self.tick + 1)
+        bullet.owner = enemy.id
+        self._track_bullet(bullet)
+
+    def _track_bullet(self, bullet):
+        # Bullets are in firing order, so the first one is the oldest
+        while len(self.bullets) >= MAX_BULLETS:
+            self._remove(next(iter(self.bullets.values())))
+        bullet.fire_time = self.time
+        self.bullets[bullet.id] = bullet
+
+    def _launch(self, bullet, direction, launch_tick):
+        bullet.direction = direction
+        bullet.yaw, bullet.pitch = heading(direction)
+        bullet.launch = bullet.position
+        bullet.launch_tick = launch_tick
+
+    def _block_hit(self, bullet, distance):
+        if self.blocks is None or not len(self.blocks):
+            return None
+        return self.blocks.raycast(bullet.position, bullet.direction, distance)
+
+    def step(self, dt):
+        """Advance the match by one tick."""
+        self.events = []
+
+        # Move bullets, player bullets bounce off blocks and the train like in the game
+        enemy_buckets = hit_buckets(self.enemies.values(), ENEMY_HIT_RADIUS)
+        player_buckets = hit_buckets(self.players.values(), PLAYER_HIT_DISTANCE)
+        for bullet in list(self.bullets.values()):
+            speed = bullet_speed(bullet.kind)
+            hit = self._block_hit(bullet, speed * dt)
+            if hit is not None and bullet.kind == ENEMY_BULLET:
+                self._remove(bullet)
+                continue
+            dx, dy, dz = bullet.direction
+            bullet.x += dx * speed * dt
+            bullet.y += dy * speed * dt
+            bullet.z += dz * speed * dt
+            if hit is not None:
+                nx, ny, nz = hit.normal
+                dot = dx * nx + dy * ny + dz * nz
+                self._launch(bullet, _normalized(dx - 2 * dot * nx, dy - 2 * dot * ny, dz - 2 * dot * nz), self.tick + 1)
+            elif bullet.y < GROUND_Y and dy < 0:
+                if bullet.kind == ENEMY_BULLET:
+                    self._remove(bullet)
+                    continue
+                self._launch(bullet, (dx, -dy, dz), self.tick + 1)
+
+            cell = (math.floor(bullet.x / HIT_CELL), math.floor(bullet.z / HIT_CELL))
+            if bullet.kind == PLAYER_BULLET:
+                self._player_bullet_hits(bullet, enemy_buckets.get(cell, ()))
+            else:
+                self._enemy_bullet_hits(bullet, player_buckets.get(cell, ()))
+            if bullet.id in self.bullets and (math.dist(bullet.position, bullet.origin) > BULLET_RANGE
+                                              or self.time - bullet.fire_time > BULLET_LIFETIME):
+                self._remove(bullet)
+
+        # Enemies walk towards the nearest living player and shoot at them
+        living = [player for player in self.players.values() if player.health > 0]
+        enemies = list(self.enemies.values())
+        for enemy in enemies:
+            if not living:
+                break
+            target = min(living, key=lambda player: (player.x - enemy.x) ** 2 + (player.z - enemy.z) ** 2)
+            enemy.yaw = math.degrees(math.atan2(target.x - enemy.x, target.z - enemy.z)) % 360
+            fx, _, fz = forward_vector(enemy.yaw)
+            enemy.x += fx * ENEMY_SPEED * dt
+            enemy.z += fz * ENEMY_SPEED * dt
+
+            # Keep enemies from walking into each other
+            for other in enemies:
+                if other is not enemy and math.dist(enemy.position, other.position) < MIN_DISTANCE:
+                    dx, _, dz = _normalized(enemy.x - other.x, 0.0, enemy.z - other.z)
+                    enemy.x += dx * ENEMY_SPEED * dt
+                    enemy.z += dz * ENEMY_SPEED * dt
+
+            if self.time - enemy.shoot_time > ENEMY_SHOOT_INTERVAL:
+                self._enemy_shoot(enemy, target)
+                enemy.shoot_time = self.time
+
+        # Dead players come back on the train after a while
+        for player in self.players.values():
+            if player.health <= 0 and self.time - player.dead_time >= RESPAWN_TIME:
+                player.x, player.y, player.z = self._player_spawn()
+                player.health = PLAYER_HEALTH
+                player.dead_time = None
+
+        while len(self.enemies) < self.enemy_count and self.spawn_enemy() is not None:
+            pass
+
+        self.tick += 1
+        self.time = self.tick * dt
+
+    def _player_bullet_hits(self, bullet, enemies):
+        for enemy in enemies:
+            if (enemy.health > 0 and abs(bullet.y - enemy.y) < ENEMY_HIT_HEIGHT
+                    and (bullet.x - enemy.x) ** 2 + (bullet.z - enemy.z) ** 2 < ENEMY_HIT_RADIUS ** 2):
+                enemy.health -= 1
+                if enemy.health <= 0:
+                    self._remove(enemy)
+                    self.events.append(('kill', (bullet.owner, enemy.id)))
+                self._remove(bullet)
+                return
+
+    def _enemy_bullet_hits(self, bullet, players):
+        for player in players:
+            if player.health > 0 and math.dist(bullet.position, player.position) < PLAYER_HIT_DISTANCE:
+                player.health -= 1
+                if player.health <= 0:
+                    player.dead_time = self.time
+                    self.events.append(('player_died', player.id))
+                self._remove(bullet)
+                return
+
+    def state(self):
+        """Return {body id: (kind, x, y, z, yaw, pitch, health, launch tick)} of every body.
+
+        For bullets x, y, z is the launch point, see bullet_position().
+        """
+        state = {}
+        for body in self.bodies.values():
+            if body.kind == PLAYER_BULLET or body.kind == ENEMY_BULLET:
+                x, y, z = body.launch
+                state[body.id] = (body.kind, x, y, z, body.yaw, body.pitch, body.health, body.launch_tick)
+            else:
+                state[body.id] = (body.kind, body.x, body.y, body.z, body.yaw, body.pitch, body.health, 0)
+        return state
+
+
+def load_blocks(map_path):
+    """Return an OccupancyGrid with the blocks of a map (needs Ursina installed to unpickle it)."""
+    from edit_journal import read_map
+    from voxel_grid import OccupancyGrid, cell_of
+
+    blocks = OccupancyGrid()
+    for record in read_map(map_path):
+        if record[0] != 'flameparticlesystem':
+            blocks.add(cell_of(tuple(record[1])), object())
+    return blocks
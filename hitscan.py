@@ -0,0 +1,243 @@
+import math
+from collections import namedtuple
+
+from voxel_grid import GROUND_Y
+
+# Ray queries for hitscan weapons.
+#
+# A shot is one ray tested against the static geometry and the enemies,
+# instead of a bullet entity that has to be moved and collision tested every
+# tick of its life. Placed objects are kept in a bounding volume hierarchy
+# over their world bounding boxes, built once when the map is baked. The
+# enemies move, so they're looked up in the SpatialHash the game already
+# keeps them in: the ray walks the hash cells it passes over (2D DDA) and
+# only tests the enemies in and next to them.
+
+Hit = namedtuple('Hit', ['entity', 'point', 'normal', 'distance'])
+
+LEAF_SIZE = 4
+ENEMY_RADIUS = 0.5
+ENEMY_HALF_HEIGHT = 1.0  # Capsules are 2 units tall at scale 1
+
+
+def ray_box(origin, inv_dir, low, high):
+    """Slab test. Returns (t_enter, axis) or None if the ray misses the box."""
+    t_near = -math.inf
+    t_far = math.inf
+    axis = 0
+    for i in range(3):
+        if inv_dir[i] is None:
+            if origin[i] < low[i] or origin[i] > high[i]:
+                return None
+            continue
+        t1 = (low[i] - origin[i]) * inv_dir[i]
+        t2 = (high[i] - origin[i]) * inv_dir[i]
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > t_near:
+            t_near = t1
+            axis = i
+        if t2 < t_far:
+            t_far = t2
+        if t_near > t_far:
+            return None
+    if t_far < 0:
+        return None
+    return max(t_near, 0.0), axis
+
+
+def _normalized(direction):
+    length = math.sqrt(direction[0] ** 2 + direction[1] ** 2 + direction[2] ** 2)
+    if length == 0:
+        return None
+    return (direction[0] / length, direction[1] / length, direction[2] / length)
+
+
+class StaticBVH:
+    """Bounding volume hierarchy over (item, low, high) boxes."""
+
+    def __init__(self, boxes):
+        self.items = []
+        self.lows = []
+        self.highs = []
+        # Nodes as flat lists: low, high, then either (left, right) children or a (start, count) leaf
+        self.nodes = []
+        boxes = list(boxes)
+        if boxes:
+            self._build(boxes)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _build(self, boxes):
+        low = [min(box[1][axis] for box in boxes) for axis in range(3)]
+        high = [max(box[2][axis] for box in boxes) for axis in range(3)]
+        index = len(self.nodes)
+        self.nodes.append(None)
+        if len(boxes) <= LEAF_SIZE:
+            start = len(self.items)
+            for item, box_low, box_high in boxes:
+                self.items.append(item)
+                self.lows.append(tuple(box_low))
+                self.highs.append(tuple(box_high))
+            self.nodes[index] = (low, high, False, start, len(boxes))
+            return index
+
+        # Split at the median centre along the longest side
+        axis = max(range(3), key=lambda a: high[a] - low[a])
+        boxes.sort(key=lambda box: box[1][axis] + box[2][axis])
+        middle = len(boxes) // 2
+        left = self._build(boxes[:middle])
+        right = self._build(boxes[middle:])
+        self.nodes[index] = (low, high, True, left, right)
+        return index
+
+    def raycast(self, origin, direction, max_distance=math.inf):
+        """Return the nearest Hit along a ray, or None."""
+        if not self.nodes:
+            return None
+        direction = _normalized(direction)
+        if direction is None:
+            return None
+        inv_dir = tuple(1 / d if d != 0 else None for d in direction)
+
+        best = None  # (t, axis, item index)
+        best_t = max_distance
+        root = ray_box(origin, inv_dir, self.nodes[0][0], self.nodes[0][1])
+        stack = [(root[0], 0)] if root else []
+        while stack:
+            t_entry, index = stack.pop()
+            if t_entry > best_t:
+                continue
+            node = self.nodes[index]
+            if node[2]:
+                # Visit the nearer child first so the far one can often be skipped
+                children = []
+                for child in (node[3], node[4]):
+                    hit = ray_box(origin, inv_dir, self.nodes[child][0], self.nodes[child][1])
+                    if hit is not None and hit[0] <= best_t:
+                        children.append((hit[0], child))
+                children.sort(reverse=True)
+                stack.extend(children)
+                continue
+            for i in range(node[3], node[3] + node[4]):
+                hit = ray_box(origin, inv_dir, self.lows[i], self.highs[i])
+                if hit is not None and hit[0] <= best_t:
+                    best = (hit[0], hit[1], i)
+                    best_t = hit[0]
+
+        if best is None:
+            return None
+        t, axis, i = best
+        point = tuple(origin[a] + direction[a] * t for a in range(3))
+        normal = [0.0, 0.0, 0.0]
+        normal[axis] = -1.0 if direction[axis] > 0 else 1.0
+        return Hit(self.items[i], point, tuple(normal), t)
+
+
+def _ray_cylinder(origin, direction, center, radius, half_height):
+    # Ray against an upright cylinder, returns (t, normal) of the side it enters through
+    ox = origin[0] - center[0]
+    oz = origin[2] - center[2]
+    dx, dy, dz = direction
+    a = dx * dx + dz * dz
+    if a < 1e-12:
+        return None
+    b = ox * dx + oz * dz
+    c = ox * ox + oz * oz - radius * radius
+    disc = b * b - a * c
+    if disc < 0:
+        return None
+    t = (-b - math.sqrt(disc)) / a
+    if t < 0:
+        if c > 0:
+            return None
+        t = 0.0  # Starts inside
+    y = origin[1] + dy * t - center[1]
+    if abs(y) > half_height:
+        return None
+    nx = (ox + dx * t) / radius
+    nz = (oz + dz * t) / radius
+    return t, (nx, 0.0, nz)
+
+
+def raycast_enemies(enemies, origin, direction, max_distance, radius=ENEMY_RADIUS, half_height=ENEMY_HALF_HEIGHT):
+    """Return the nearest Hit on an enemy in a SpatialHash, or None.
+
+    The hash stores each enemy under its own key with its (x, z); enemy.y is
+    read from the entity.
+    """
+    direction = _normalized(direction)
+    if direction is None or not len(enemies):
+        return None
+    size = enemies.cell_size
+    dx, dz = direction[0], direction[2]
+    cell = [math.floor(origin[0] / size), math.floor(origin[2] / size)]
+    step = [0, 0]
+    t_max = [math.inf, math.inf]
+    t_delta = [math.inf, math.inf]
+    for i, d, o in ((0, dx, origin[0]), (1, dz, origin[2])):
+        if d > 0:
+            step[i] = 1
+            t_max[i] = ((cell[i] + 1) * size - o) / d
+            t_delta[i] = size / d
+        elif d < 0:
+            step[i] = -1
+            t_max[i] = (cell[i] * size - o) / d
+            t_delta[i] = -size / d
+
+    best = None
+    tested = set()
+    t_cell = 0.0
+    while t_cell <= max_distance:
+        if best is not None and t_cell > best[0] + size:
+            break
+        # Neighbouring cells too, an enemy near a cell edge sticks out of it
+        for ox in (-1, 0, 1):
+            for oz in (-1, 0, 1):
+                key = (cell[0] + ox, cell[1] + oz)
+                if key in tested:
+                    continue
+                tested.add(key)
+                bucket = enemies.cells.get(key)
+                if not bucket:
+                    continue
+                for enemy, (x, z) in bucket.items():
+                    hit = _ray_cylinder(origin, direction, (x, enemy.y, z), radius, half_height)
+                    if hit is not None and hit[0] <= max_distance and (best is None or hit[0] < best[0]):
+                        best = (hit[0], hit[1], enemy)
+        if step == [0, 0]:
+            break  # Straight up or down, only the starting cells matter
+        axis = 0 if t_max[0] < t_max[1] else 1
+        t_cell = t_max[axis]
+        cell[axis] += step[axis]
+        t_max[axis] += t_delta[axis]
+
+    if best is None:
+        return None
+    t, normal, enemy = best
+    point = tuple(origin[a] + direction[a] * t for a in range(3))
+    return Hit(enemy, point, normal, t)
+
+
+def raycast_ground(origin, direction, max_distance, ground_y=GROUND_Y, extent=250):
+    """Return the Hit of a ray on the top of the train, or None."""
+    direction = _normalized(direction)
+    if direction is None or direction[1] >= 0 or origin[1] < ground_y:
+        return None
+    t = (ground_y - origin[1]) / direction[1]
+    point = (origin[0] + direction[0] * t, ground_y, origin[2] + direction[2] * t)
+    if t > max_distance or abs(point[0]) > extent or abs(point[2]) > extent:
+        return None
+    return Hit(None, point, (0.0, 1.0, 0.0), t)
+
+
+def hitscan(static, enemies, origin, direction, max_distance=200):
+    """Fire one ray. Returns the nearest Hit on a placed object, an enemy or the ground (entity None)."""
+    hits = [
+        static.raycast(origin, direction, max_distance) if static is not None else None,
+        raycast_enemies(enemies, origin, direction, max_distance),
+        raycast_ground(origin, direction, max_distance),
+    ]
+    hits = [hit for hit in hits if hit is not None]
+    return min(hits, key=lambda hit: hit.distance) if hits else None
@@ -0,0 +1,248 @@
+import argparse
+import hashlib
+import math
+import os
+import pickle
+import time
+from collections import namedtuple
+
+from block_mesher import ChunkMesher, chunk_of, is_transparent, CHUNK_SIZE
+from edit_journal import read_records
+from hitscan import StaticBVH
+from mesh_lod import read_obj
+from navigation import WalkGrid
+from replay import map_hash
+from spawn_director import SpatialHash, ring_points
+from voxel_grid import cell_of, position_of, BLOCK_HALF_EXTENT
+
+# Offline map baking.
+#
+# Loading map.dbo means building an entity, a collider and maybe an Audio for
+# every object, then meshing the chunks and rasterizing the navigation grid.
+# Baking does all of that work once and writes the result to <map>.baked:
+#
+#   chunks          per chunk, the merged meshes of its blocks (one per block
+#                   type) and the collision boxes of everything axis aligned
+#                   in it, tagged with the object id they came from
+#   objects         what the chunk meshes can't draw (rotated models, flames),
+#                   with the world bounds of its model
+#   bvh             a StaticBVH over the bounds of every solid object, whose
+#                   items are the object ids
+#   obstacles       (object id, x, z) of everything enemies walk around
+#   sight_blockers  positions of the opaque objects, for line of sight
+#   walk_grid       the navigation WalkGrid, already rasterized
+#   spawn_points    the free points of the spawn ring, in grid order
+#   emitters        the objects with a sound attached
+#
+# Every chunk keeps a hash of the blocks in it and around it: their cells, types
+# and colours, not their object ids, which compacting the journal renumbers.
+# A rebake starts from the previous package and only meshes the chunks whose
+# hash changed. A rebake still goes through every record, so the editor only
+# bakes when its Bake button is pressed, and the game rebakes a package that is
+# stale when it loads it. The collision boxes are cheap and carry the ids, so
+# they are always rebuilt.
+
+BAKE_VERSION = 2
+OBSTACLE_HEIGHT = 9  # Objects whose centre is lower than this block enemies
+CUBE_EXTENT = 0.5  # Half size of ursina's cube, used for unknown types
+
+# Block types and their models, the same as models_data in the games
+BLOCK_MODELS = {
+    'box': 'box.obj',
+    'sand': 'sand.obj',
+    'trunk': 'trunk.obj',
+    'leaf': 'leaf.obj',
+    'glass': 'glass.obj',
+    'brick': 'brick.obj',
+    'flame': None,
+}
+
+BakedChunk = namedtuple('BakedChunk', ['digest', 'meshes', 'boxes'])
+# merged is True when the object's box is part of its chunk's collision boxes
+BakedObject = namedtuple('BakedObject', ['object_id', 'obj_type', 'position', 'rotation', 'color', 'bounds', 'merged'])
+Emitter = namedtuple('Emitter', ['object_id', 'position', 'sound_file', 'play_on_awake', 'loop'])
+BakedMap = namedtuple('BakedMap', [
+    'version', 'source', 'count', 'chunks', 'objects', 'bvh', 'obstacles',
+    'sight_blockers', 'walk_grid', 'spawn_points', 'emitters',
+])
+
+_model_points = {}  # OBJ path -> vertex positions in ursina's coordinates
+
+
+def baked_path(map_path):
+    return map_path + '.baked'
+
+
+def is_grid_rotation(rotation):
+    return rotation[0] == 0 and rotation[2] == 0 and rotation[1] % 90 == 0
+
+
+def is_axis_aligned(rotation):
+    """True when a rotation only swaps axes around, so the world bounds are the exact box."""
+    return all(angle % 90 == 0 for angle in rotation)
+
+
+def is_block(obj_type, position, rotation, models):
+    """True when a record is a grid-aligned block the chunk meshes can draw."""
+    if models.get(obj_type) is None or not is_grid_rotation(rotation):
+        return False
+    return math.dist(position, position_of(cell_of(position))) < 0.01
+
+
+def rotate(point, rotation):
+    """Rotate a point by an ursina (x, y, z) rotation in degrees: roll, then pitch, then heading."""
+    x, y, z = point
+    pitch, heading, roll = (math.radians(angle) for angle in rotation)
+    x, y = x * math.cos(roll) + y * math.sin(roll), -x * math.sin(roll) + y * math.cos(roll)
+    y, z = y * math.cos(pitch) - z * math.sin(pitch), y * math.sin(pitch) + z * math.cos(pitch)
+    x, z = x * math.cos(heading) + z * math.sin(heading), -x * math.sin(heading) + z * math.cos(heading)
+    return (x, y, z)
+
+
+def _points(model):
+    if model not in _model_points:
+        if model == 'cube':
+            e = CUBE_EXTENT
+            _model_points[model] = [(x, y, z) for x in (-e, e) for y in (-e, e) for z in (-e, e)]
+        else:
+            # OBJ is right-handed, ursina mirrors z when it loads one
+            _model_points[model] = [(x, y, -z) for x, y, z in read_obj(model).positions]
+    return _model_points[model]
+
+
+def model_bounds(model, position, rotation):
+    """Return the world (low, high) of a model placed at a position and rotation."""
+    points = [rotate(point, rotation) for point in _points(model)]
+    if not points:
+        return None
+    low = tuple(position[a] + min(point[a] for point in points) for a in range(3))
+    high = tuple(position[a] + max(point[a] for point in points) for a in range(3))
+    return (low, high)
+
+
+def _digest(value):
+    return hashlib.sha1(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)).digest()
+
+
+def bake_map(records, models=BLOCK_MODELS, source=b'', previous=None):
+    """Bake an object id -> record dict. Chunks whose blocks match the previous BakedMap are reused."""
+    mesher = ChunkMesher()
+    chunk_blocks = {}  # chunk -> [(object id, cell, obj_type, color)]
+    chunk_boxes = {}  # chunk -> [(object id, low, high)] of the axis aligned objects that aren't blocks
+    objects = []
+    obstacles = []
+    sight_blockers = []
+    emitters = []
+    for object_id, (obj_type, position, rotation, color, sound_file, play_on_awake, loop) in records.items():
+        # Plain tuples, the records may hold ursina vectors and colours
+        position = tuple(float(value) for value in position)
+        rotation = tuple(float(value) for value in rotation)
+        color = tuple(float(value) for value in color)
+        flame = obj_type == 'flameparticlesystem'
+
+        if is_block(obj_type, position, rotation, models):
+            cell = cell_of(position)
+            mesher.set_block(cell, obj_type, color)
+            chunk_blocks.setdefault(chunk_of(cell), []).append((object_id, cell, obj_type, color))
+        else:
+            if flame or (obj_type in models and models[obj_type] is None):
+                bounds = None  # Particles and plain textures have nothing to collide with
+            else:
+                bounds = model_bounds(models.get(obj_type, 'cube'), position, rotation)
+            merged = bounds is not None and is_axis_aligned(rotation)
+            if merged:
+                chunk_boxes.setdefault(chunk_of(cell_of(position)), []).append((object_id, bounds[0], bounds[1]))
+            objects.append(BakedObject(object_id, obj_type, position, rotation, color, bounds, merged))
+
+        if not flame:
+            if position[1] < OBSTACLE_HEIGHT:
+                obstacles.append((object_id, position[0], position[2]))
+            if not is_transparent(obj_type):
+                sight_blockers.append(position)
+        if sound_file:
+            emitters.append(Emitter(object_id, position, sound_file, play_on_awake, loop))
+
+    # A chunk's faces depend on the blocks just across its border, so they're part of its hash
+    chunks = {}
+    h = BLOCK_HALF_EXTENT
+    for chunk in chunk_blocks.keys() | chunk_boxes.keys():
+        blocks = chunk_blocks.get(chunk, [])
+        low_x, low_z = chunk[0] * CHUNK_SIZE - 2, chunk[1] * CHUNK_SIZE - 2
+        high_x, high_z = low_x + CHUNK_SIZE + 4, low_z + CHUNK_SIZE + 4
+        border = [
+            block[1:]
+            for dx in (-1, 0, 1) for dz in (-1, 0, 1) if dx or dz
+            for block in chunk_blocks.get((chunk[0] + dx, chunk[1] + dz), ())
+            if low_x <= block[1][0] < high_x and low_z <= block[1][2] < high_z
+        ]
+        digest = _digest((sorted(block[1:] for block in blocks), sorted(border)))
+        old = previous.chunks.get(chunk) if previous is not None else None
+        meshes = old.meshes if old is not None and old.digest == digest else mesher.build_chunk(chunk)
+
+        boxes = []
+        for object_id, cell, obj_type, color in blocks:
+            x, y, z = position_of(cell)
+            boxes.append((object_id, (x - h, y - h, z - h), (x + h, y + h, z + h)))
+        chunks[chunk] = BakedChunk(digest, meshes, boxes + chunk_boxes.get(chunk, []))
+
+    # Rebuilt whole, it's cheap next to meshing and a BVH doesn't update well piecewise
+    solids = [box for baked in chunks.values() for box in baked.boxes]
+    solids.extend((baked.object_id,) + baked.bounds for baked in objects if baked.bounds and not baked.merged)
+
+    obstacle_hash = SpatialHash(4)
+    for object_id, x, z in obstacles:
+        obstacle_hash.insert(object_id, x, z)
+    walk_grid = WalkGrid.from_obstacles([(x, z) for object_id, x, z in obstacles])
+
+    return BakedMap(BAKE_VERSION, source, len(records), chunks, objects, StaticBVH(solids), obstacles,
+                    sight_blockers, walk_grid, ring_points(obstacle_hash), emitters)
+
+
+def read_baked(path):
+    """Return the BakedMap in a file, or None if it's missing or from another version."""
+    try:
+        with open(path, 'rb') as file:
+            package = pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+        return None
+    if not isinstance(package, BakedMap) or package.version != BAKE_VERSION:
+        return None
+    return package
+
+
+def write_baked(path, package):
+    # Written aside and moved in place, a crash never leaves a torn package
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        pickle.dump(package, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+
+def bake_records(map_path, records, models=BLOCK_MODELS, previous=None):
+    """Bake the records of a saved map into its package, reusing the unchanged chunks of previous."""
+    start = time.perf_counter()
+    package = bake_map(records, models, map_hash(map_path), previous)
+    write_baked(baked_path(map_path), package)
+    rebuilt = sum(1 for chunk, baked in package.chunks.items()
+                  if previous is None or chunk not in previous.chunks or previous.chunks[chunk].meshes is not baked.meshes)
+    print(f"Baked {map_path}: {len(package.chunks)} chunks ({rebuilt} rebuilt), "
+          f"{len(package.objects)} loose objects in {time.perf_counter() - start:.2f}s")
+    return package
+
+
+def load_baked(map_path, models=BLOCK_MODELS):
+    """Return the BakedMap of a map, rebaking what changed first if the package is missing or stale."""
+    package = read_baked(baked_path(map_path))
+    if package is not None and package.source == map_hash(map_path):
+        return package
+    return bake_records(map_path, read_records(map_path), models, package)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bake a map into a package the game loads directly')
+    parser.add_argument('map', nargs='?', default='map.dbo')
+    parser.add_argument('--full', action='store_true', help='rebuild every chunk instead of only the changed ones')
+    args = parser.parse_args()
+
+    previous = None if args.full else read_baked(baked_path(args.map))
+    bake_records(args.map, read_records(args.map), previous=previous)
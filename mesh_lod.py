@@ -0,0 +1,330 @@
+import hashlib
+import heapq
+import math
+import os
+from collections import namedtuple
+
+# Level of detail generation for OBJ props.
+#
+# Every OBJ gets a few simplified copies made with quadric edge collapse
+# (Garland-Heckbert): each vertex accumulates the planes of its faces as a
+# quadric, and the edge whose collapse adds the least squared distance to
+# those planes is collapsed first. Open edges get an extra plane at right
+# angles to their face so silhouettes hold, and collapses that would flip a
+# face are skipped. The levels are written next to a hash of the source file
+# in lod_cache/, so they are only rebuilt when the model changes.
+#
+# At runtime a prop picks its level from how big it is on screen, with a
+# hysteresis band around each threshold so it doesn't flicker between two
+# levels at the boundary.
+
+CACHE_DIR = 'lod_cache'
+LOD_RATIOS = (0.5, 0.25, 0.1)  # Fraction of the triangles kept by each level after the first
+SCREEN_THRESHOLDS = (0.25, 0.1, 0.04)  # Projected size below which each next level is used
+HYSTERESIS = 0.2  # Relative band around a threshold where the current level is kept
+BOUNDARY_WEIGHT = 100.0  # Weight of the planes that pin open edges
+
+ObjMesh = namedtuple('ObjMesh', ['positions', 'uvs', 'faces', 'mtllib', 'material'])
+MeshData = namedtuple('MeshData', ['vertices', 'triangles', 'uvs', 'normals'])
+
+
+def read_obj(path):
+    """Read the positions, texture coordinates and triangulated faces of an OBJ.
+
+    Faces are ((a, b, c), (uv_a, uv_b, uv_c) or None) with zero-based indices.
+    """
+    positions = []
+    uvs = []
+    faces = []
+    mtllib = None
+    material = None
+    with open(path) as file:
+        for line in file:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == 'v':
+                positions.append(tuple(float(value) for value in parts[1:4]))
+            elif parts[0] == 'vt':
+                uvs.append(tuple(float(value) for value in parts[1:3]))
+            elif parts[0] == 'f':
+                corners = []
+                for corner in parts[1:]:
+                    indices = corner.split('/')
+                    position = int(indices[0])
+                    uv = int(indices[1]) if len(indices) > 1 and indices[1] else None
+                    # Negative indices count back from the end
+                    position = position - 1 if position > 0 else len(positions) + position
+                    if uv is not None:
+                        uv = uv - 1 if uv > 0 else len(uvs) + uv
+                    corners.append((position, uv))
+                # Fan triangulation of quads and polygons
+                for i in range(1, len(corners) - 1):
+                    triangle = (corners[0], corners[i], corners[i + 1])
+                    face_uvs = tuple(uv for position, uv in triangle)
+                    faces.append((tuple(position for position, uv in triangle), None if None in face_uvs else face_uvs))
+            elif parts[0] == 'mtllib' and mtllib is None:
+                mtllib = line.split(None, 1)[1].strip()
+            elif parts[0] == 'usemtl' and material is None:
+                material = line.split(None, 1)[1].strip()
+    return ObjMesh(positions, uvs, faces, mtllib, material)
+
+
+def write_obj(path, mesh, mtllib=None):
+    lines = ['# Generated by mesh_lod.py']
+    if mtllib or mesh.mtllib:
+        lines.append(f'mtllib {mtllib or mesh.mtllib}')
+    if mesh.material:
+        lines.append(f'usemtl {mesh.material}')
+    lines.extend(f'v {x:.6f} {y:.6f} {z:.6f}' for x, y, z in mesh.positions)
+    lines.extend(f'vt {u:.6f} {v:.6f}' for u, v in mesh.uvs)
+    for corners, face_uvs in mesh.faces:
+        if face_uvs is None:
+            lines.append('f ' + ' '.join(str(a + 1) for a in corners))
+        else:
+            lines.append('f ' + ' '.join(f'{a + 1}/{t + 1}' for a, t in zip(corners, face_uvs)))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
+
+def _sub(a, b):
+    return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+
+def _dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+def _face_normal(p0, p1, p2):
+    """Return the unnormalised normal of a triangle (its length is twice the area)."""
+    return _cross(_sub(p1, p0), _sub(p2, p0))
+
+
+def _plane_quadric(normal, point, weight):
+    # Quadric of the plane through point, as the 10 unique entries of the symmetric 4x4 matrix
+    length = math.sqrt(_dot(normal, normal))
+    if length == 0:
+        return (0.0,) * 10
+    a, b, c = (n / length for n in normal)
+    d = -(a * point[0] + b * point[1] + c * point[2])
+    return tuple(weight * value for value in (a * a, a * b, a * c, a * d, b * b, b * c, b * d, c * c, c * d, d * d))
+
+
+def _add_quadrics(q, r):
+    return tuple(x + y for x, y in zip(q, r))
+
+
+def _quadric_error(q, p):
+    x, y, z = p
+    return (q[0] * x * x + 2 * q[1] * x * y + 2 * q[2] * x * z + 2 * q[3] * x
+            + q[4] * y * y + 2 * q[5] * y * z + 2 * q[6] * y
+            + q[7] * z * z + 2 * q[8] * z + q[9])
+
+
+def _optimal_point(q):
+    # Solve for the point minimising the quadric, None if the system is singular
+    a = ((q[0], q[1], q[2]), (q[1], q[4], q[5]), (q[2], q[5], q[7]))
+    rhs = (-q[3], -q[6], -q[8])
+    det = _dot(a[0], _cross(a[1], a[2]))
+    if abs(det) < 1e-9:
+        return None
+    # Cramer's rule with the symmetric matrix
+    cols = list(zip(*a))
+    result = []
+    for i in range(3):
+        replaced = [list(col) for col in cols]
+        replaced[i] = list(rhs)
+        result.append(_dot(replaced[0], _cross(replaced[1], replaced[2])) / det)
+    return tuple(result)
+
+
+def simplify(mesh, ratio):
+    """Return a copy of an ObjMesh with about ratio of its triangles left."""
+    positions = [list(p) for p in mesh.positions]
+    faces = [[list(corners), list(face_uvs) if face_uvs else None] for corners, face_uvs in mesh.faces]
+    target = max(4, int(len(faces) * ratio))
+
+    quadrics = [(0.0,) * 10 for _ in positions]
+    vertex_faces = [set() for _ in positions]
+    edge_faces = {}
+    for f, (corners, face_uvs) in enumerate(faces):
+        normal = _face_normal(*(positions[i] for i in corners))
+        quadric = _plane_quadric(normal, positions[corners[0]], math.sqrt(_dot(normal, normal)) / 2)
+        for i in corners:
+            quadrics[i] = _add_quadrics(quadrics[i], quadric)
+            vertex_faces[i].add(f)
+        for k in range(3):
+            edge = tuple(sorted((corners[k], corners[(k + 1) % 3])))
+            edge_faces.setdefault(edge, []).append(f)
+
+    # Pin open edges with a plane through the edge at right angles to its face
+    for (a, b), owners in edge_faces.items():
+        if len(owners) != 1:
+            continue
+        corners = faces[owners[0]][0]
+        face_normal = _face_normal(*(positions[i] for i in corners))
+        side_normal = _cross(_sub(positions[b], positions[a]), face_normal)
+        quadric = _plane_quadric(side_normal, positions[a], BOUNDARY_WEIGHT)
+        quadrics[a] = _add_quadrics(quadrics[a], quadric)
+        quadrics[b] = _add_quadrics(quadrics[b], quadric)
+
+    versions = [0] * len(positions)
+    alive_faces = [True] * len(faces)
+    face_count = len(faces)
+    heap = []
+
+    def push_edge(a, b):
+        q = _add_quadrics(quadrics[a], quadrics[b])
+        candidates = [tuple(positions[a]), tuple(positions[b]),
+                      tuple((positions[a][i] + positions[b][i]) / 2 for i in range(3))]
+        optimal = _optimal_point(q)
+        if optimal is not None:
+            candidates.append(optimal)
+        cost, point = min((_quadric_error(q, p), p) for p in candidates)
+        heapq.heappush(heap, (cost, a, b, versions[a], versions[b], point))
+
+    for a, b in edge_faces:
+        push_edge(a, b)
+
+    def flips(vertex, point, skip):
+        # Would moving vertex to point turn any of its other faces over?
+        for f in vertex_faces[vertex]:
+            if f in skip:
+                continue
+            corners = faces[f][0]
+            before = _face_normal(*(positions[i] for i in corners))
+            after = _face_normal(*(point if i == vertex else positions[i] for i in corners))
+            if _dot(before, after) <= 0.2 * math.sqrt(_dot(before, before) * _dot(after, after)):
+                return True
+        return False
+
+    while face_count > target and heap:
+        cost, a, b, version_a, version_b, point = heapq.heappop(heap)
+        if version_a != versions[a] or version_b != versions[b]:
+            continue  # Stale, one of the ends changed since this was pushed
+        shared = vertex_faces[a] & vertex_faces[b]
+        if not shared or flips(a, point, shared) or flips(b, point, shared):
+            continue
+
+        # Collapse b into a
+        for f in shared:
+            alive_faces[f] = False
+            face_count -= 1
+            for i in faces[f][0]:
+                if i != a and i != b:
+                    vertex_faces[i].discard(f)
+        vertex_faces[a] -= shared
+        for f in vertex_faces[b] - shared:
+            corners = faces[f][0]
+            corners[corners.index(b)] = a
+            vertex_faces[a].add(f)
+        vertex_faces[b] = set()
+        positions[a] = list(point)
+        quadrics[a] = _add_quadrics(quadrics[a], quadrics[b])
+        versions[a] += 1
+        versions[b] += 1
+
+        neighbours = set()
+        for f in vertex_faces[a]:
+            neighbours.update(faces[f][0])
+        neighbours.discard(a)
+        for n in neighbours:
+            push_edge(min(a, n), max(a, n))
+
+    # Compact the surviving vertices and faces
+    remap = {}
+    new_positions = []
+    new_faces = []
+    for f, (corners, face_uvs) in enumerate(faces):
+        if not alive_faces[f]:
+            continue
+        for i in corners:
+            if i not in remap:
+                remap[i] = len(new_positions)
+                new_positions.append(tuple(positions[i]))
+        new_faces.append((tuple(remap[i] for i in corners), tuple(face_uvs) if face_uvs else None))
+    return ObjMesh(new_positions, list(mesh.uvs), new_faces, mesh.mtllib, mesh.material)
+
+
+def _hash_file(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()[:12]
+
+
+def generate_lods(path, ratios=LOD_RATIOS, cache_dir=CACHE_DIR):
+    """Return the paths of an OBJ's levels, the original first. Missing levels are built and cached."""
+    os.makedirs(cache_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    digest = _hash_file(path)
+    paths = [path]
+    mesh = None
+    for level, ratio in enumerate(ratios, start=1):
+        lod_path = os.path.join(cache_dir, f'{stem}.{digest}.lod{level}.obj')
+        if not os.path.exists(lod_path):
+            if mesh is None:
+                mesh = read_obj(path)
+            # Each level starts from the previous one, it's cheaper and keeps them consistent
+            source = read_obj(paths[-1]) if level > 1 else mesh
+            lod = simplify(source, ratio * len(mesh.faces) / max(1, len(source.faces)))
+            mtllib = os.path.relpath(os.path.join(os.path.dirname(path), mesh.mtllib), cache_dir) if mesh.mtllib else None
+            write_obj(lod_path, lod, mtllib)
+        paths.append(lod_path)
+    return paths
+
+
+def mesh_data(mesh):
+    """Flatten an ObjMesh into per-corner vertices with face normals, in Ursina's coordinates.
+
+    OBJ is right-handed and Ursina left-handed, so z is mirrored, which keeps
+    the OBJ winding facing out.
+    """
+    vertices = []
+    uvs = []
+    normals = []
+    triangles = []
+    for corners, face_uvs in mesh.faces:
+        points = [(p[0], p[1], -p[2]) for p in (mesh.positions[i] for i in corners)]
+        normal = _face_normal(*points)
+        length = math.sqrt(_dot(normal, normal)) or 1.0
+        normal = tuple(-n / length for n in normal)
+        start = len(vertices)
+        vertices.extend(points)
+        normals.extend([normal] * 3)
+        if face_uvs:
+            uvs.extend(mesh.uvs[t] for t in face_uvs)
+        else:
+            uvs.extend([(0.0, 0.0)] * 3)
+        triangles.append((start, start + 1, start + 2))
+    return MeshData(vertices, triangles, uvs, normals)
+
+
+def load_lods(path, ratios=LOD_RATIOS, cache_dir=CACHE_DIR):
+    """Return the MeshData of every level of an OBJ, building missing levels first."""
+    return [mesh_data(read_obj(lod_path)) for lod_path in generate_lods(path, ratios, cache_dir)]
+
+
+def bounding_radius(data):
+    """Radius of a MeshData around its local origin."""
+    return math.sqrt(max((_dot(v, v) for v in data.vertices), default=0.0))
+
+
+def projected_size(radius, distance, fov):
+    """Fraction of the screen height covered by a sphere at a distance, fov in degrees."""
+    if distance <= radius:
+        return 1.0
+    return radius / (distance * math.tan(math.radians(fov) / 2))
+
+
+def select_level(level, size, thresholds=SCREEN_THRESHOLDS, hysteresis=HYSTERESIS):
+    """Return the level to use for a projected size, given the current level."""
+    while level < len(thresholds) and size < thresholds[level] * (1 - hysteresis):
+        level += 1
+    while level > 0 and size > thresholds[level - 1] * (1 + hysteresis):
+        level -= 1
+    return level
@@ -0,0 +1,200 @@
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Recording and export of monitor.py samples.
+#
+# A recording is an append-only columnar file: a header naming the columns,
+# followed by blocks. Each block stores its row count and then every column as
+# a packed run of little-endian doubles, so a block can be appended without
+# touching anything already on disk and a crash only loses the unflushed rows.
+
+MAGIC = b'SUPEMETR'
+VERSION = 1
+BLOCK_HEADER = struct.Struct('<I')
+
+
+def _to_bytes(values):
+    data = array('d', values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
+def _from_bytes(raw):
+    data = array('d')
+    data.frombytes(raw)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data
+
+
+class ColumnarRecorder:
+    """Buffers samples and appends them to a columnar file in blocks."""
+
+    def __init__(self, path, columns, flush_interval=5.0, block_rows=256):
+        self.path = path
+        self.columns = list(columns)
+        self.flush_interval = flush_interval
+        self.block_rows = block_rows
+        self.buffer = {name: [] for name in self.columns}
+        self.rows = 0
+        self.last_flush = time.time()
+
+        # Keep appending to an earlier recording if it has the same columns
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            existing_columns, _ = _read_header(path)
+            if existing_columns != self.columns:
+                raise ValueError(f'{path} was recorded with different columns: {existing_columns}')
+            # Cut off a block a crash left half written, or everything after it would misread
+            self.file = open(path, 'r+b')
+            self.file.truncate(_end_of_blocks(path))
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, 'wb')
+            header = json.dumps(self.columns).encode()
+            self.file.write(MAGIC + struct.pack('<II', VERSION, len(header)) + header)
+            self.file.flush()
+
+    def append(self, sample):
+        """Add one row, missing columns are recorded as NaN."""
+        for name in self.columns:
+            value = sample.get(name)
+            self.buffer[name].append(float('nan') if value is None else float(value))
+        self.rows += 1
+
+        if self.rows >= self.block_rows or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as one block and push it to disk."""
+        self.last_flush = time.time()
+        if self.rows == 0:
+            return
+
+        block = [BLOCK_HEADER.pack(self.rows)]
+        for name in self.columns:
+            block.append(_to_bytes(self.buffer[name]))
+            self.buffer[name].clear()
+        self.rows = 0
+
+        self.file.write(b''.join(block))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+def _read_header(path):
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a metrics recording')
+        version, header_size = struct.unpack('<II', file.read(8))
+        if version != VERSION:
+            raise ValueError(f'Unsupported recording version {version}')
+        columns = json.loads(file.read(header_size))
+        return columns, file.tell()
+
+
+def _blocks(path):
+    """Yield (rows, body, end offset) of every complete block of a recording."""
+    columns, offset = _read_header(path)
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        while True:
+            raw = file.read(BLOCK_HEADER.size)
+            if len(raw) < BLOCK_HEADER.size:
+                break
+            rows = BLOCK_HEADER.unpack(raw)[0]
+            body = file.read(rows * 8 * len(columns))
+            if len(body) < rows * 8 * len(columns):
+                break  # Block cut short by a crash, drop it
+            yield rows, body, file.tell()
+
+
+def _end_of_blocks(path):
+    """Return the offset just past the last complete block."""
+    end = _read_header(path)[1]
+    for rows, body, end in _blocks(path):
+        pass
+    return end
+
+
+def read_recording(path):
+    """Load a recording into a dict of column name -> array of values."""
+    columns, _ = _read_header(path)
+    data = {name: array('d') for name in columns}
+    for rows, body, _ in _blocks(path):
+        for i, name in enumerate(columns):
+            data[name].extend(_from_bytes(body[i * rows * 8:(i + 1) * rows * 8]))
+    return data
+
+
+def _format_value(value):
+    # OpenMetrics spells the non-finite values +Inf, -Inf and NaN
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class MetricsServer:
+    """Serves the latest sample as OpenMetrics text on http://host:port/metrics."""
+
+    def __init__(self, port=9464, host='127.0.0.1', prefix='supe_'):
+        self.prefix = prefix
+        self.sample = {}
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep scrapes out of the console
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def update(self, sample):
+        with self.lock:
+            self.sample = dict(sample)
+
+    def render(self):
+        """Format the current sample as OpenMetrics gauges."""
+        with self.lock:
+            sample = self.sample
+        lines = []
+        for name, value in sample.items():
+            if value is None:
+                continue
+            metric = self.prefix + name
+            value = float(value)
+            lines.append(f'# TYPE {metric} gauge')
+            lines.append(f'{metric} {_format_value(value)}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
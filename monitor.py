@@ -2,9 +2,21 @@ import psutil
 import GPUtil
 import time
 import threading
+import argparse
+import atexit
 import customtkinter as ctk
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from telemetry import open_reader
+from metrics_export import ColumnarRecorder, MetricsServer
+
+# Command line options for recording and exporting samples
+parser = argparse.ArgumentParser(description='CPU, GPU and engine monitor')
+parser.add_argument('--record', metavar='FILE', help='append every sample to a columnar recording file')
+parser.add_argument('--flush-interval', type=float, default=5.0, help='seconds between flushes of the recording')
+parser.add_argument('--metrics-port', type=int, help='serve OpenMetrics text on http://127.0.0.1:PORT/metrics')
+parser.add_argument('--headless', action='store_true', help='record/export only, without the graph window')
+args = parser.parse_args()
 
 # Function to get CPU and GPU usage for "example.exe"
 def get_usage():
@@ -22,34 +34,110 @@ def get_usage():
     
     return cpu_usage, gpu_usage
 
+# Function to get the engine counters the game publishes every frame
+def get_telemetry():
+    global telemetry_reader
+    if telemetry_reader is None:
+        telemetry_reader = open_reader()  # Game may have started after the monitor
+        if telemetry_reader is None:
+            return None
+
+    records = telemetry_reader.read_new()
+    if not records:
+        return None
+
+    # Average the frames of the last second, keep the counts of the newest one
+    sample = dict(records[-1])
+    sample['frame_time'] = sum(r['frame_time'] for r in records) / len(records) * 1000  # In ms
+    return sample
+
+# Function to take one sample and hand it to the recorder and metrics endpoint
+def collect_sample():
+    cpu, gpu = get_usage()
+    sample = {'timestamp': time.time(), 'cpu_usage': cpu, 'gpu_usage': gpu}
+
+    engine = get_telemetry()
+    for key in engine_labels:
+        sample[key] = engine[key] if engine else None
+
+    if recorder:
+        recorder.append(sample)
+    if metrics_server:
+        metrics_server.update(sample)
+    return sample
+
 # Function to update graph dynamically
 def update_graph():
     while True:
-        cpu, gpu = get_usage()
+        sample = collect_sample()
         x_data.append(len(x_data))
-        cpu_data.append(cpu)
-        gpu_data.append(gpu)
-        
+        cpu_data.append(sample['cpu_usage'])
+        gpu_data.append(sample['gpu_usage'])
+
+        for key in engine_data:
+            engine_data[key].append(sample[key] or 0)
+
         # Update plot
         ax.clear()
         ax.plot(x_data, cpu_data, label='CPU Usage (%)')
         ax.plot(x_data, gpu_data, label='GPU Usage (%)')
-        ax.set_xlabel('Time (s)')
         ax.set_ylabel('Usage (%)')
         ax.legend(loc='upper right')
+
+        # Engine counters from the game's telemetry
+        engine_ax.clear()
+        for key, values in engine_data.items():
+            engine_ax.plot(x_data, values, label=engine_labels[key])
+        engine_ax.set_xlabel('Time (s)')
+        engine_ax.set_ylabel('Engine')
+        engine_ax.legend(loc='upper right', fontsize='small')
         
         # Update canvas
         canvas.draw()
 
         time.sleep(1)
 
+# Engine telemetry published by the game
+telemetry_reader = None
+engine_labels = {
+    'frame_time': 'Frame Time (ms)',
+    'entities': 'Entities',
+    'placed_objects': 'Placed Objects',
+    'player_bullets': 'Player Bullets',
+    'enemy_bullets': 'Enemy Bullets',
+    'enemies': 'Enemies',
+    'particles': 'Particles',
+    'map_load_progress': 'Map Load (0-1)',
+}
+engine_data = {key: [] for key in engine_labels}
+
+# Optional recording file and metrics endpoint
+recorder = None
+if args.record:
+    recorder = ColumnarRecorder(args.record, ['timestamp', 'cpu_usage', 'gpu_usage'] + list(engine_labels), flush_interval=args.flush_interval)
+    atexit.register(recorder.close)
+
+metrics_server = None
+if args.metrics_port:
+    metrics_server = MetricsServer(args.metrics_port)
+    print(f'Serving metrics on http://127.0.0.1:{args.metrics_port}/metrics')
+
+# Capture without a window for long sessions
+if args.headless:
+    try:
+        while True:
+            collect_sample()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        raise SystemExit
+
 # Create custom Tkinter window
 app = ctk.CTk()
-app.geometry("600x400")
+app.geometry("600x600")
 app.title("CPU and GPU Usage Monitor")
 
 # Graph initialization
-fig, ax = plt.subplots()
+fig, (ax, engine_ax) = plt.subplots(2, 1, sharex=True)
 x_data, cpu_data, gpu_data = [], [], []
 
 # Embed graph in Tkinter window
@@ -0,0 +1,170 @@
+import math
+from array import array
+from collections import deque
+
+# Flow field navigation for the enemies of game3DUFPSN.py.
+#
+# The loaded map is rasterized once into a walkability grid over the train:
+# every cell a placed object (grown by the enemy's radius) overlaps is
+# blocked. Only objects low enough for an enemy to walk into count, so
+# blocks stacked higher up don't block the ground under them.
+#
+# One breadth-first search from the player's cell gives every cell its step
+# count to the player, shared by all enemies. An enemy steers towards the
+# neighbour of its cell with the lowest count, which is eight lookups however
+# many enemies there are. The search only restarts when the player moves to
+# another cell, and it runs a budget of cells per tick into a second buffer,
+# so enemies keep using the previous field until the new one is finished and
+# no tick pays for the whole search. It also stops FIELD_RADIUS cells out,
+# past that enemies walk straight at the player.
+
+NAV_CELL = 2.0
+NAV_EXTENT = 250  # Half the size of the train
+AGENT_RADIUS = 0.5
+CELLS_PER_TICK = 2000
+FIELD_RADIUS = 80  # In cells
+UNREACHED = -1
+
+# Neighbour offsets, orthogonal ones first
+NEIGHBOURS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+
+class WalkGrid:
+    """Blocked and free cells of the ground."""
+
+    def __init__(self, cell_size=NAV_CELL, extent=NAV_EXTENT):
+        self.cell_size = cell_size
+        self.extent = extent
+        self.size = int(math.ceil(2 * extent / cell_size))
+        self.blocked = bytearray(self.size * self.size)
+
+    @classmethod
+    def from_obstacles(cls, positions, half_extent=1.0, cell_size=NAV_CELL, extent=NAV_EXTENT):
+        """Rasterize the (x, z) centres of square obstacles."""
+        grid = cls(cell_size, extent)
+        for x, z in positions:
+            grid.block_box(x, z, half_extent + AGENT_RADIUS)
+        return grid
+
+    def cell_of(self, x, z):
+        """Return the (i, j) cell of a position, clamped to the grid."""
+        i = int((x + self.extent) // self.cell_size)
+        j = int((z + self.extent) // self.cell_size)
+        return (min(max(i, 0), self.size - 1), min(max(j, 0), self.size - 1))
+
+    def center(self, i, j):
+        return (-self.extent + (i + 0.5) * self.cell_size, -self.extent + (j + 0.5) * self.cell_size)
+
+    def block_box(self, x, z, half_extent):
+        low_i, low_j = self.cell_of(x - half_extent, z - half_extent)
+        high_i, high_j = self.cell_of(x + half_extent, z + half_extent)
+        for i in range(low_i, high_i + 1):
+            row = i * self.size
+            for j in range(low_j, high_j + 1):
+                self.blocked[row + j] = 1
+
+    def is_blocked(self, i, j):
+        return self.blocked[i * self.size + j] == 1
+
+
+class FlowField:
+    """Step counts to the player over a WalkGrid, rebuilt a slice per tick."""
+
+    def __init__(self, grid, cells_per_tick=CELLS_PER_TICK, radius=FIELD_RADIUS):
+        self.grid = grid
+        self.cells_per_tick = cells_per_tick
+        self.radius = radius
+        self.distances = None  # Finished field, flattened like grid.blocked
+        self.goal = None  # Cell the finished field leads to
+        self.wanted = None  # Cell the player is in now
+        self._next = None  # Field being built
+        self._frontier = None
+        self._next_goal = None
+
+    def set_goal(self, x, z):
+        self.wanted = self.grid.cell_of(x, z)
+
+    def _start(self, goal):
+        size = self.grid.size
+        self._next = array('i', [UNREACHED]) * (size * size)
+        self._next_goal = goal
+        self._next[goal[0] * size + goal[1]] = 0
+        self._frontier = deque([goal])
+
+    def update(self):
+        """Spend this tick's budget on the field. Returns True when a new field was finished."""
+        if self._next is None:
+            if self.wanted is None or self.wanted == self.goal:
+                return False
+            self._start(self.wanted)
+
+        grid = self.grid
+        size = grid.size
+        blocked = grid.blocked
+        distances = self._next
+        frontier = self._frontier
+        gi, gj = self._next_goal
+        radius = self.radius
+        budget = self.cells_per_tick
+        while frontier and budget > 0:
+            budget -= 1
+            i, j = frontier.popleft()
+            step = distances[i * size + j] + 1
+            for di, dj in NEIGHBOURS:
+                ni = i + di
+                nj = j + dj
+                if ni < 0 or nj < 0 or ni >= size or nj >= size:
+                    continue
+                if abs(ni - gi) > radius or abs(nj - gj) > radius:
+                    continue
+                index = ni * size + nj
+                if blocked[index] or distances[index] != UNREACHED:
+                    continue
+                # No cutting corners past a blocked cell
+                if di and dj and (blocked[(i + di) * size + j] or blocked[i * size + j + dj]):
+                    continue
+                distances[index] = step
+                frontier.append((ni, nj))
+
+        if frontier:
+            return False
+        self.distances = distances
+        self.goal = self._next_goal
+        self._next = None
+        self._frontier = None
+        return True
+
+    def direction(self, x, z, target_x, target_z):
+        """Return the normalised (dx, dz) an enemy at (x, z) should walk in to reach the target."""
+        grid = self.grid
+        i, j = grid.cell_of(x, z)
+        size = grid.size
+        distances = self.distances
+        here = distances[i * size + j] if distances is not None else UNREACHED
+        if here <= 1:
+            # No field yet, outside it, or next to the player: walk straight at them
+            return _normalized(target_x - x, target_z - z)
+
+        best = None
+        best_distance = here
+        for di, dj in NEIGHBOURS:
+            ni = i + di
+            nj = j + dj
+            if 0 <= ni < size and 0 <= nj < size:
+                if di and dj and (grid.blocked[(i + di) * size + j] or grid.blocked[i * size + j + dj]):
+                    continue
+                distance = distances[ni * size + nj]
+                if distance != UNREACHED and distance < best_distance:
+                    best = (ni, nj)
+                    best_distance = distance
+        if best is None:
+            return _normalized(target_x - x, target_z - z)
+        cx, cz = grid.center(*best)
+        return _normalized(cx - x, cz - z)
+
+
+def _normalized(x, z):
+    length = math.sqrt(x * x + z * z)
+    if length == 0:
+        return (0.0, 0.0)
+    return (x / length, z / length)
@@ -0,0 +1,303 @@
+import asyncio
+import math
+import struct
+from collections import deque
+
+from game_rules import ENEMY_BULLET, PLAYER_BULLET, PlayerInput, bullet_position
+
+# Wire format of the dedicated server.
+#
+# Every datagram starts with a one byte packet type. Clients send their inputs
+# every tick, repeating the last few so a lost packet doesn't lose an input,
+# together with the newest snapshot tick they have received. The server
+# answers with snapshots of every body, delta-compressed against that acked
+# snapshot: only the fields that changed are sent, plus the ids of the bodies
+# that are gone. Before the first ack arrives the snapshot is sent in full,
+# against the empty baseline 0. The server keeps the last acked snapshot of
+# every client itself, so an ack that comes in late doesn't cost a full resend.
+#
+# A snapshot never goes out as one datagram bigger than PACKET_BUDGET: it is
+# split into parts that each apply to the same baseline. Removed ids come
+# first, then the client's own body and the bodies closest to it, so the parts
+# that matter most go out first. A client shows every part as it arrives but
+# only keeps and acks a snapshot once it has all of them.
+#
+# Snapshot fields are quantized before they are compared, so a body that
+# moved less than one step doesn't count as changed: positions are int16 in
+# 1/64 units (+-512), yaw is uint16 over a full turn, pitch int16 in 1/100
+# degrees and health a byte. Bullets are sent as their launch (see
+# game_rules.py), so a flying bullet costs nothing after its first snapshot.
+
+PROTOCOL_VERSION = 2
+
+CONNECT = 1
+WELCOME = 2
+INPUT = 3
+SNAPSHOT = 4
+DISCONNECT = 5
+
+HISTORY = 64  # Snapshots kept on both ends to delta against
+INPUT_REDUNDANCY = 3  # Inputs repeated in every input packet
+PACKET_BUDGET = 1200  # Bytes per snapshot datagram, stays under the usual 1280 byte MTU
+
+POSITION_SCALE = 64
+YAW_SCALE = 65536 / 360
+MOVE_SCALE = 127
+PITCH_SCALE = 100
+
+PACKET_TYPE = struct.Struct('<B')
+CONNECT_PACKET = struct.Struct('<BB')
+WELCOME_PACKET = struct.Struct('<BIIH')  # type, player id, server tick, tick rate
+INPUT_HEADER = struct.Struct('<BIB')  # type, acked snapshot tick, input count
+INPUT_ENTRY = struct.Struct('<IbbHhB')  # sequence, move x, move z, yaw, pitch, buttons
+SNAPSHOT_HEADER = struct.Struct('<BIIIBB')  # type, tick, baseline tick, last input sequence, part, part count
+SNAPSHOT_COUNTS = struct.Struct('<HH')  # changed bodies, removed bodies
+BODY_HEADER = struct.Struct('<IB')  # body id, mask of the fields that follow
+BODY_ID = struct.Struct('<I')
+
+# Quantized body fields in state order (kind, x, y, z, yaw, pitch, health, launch tick), one mask bit each
+FIELDS = [struct.Struct(code) for code in ('<B', '<h', '<h', '<h', '<H', '<h', '<B', '<I')]
+ALL_FIELDS = (1 << len(FIELDS)) - 1
+
+
+def _clamp(value, low, high):
+    return low if value < low else high if value > high else value
+
+
+def quantize_body(kind, x, y, z, yaw, pitch, health, launch_tick):
+    """Return a body's state as the integers that go on the wire."""
+    return (
+        kind,
+        _clamp(int(round(x * POSITION_SCALE)), -32768, 32767),
+        _clamp(int(round(y * POSITION_SCALE)), -32768, 32767),
+        _clamp(int(round(z * POSITION_SCALE)), -32768, 32767),
+        int(round(yaw * YAW_SCALE)) & 0xFFFF,
+        _clamp(int(round(pitch * PITCH_SCALE)), -32768, 32767),
+        _clamp(int(health), 0, 255),
+        launch_tick,
+    )
+
+
+def dequantize_body(values):
+    """Return a state tuple from the wire integers."""
+    kind, x, y, z, yaw, pitch, health, launch_tick = values
+    return (kind, x / POSITION_SCALE, y / POSITION_SCALE, z / POSITION_SCALE, yaw / YAW_SCALE, pitch / PITCH_SCALE, health, launch_tick)
+
+
+def resolve_body(values, tick, dt):
+    """Return (kind, x, y, z, yaw, pitch, health) of a dequantized body at tick."""
+    kind, x, y, z, yaw, pitch, health, launch_tick = values
+    if kind == PLAYER_BULLET or kind == ENEMY_BULLET:
+        x, y, z = bullet_position(kind, (x, y, z), yaw, pitch, launch_tick, tick, dt)
+    return (kind, x, y, z, yaw, pitch, health)
+
+
+def quantize_state(state):
+    return {body_id: quantize_body(*values) for body_id, values in state.items()}
+
+
+def delta_entries(state, baseline):
+    """Return ({body id: encoded fields}, [removed body id]) of what changed in a quantized state since baseline."""
+    changed = {}
+    for body_id, values in state.items():
+        old = baseline.get(body_id)
+        if old is None:
+            mask = ALL_FIELDS
+        elif old == values:
+            continue
+        else:
+            mask = 0
+            for i in range(len(FIELDS)):
+                if values[i] != old[i]:
+                    mask |= 1 << i
+        parts = [BODY_HEADER.pack(body_id, mask)]
+        for i, field in enumerate(FIELDS):
+            if mask & (1 << i):
+                parts.append(field.pack(values[i]))
+        changed[body_id] = b''.join(parts)
+    removed = [body_id for body_id in baseline if body_id not in state]
+    return changed, removed
+
+
+def pack_delta(changed, removed, order, budget=PACKET_BUDGET - SNAPSHOT_HEADER.size):
+    """Split a delta into snapshot bodies of at most budget bytes each.
+
+    Removed ids go first, then the changed bodies in order, so the first
+    bodies of order end up in the first part. There is always at least one part.
+    """
+    entries = [(False, BODY_ID.pack(body_id)) for body_id in removed]
+    entries.extend((True, changed[body_id]) for body_id in order)
+    parts = []
+    bodies, ids, size = [], [], SNAPSHOT_COUNTS.size
+    for is_body, entry in entries:
+        if size + len(entry) > budget and (bodies or ids):
+            parts.append(SNAPSHOT_COUNTS.pack(len(bodies), len(ids)) + b''.join(bodies) + b''.join(ids))
+            bodies, ids, size = [], [], SNAPSHOT_COUNTS.size
+        (bodies if is_body else ids).append(entry)
+        size += len(entry)
+    parts.append(SNAPSHOT_COUNTS.pack(len(bodies), len(ids)) + b''.join(bodies) + b''.join(ids))
+    return parts
+
+
+def apply_delta(state, data, offset):
+    """Apply the snapshot body at data[offset:] to a quantized state in place."""
+    changed_count, removed_count = SNAPSHOT_COUNTS.unpack_from(data, offset)
+    offset += SNAPSHOT_COUNTS.size
+    for _ in range(changed_count):
+        body_id, mask = BODY_HEADER.unpack_from(data, offset)
+        offset += BODY_HEADER.size
+        values = list(state.get(body_id, (0,) * len(FIELDS)))
+        for i, field in enumerate(FIELDS):
+            if mask & (1 << i):
+                values[i] = field.unpack_from(data, offset)[0]
+                offset += field.size
+        state[body_id] = tuple(values)
+    for _ in range(removed_count):
+        state.pop(BODY_ID.unpack_from(data, offset)[0], None)
+        offset += BODY_ID.size
+
+
+def encode_snapshot_header(tick, baseline_tick, input_sequence, part=0, part_count=1):
+    return SNAPSHOT_HEADER.pack(SNAPSHOT, tick, baseline_tick, input_sequence, part, part_count)
+
+
+def encode_inputs(ack_tick, inputs):
+    """Return an input packet with the last few inputs, oldest first."""
+    parts = [INPUT_HEADER.pack(INPUT, ack_tick, len(inputs))]
+    for player_input in inputs:
+        parts.append(INPUT_ENTRY.pack(
+            player_input.sequence,
+            _clamp(int(round(player_input.move_x * MOVE_SCALE)), -127, 127),
+            _clamp(int(round(player_input.move_z * MOVE_SCALE)), -127, 127),
+            int(round(player_input.yaw * YAW_SCALE)) & 0xFFFF,
+            _clamp(int(round(player_input.pitch * PITCH_SCALE)), -32768, 32767),
+            player_input.buttons & 0xFF,
+        ))
+    return b''.join(parts)
+
+
+def decode_inputs(data):
+    """Return (acked snapshot tick, [PlayerInput]) of an input packet."""
+    _, ack_tick, count = INPUT_HEADER.unpack_from(data, 0)
+    offset = INPUT_HEADER.size
+    inputs = []
+    for _ in range(count):
+        sequence, move_x, move_z, yaw, pitch, buttons = INPUT_ENTRY.unpack_from(data, offset)
+        offset += INPUT_ENTRY.size
+        inputs.append(PlayerInput(sequence, move_x / MOVE_SCALE, move_z / MOVE_SCALE, yaw / YAW_SCALE, pitch / PITCH_SCALE, buttons))
+    return ack_tick, inputs
+
+
+class SnapshotHistory:
+    """The last HISTORY quantized states by tick, tick 0 is the empty baseline."""
+
+    def __init__(self, size=HISTORY):
+        self.size = size
+        self.states = {0: {}}
+        self.ticks = deque()
+
+    def add(self, tick, state):
+        self.states[tick] = state
+        self.ticks.append(tick)
+        while len(self.ticks) > self.size:
+            self.states.pop(self.ticks.popleft(), None)
+
+    def get(self, tick):
+        return self.states.get(tick)
+
+
+class NetClient(asyncio.DatagramProtocol):
+    """Client end of the protocol: sends inputs, keeps the newest decoded snapshot."""
+
+    def __init__(self):
+        self.transport = None
+        self.player_id = None
+        self.tick_rate = None
+        self.connected = asyncio.Event()
+        self.history = SnapshotHistory()
+        self.latest_tick = 0  # Newest complete snapshot, the one we ack
+        self.partial = {}  # tick -> [state, parts still missing, input sequence] of snapshots not complete yet
+        self.bodies = {}  # body id -> quantized state of the newest snapshot, complete or not
+        self.bodies_tick = 0
+        self.input_ack = 0  # Newest input sequence the server has simulated
+        self.inputs = deque(maxlen=INPUT_REDUNDANCY)
+        self.sequence = 0
+        self.bytes_received = 0
+        self.snapshots_received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.bytes_received += len(data)
+        packet_type = data[0]
+        if packet_type == WELCOME:
+            _, self.player_id, _, self.tick_rate = WELCOME_PACKET.unpack_from(data)
+            self.connected.set()
+        elif packet_type == SNAPSHOT:
+            _, tick, baseline_tick, input_ack, part, part_count = SNAPSHOT_HEADER.unpack_from(data)
+            if tick <= self.latest_tick:
+                return  # Late or out of order
+            snapshot = self.partial.get(tick)
+            if snapshot is None:
+                baseline = self.history.get(baseline_tick)
+                if baseline is None:
+                    return  # Its baseline is already gone
+                snapshot = self.partial[tick] = [dict(baseline), set(range(part_count)), input_ack]
+            if part not in snapshot[1]:
+                return  # Repeated part
+            apply_delta(snapshot[0], data, SNAPSHOT_HEADER.size)
+            snapshot[1].discard(part)
+            if tick >= self.bodies_tick:
+                self.bodies = snapshot[0]
+                self.bodies_tick = tick
+                self.input_ack = input_ack
+            if not snapshot[1]:
+                self.history.add(tick, snapshot[0])
+                self.latest_tick = tick
+                self.snapshots_received += 1
+                # Older snapshots that are still missing parts can't be acked after this one
+                for old in [old for old in self.partial if old <= tick]:
+                    del self.partial[old]
+            elif len(self.partial) > HISTORY:
+                del self.partial[min(self.partial)]
+
+    def state(self):
+        """Return {body id: (kind, x, y, z, yaw, pitch, health)} of the newest snapshot."""
+        dt = 1 / self.tick_rate
+        return {body_id: resolve_body(dequantize_body(values), self.bodies_tick, dt) for body_id, values in self.bodies.items()}
+
+    async def connect(self, timeout=5.0):
+        """Keep asking to join until the server welcomes us."""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not self.connected.is_set():
+            self.transport.sendto(CONNECT_PACKET.pack(CONNECT, PROTOCOL_VERSION))
+            try:
+                await asyncio.wait_for(self.connected.wait(), 0.25)
+            except asyncio.TimeoutError:
+                if asyncio.get_running_loop().time() > deadline:
+                    raise ConnectionError('No answer from the server')
+        return self.player_id
+
+    def send_input(self, move_x=0.0, move_z=0.0, yaw=0.0, pitch=0.0, buttons=0):
+        """Send this tick's input along with the previous ones."""
+        self.sequence += 1
+        self.inputs.append(PlayerInput(self.sequence, move_x, move_z, yaw, pitch, buttons))
+        self.transport.sendto(encode_inputs(self.latest_tick, self.inputs))
+
+    def disconnect(self):
+        if self.transport:
+            self.transport.sendto(PACKET_TYPE.pack(DISCONNECT))
+            self.transport.close()
+
+
+async def open_client(host='127.0.0.1', port=27015):
+    """Open a NetClient to a server and join the match."""
+    _, client = await asyncio.get_running_loop().create_datagram_endpoint(NetClient, remote_addr=(host, port))
+    await client.connect()
+    return client
+
+
+def bearing(from_position, to_position):
+    """Yaw that faces from one position towards another."""
+    return math.degrees(math.atan2(to_position[0] - from_position[0], to_position[2] - from_position[2])) % 360
@@ -0,0 +1,92 @@
+from block_mesher import NEIGHBOUR_STEP
+
+# Box regions of grid cells for the editor's bulk tools.
+#
+# A region is spanned by two corner cells. Blocks are one block width apart
+# (2 cells in x and z, 1 layer), so the cells of a region are laid out on
+# that lattice starting from the first corner. Nothing here creates entities;
+# the editor walks these cells in time-sliced batches.
+
+
+class Region:
+    """Box of grid cells between two corner cells (inclusive)."""
+
+    def __init__(self, corner_a, corner_b):
+        self.corner = corner_a
+        self.low = tuple(min(corner_a[i], corner_b[i]) for i in range(3))
+        self.high = tuple(max(corner_a[i], corner_b[i]) for i in range(3))
+
+    def _axis_values(self, axis):
+        # Lattice values along an axis, aligned to the first corner
+        step = NEIGHBOUR_STEP[axis]
+        start = self.low[axis] + (self.corner[axis] - self.low[axis]) % step
+        return range(start, self.high[axis] + 1, step)
+
+    def cells(self):
+        """Yield every lattice cell of the region, layer by layer."""
+        xs = self._axis_values(0)
+        zs = self._axis_values(2)
+        for layer in self._axis_values(1):
+            for x in xs:
+                for z in zs:
+                    yield (x, layer, z)
+
+    def volume(self):
+        return len(self._axis_values(0)) * len(self._axis_values(1)) * len(self._axis_values(2))
+
+    def contains(self, cell):
+        return all(self.low[i] <= cell[i] <= self.high[i] for i in range(3))
+
+    def is_interior(self, cell):
+        """True if a cell is inside the region and not on its outer shell."""
+        return all(self.low[i] + NEIGHBOUR_STEP[i] <= cell[i] <= self.high[i] - NEIGHBOUR_STEP[i] for i in range(3))
+
+    def occupied(self, cells):
+        """Yield the occupied cells inside the region.
+
+        Walks whichever is smaller: the region's cells or the occupied cells,
+        so a huge mostly empty region over a small map stays cheap. None is
+        yielded every few thousand cells checked so callers can pause.
+        """
+        # Placed blocks don't have to sit on the region's lattice, check every cell
+        full_volume = 1
+        for i in range(3):
+            full_volume *= self.high[i] - self.low[i] + 1
+
+        if full_volume <= len(cells):
+            for layer in range(self.low[1], self.high[1] + 1):
+                for x in range(self.low[0], self.high[0] + 1):
+                    for z in range(self.low[2], self.high[2] + 1):
+                        if (x, layer, z) in cells:
+                            yield (x, layer, z)
+                    yield None
+        else:
+            for i, cell in enumerate(list(cells)):
+                if self.contains(cell):
+                    yield cell
+                if i % 4096 == 0:
+                    yield None
+
+    def center(self):
+        return tuple((self.low[i] + self.high[i]) / 2 for i in range(3))
+
+    def size(self):
+        return tuple(self.high[i] - self.low[i] for i in range(3))
+
+
+def copy_region(region, grid, record_of):
+    """Yield (offset from the low corner, record) for each object of an OccupancyGrid inside a region.
+
+    The None pauses of occupied() are passed through so the copy can be time sliced.
+    """
+    for cell in region.occupied(grid.cells):
+        if cell is None:
+            yield None
+            continue
+        offset = tuple(cell[i] - region.low[i] for i in range(3))
+        for item in grid.items_in(cell):
+            yield offset, record_of(item)
+
+
+def offset_cell(cell, offset):
+    return tuple(cell[i] + offset[i] for i in range(3))
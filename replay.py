@@ -0,0 +1,218 @@
+import argparse
+import glob
+import hashlib
+import os
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+from edit_journal import journal_path
+
+# Session recordings of game3DUFPSN.py.
+#
+# The gameplay simulation runs in fixed ticks and only depends on the map,
+# the seed of its random generator and what the player did each tick, so
+# that is all a recording holds. After the header every tick is one flags
+# byte followed by only the fields that changed since the tick before:
+#
+#   POSITION  player position, 3 float32
+#   ROTATION  player yaw and camera pitch, 2 float32
+#   SHOOT     the player fired this tick
+#   SPAWN     enemies spawned this tick, uint16 count
+#   CHECK     crc32 of the simulation state, written every CHECK_INTERVAL ticks
+#   HITSCAN   the weapon was in hitscan mode
+#
+# A tick where the player stood still costs one byte. Panda3D keeps positions
+# in float32, so storing them as float32 loses nothing. The checks let a
+# replay notice the moment it stops matching the recorded session.
+
+MAGIC = b'SUPEREPL'
+VERSION = 1
+HEADER = struct.Struct('<I20sQH')  # version, map hash, seed, tick rate
+FLAGS = struct.Struct('<B')
+POSE_POSITION = struct.Struct('<fff')
+POSE_ROTATION = struct.Struct('<ff')
+SPAWN_COUNT = struct.Struct('<H')
+CHECKSUM = struct.Struct('<I')
+
+POSITION = 1
+ROTATION = 2
+SHOOT = 4
+SPAWN = 8
+CHECK = 16
+HITSCAN = 32
+
+CHECK_INTERVAL = 60
+RECORDINGS_DIR = 'recordings'
+RECORDINGS_KEPT = 20  # Sessions recorded by default are kept up to this many, oldest go first
+
+TickRecord = namedtuple('TickRecord', ['position', 'yaw', 'pitch', 'shoot', 'spawns', 'check', 'hitscan'])
+
+
+def map_hash(map_path):
+    """Hash of a map file together with its edit journal."""
+    digest = hashlib.sha1()
+    for path in (map_path, journal_path(map_path)):
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.digest()
+
+
+def checksum(values):
+    """crc32 of a sequence of numbers packed as float32."""
+    return zlib.crc32(struct.pack(f'<{len(values)}f', *values))
+
+
+def _float32(value):
+    return struct.unpack('<f', struct.pack('<f', value))[0]
+
+
+class SessionRecorder:
+    """Appends one record per simulated tick to a recording file."""
+
+    def __init__(self, path, map_digest, seed, tick_rate, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.time()
+        self.position = None
+        self.rotation = None
+        self.ticks = 0
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + HEADER.pack(VERSION, map_digest, seed, tick_rate))
+        self.file.flush()
+
+    def tick(self, position, yaw, pitch, shoot=False, spawns=0, check=None, hitscan=False):
+        """Record what drove one tick of the simulation."""
+        position = tuple(_float32(value) for value in position)
+        rotation = (_float32(yaw), _float32(pitch))
+        flags = 0
+        parts = []
+        if position != self.position:
+            flags |= POSITION
+            parts.append(POSE_POSITION.pack(*position))
+            self.position = position
+        if rotation != self.rotation:
+            flags |= ROTATION
+            parts.append(POSE_ROTATION.pack(*rotation))
+            self.rotation = rotation
+        if shoot:
+            flags |= SHOOT
+        if hitscan:
+            flags |= HITSCAN
+        if spawns:
+            flags |= SPAWN
+            parts.append(SPAWN_COUNT.pack(spawns))
+        if check is not None:
+            flags |= CHECK
+            parts.append(CHECKSUM.pack(check))
+        self.buffer.append(FLAGS.pack(flags) + b''.join(parts))
+        self.ticks += 1
+
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if self.buffer:
+            self.file.write(b''.join(self.buffer))
+            self.buffer.clear()
+            self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+def read_header(path):
+    """Return (map hash, seed, tick rate) of a recording."""
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a session recording')
+        version, digest, seed, tick_rate = HEADER.unpack(file.read(HEADER.size))
+        if version != VERSION:
+            raise ValueError(f'Unsupported recording version {version}')
+        return digest, seed, tick_rate
+
+
+def read_ticks(path):
+    """Return the TickRecord of every tick in a recording, with the pose filled in on every one."""
+    with open(path, 'rb') as file:
+        data = file.read()
+    offset = len(MAGIC) + HEADER.size
+    ticks = []
+    position = (0.0, 0.0, 0.0)
+    yaw = pitch = 0.0
+    try:
+        while offset < len(data):
+            flags = data[offset]
+            offset += 1
+            if flags & POSITION:
+                position = POSE_POSITION.unpack_from(data, offset)
+                offset += POSE_POSITION.size
+            if flags & ROTATION:
+                yaw, pitch = POSE_ROTATION.unpack_from(data, offset)
+                offset += POSE_ROTATION.size
+            spawns = 0
+            if flags & SPAWN:
+                spawns = SPAWN_COUNT.unpack_from(data, offset)[0]
+                offset += SPAWN_COUNT.size
+            check = None
+            if flags & CHECK:
+                check = CHECKSUM.unpack_from(data, offset)[0]
+                offset += CHECKSUM.size
+            ticks.append(TickRecord(position, yaw, pitch, bool(flags & SHOOT), spawns, check, bool(flags & HITSCAN)))
+    except struct.error:
+        pass  # Tick cut short by a crash, drop it
+    return ticks
+
+
+def prune_recordings(folder=RECORDINGS_DIR, keep=RECORDINGS_KEPT):
+    """Delete all but the newest keep recordings of a folder. Returns how many were deleted."""
+    paths = sorted(glob.glob(os.path.join(folder, '*.rec')), key=os.path.getmtime)
+    old = paths[:max(0, len(paths) - keep)]
+    for path in old:
+        os.remove(path)
+    return len(old)
+
+
+class TickTimer:
+    """Wall time of every replayed tick, to find the ones that spike."""
+
+    def __init__(self):
+        self.times = []
+
+    def add(self, seconds):
+        self.times.append(seconds)
+
+    def summary(self):
+        if not self.times:
+            return 'no ticks'
+        ordered = sorted(self.times)
+        total = sum(ordered)
+        worst = max(range(len(self.times)), key=self.times.__getitem__)
+        return (
+            f'{len(ordered)} ticks in {total:.2f}s ({len(ordered) / max(total, 1e-9):.0f} ticks/s)  '
+            f'mean {total / len(ordered) * 1000:.2f}ms  p95 {ordered[int(len(ordered) * 0.95)] * 1000:.2f}ms  '
+            f'max {ordered[-1] * 1000:.2f}ms at tick {worst}'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show what a game3DUFPSN session recording holds')
+    parser.add_argument('recording')
+    args = parser.parse_args()
+
+    digest, seed, tick_rate = read_header(args.recording)
+    ticks = read_ticks(args.recording)
+    print(f'map {digest.hex()}  seed {seed}  {tick_rate} ticks/s')
+    print(f'{len(ticks)} ticks ({len(ticks) / tick_rate:.1f}s), {os.path.getsize(args.recording)} bytes')
+    print(f'{sum(tick.shoot for tick in ticks)} shots, {sum(tick.spawns for tick in ticks)} enemies spawned')
+    print(f'Replay with: python game3DUFPSN.py --replay {args.recording} [--headless]')
@@ -0,0 +1,168 @@
+import math
+from array import array
+
+# Multi-selection for the map editor.
+#
+# The selected objects are kept as columns: their ids plus packed arrays of
+# positions, rotations and colours. Batch edits (move, rotate, recolour) only
+# touch these arrays; records() turns them back into map records so the
+# editor can flush the whole selection to the journal and the scene in one
+# pass.
+#
+# Box and lasso selection project object positions with the camera's
+# view-projection matrix (Panda3D row-vector order, 4x4 nested rows) and test
+# them in normalised device coordinates. box_on_screen lets the editor skip
+# whole columns of the grid that are off the drawn rectangle first.
+
+
+def project_points(matrix, points):
+    """Yield the (x, y) device coordinates of each point, or None if it's behind the camera."""
+    m = matrix
+    for x, y, z in points:
+        w = x * m[0][3] + y * m[1][3] + z * m[2][3] + m[3][3]
+        if w <= 1e-6:
+            yield None
+            continue
+        yield (
+            (x * m[0][0] + y * m[1][0] + z * m[2][0] + m[3][0]) / w,
+            (x * m[0][1] + y * m[1][1] + z * m[2][1] + m[3][1]) / w,
+        )
+
+
+def point_in_polygon(point, polygon):
+    """Even-odd test of a 2D point against a closed polygon."""
+    x, y = point
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        xi, yi = polygon[i]
+        xj, yj = polygon[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def box_on_screen(matrix, low, high, rect_low, rect_high):
+    """False when no point of a world box can project inside a screen rectangle.
+
+    Boxes reaching behind the camera are always kept, their projection isn't bounded.
+    """
+    corners = [(x, y, z) for x in (low[0], high[0]) for y in (low[1], high[1]) for z in (low[2], high[2])]
+    points = list(project_points(matrix, corners))
+    if None in points:
+        return True
+    return (min(p[0] for p in points) <= rect_high[0] and max(p[0] for p in points) >= rect_low[0]
+            and min(p[1] for p in points) <= rect_high[1] and max(p[1] for p in points) >= rect_low[1])
+
+
+def select_in_box(matrix, items, corner_a, corner_b):
+    """Return the ids of (id, position) items that project inside a screen rectangle."""
+    low_x, high_x = sorted((corner_a[0], corner_b[0]))
+    low_y, high_y = sorted((corner_a[1], corner_b[1]))
+    ids = [object_id for object_id, position in items]
+    points = project_points(matrix, [position for object_id, position in items])
+    return [
+        object_id for object_id, point in zip(ids, points)
+        if point and low_x <= point[0] <= high_x and low_y <= point[1] <= high_y
+    ]
+
+
+def select_in_lasso(matrix, items, polygon):
+    """Return the ids of (id, position) items that project inside a screen polygon."""
+    if len(polygon) < 3:
+        return []
+    # Bounding box first, the polygon test only runs for points near the lasso
+    low_x = min(p[0] for p in polygon)
+    high_x = max(p[0] for p in polygon)
+    low_y = min(p[1] for p in polygon)
+    high_y = max(p[1] for p in polygon)
+    ids = [object_id for object_id, position in items]
+    points = project_points(matrix, [position for object_id, position in items])
+    return [
+        object_id for object_id, point in zip(ids, points)
+        if point and low_x <= point[0] <= high_x and low_y <= point[1] <= high_y
+        and point_in_polygon(point, polygon)
+    ]
+
+
+class Selection:
+    """Columns of the selected objects' transforms and colours."""
+
+    def __init__(self):
+        self.ids = []
+        self.positions = array('d')  # x, y, z per object
+        self.rotations = array('d')
+        self.colors = array('d')  # r, g, b, a per object
+
+    def __len__(self):
+        return len(self.ids)
+
+    def set(self, records):
+        """Select the given (object id, record) pairs."""
+        self.clear()
+        for object_id, record in records:
+            self.ids.append(object_id)
+            self.positions.extend(record[1])
+            self.rotations.extend(record[2])
+            self.colors.extend(tuple(record[3])[:4])
+
+    def clear(self):
+        self.ids = []
+        self.positions = array('d')
+        self.rotations = array('d')
+        self.colors = array('d')
+
+    def bounds(self):
+        """Return the (low, high) corners of the selected positions."""
+        low = [min(self.positions[axis::3]) for axis in range(3)]
+        high = [max(self.positions[axis::3]) for axis in range(3)]
+        return low, high
+
+    def center(self):
+        low, high = self.bounds()
+        return [(low[axis] + high[axis]) / 2 for axis in range(3)]
+
+    def translate(self, dx, dy, dz):
+        positions = self.positions
+        for offset, delta in enumerate((dx, dy, dz)):
+            if delta:
+                for i in range(offset, len(positions), 3):
+                    positions[i] += delta
+
+    def rotate_y(self, angle, pivot):
+        """Turn the selection around a vertical axis through pivot (clockwise seen from above, like rotation_y)."""
+        radians = math.radians(angle)
+        cos = math.cos(radians)
+        sin = math.sin(radians)
+        positions = self.positions
+        px, pz = pivot[0], pivot[2]
+        for i in range(0, len(positions), 3):
+            x = positions[i] - px
+            z = positions[i + 2] - pz
+            positions[i] = px + x * cos + z * sin
+            positions[i + 2] = pz - x * sin + z * cos
+        rotations = self.rotations
+        for i in range(1, len(rotations), 3):
+            rotations[i] = (rotations[i] + angle) % 360
+
+    def recolor(self, rgba):
+        self.colors = array('d', tuple(rgba) * len(self.ids))
+
+    def records(self, base_records, make_vector, make_color):
+        """Return (object id, record) pairs with the selection's columns merged into base_records."""
+        positions = self.positions
+        rotations = self.rotations
+        colors = self.colors
+        result = []
+        for n, object_id in enumerate(self.ids):
+            record = base_records[object_id]
+            i = n * 3
+            c = n * 4
+            result.append((object_id, (
+                record[0],
+                make_vector(positions[i], positions[i + 1], positions[i + 2]),
+                make_vector(rotations[i], rotations[i + 1], rotations[i + 2]),
+                make_color(colors[c], colors[c + 1], colors[c + 2], colors[c + 3]),
+            ) + tuple(record[4:])))
+        return result
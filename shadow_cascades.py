@@ -0,0 +1,410 @@
+import math
+
+from panda3d.core import (
+    BitMask32, ColorWriteAttrib, GraphicsOutput, Mat4, NodePath, OrthographicLens,
+    PandaNode, SamplerState, Shader, Texture, Vec3, Vec4,
+)
+
+# Cascaded shadow maps fitted to the camera.
+#
+# The view frustum is cut into slices along the view direction (practical
+# split scheme, a blend of uniform and logarithmic splits). Each slice gets its
+# own shadow camera and depth map. The camera is fitted to a bounding sphere
+# of the slice, so its size doesn't change when the view turns. Its centre is
+# snapped to whole shadow map texels, so shadow edges don't crawl while
+# moving. Near slices are small, which gives sharp shadows close to the
+# player. The far slice covers a lot of ground at a lower texel density.
+#
+# Casters are culled per cascade with camera masks: a caster is only drawn
+# into the depth maps of the cascades whose box it touches. The last cascade
+# only draws static casters (the map) and is only re-rendered when the light
+# moves, the static scene changes or its snapped position moves.
+#
+# Only the moving casters are tested every frame. Static casters sit in
+# buckets of a coarse grid over x and z, and a cascade re-culls them only
+# when its fit changed, looking at the buckets under its box and nothing else.
+
+SHADOW_BIT = 8  # First camera mask bit used by the cascades
+DEPTH_PADDING = 100.0  # How far behind a cascade (towards the light) casters are still drawn
+STATIC_BUCKET = 32.0  # Size of the grid cells static casters are bucketed in
+
+
+def split_distances(near, far, count, blend=0.6):
+    """Return the far distance of each of count slices between near and far."""
+    splits = []
+    for i in range(1, count + 1):
+        fraction = i / count
+        logarithmic = near * (far / near) ** fraction
+        uniform = near + (far - near) * fraction
+        splits.append(blend * logarithmic + (1 - blend) * uniform)
+    return splits
+
+
+def slice_sphere(position, forward, near, far, tan_x, tan_y):
+    """Bounding sphere (center, radius) of the frustum slice between near and far.
+
+    tan_x and tan_y are the tangents of half the horizontal and vertical fov.
+    """
+    # The centre sits on the view axis where the near and far corners are equally far away
+    k = tan_x * tan_x + tan_y * tan_y
+    center_distance = min(far, (near + far) / 2 * (1 + k))
+    far_corner = math.sqrt((far - center_distance) ** 2 + (far * far) * k)
+    near_corner = math.sqrt((center_distance - near) ** 2 + (near * near) * k)
+    radius = max(far_corner, near_corner)
+    center = tuple(position[i] + forward[i] * center_distance for i in range(3))
+    return center, radius
+
+
+def light_basis(direction):
+    """Return orthonormal (right, up, forward) vectors for a light shining along direction."""
+    length = math.sqrt(sum(d * d for d in direction))
+    forward = tuple(d / length for d in direction)
+    helper = (0.0, 1.0, 0.0) if abs(forward[1]) < 0.99 else (1.0, 0.0, 0.0)
+    right = _normalize(_cross(helper, forward))
+    up = _cross(forward, right)
+    return right, up, forward
+
+
+def snap_to_texels(center, radius, basis, resolution):
+    """Move a cascade centre to the nearest whole texel in the light's plane."""
+    right, up, forward = basis
+    texel = 2 * radius / resolution
+    x = round(_dot(center, right) / texel) * texel
+    y = round(_dot(center, up) / texel) * texel
+    z = _dot(center, forward)
+    return tuple(right[i] * x + up[i] * y + forward[i] * z for i in range(3))
+
+
+def sphere_in_cascade(center, radius, cascade_center, cascade_radius, basis):
+    """True if a caster's bounding sphere touches a cascade's box in light space."""
+    right, up, forward = basis
+    offset = tuple(center[i] - cascade_center[i] for i in range(3))
+    reach = cascade_radius + radius
+    return (abs(_dot(offset, right)) <= reach and abs(_dot(offset, up)) <= reach
+            and -(cascade_radius + DEPTH_PADDING) - radius <= _dot(offset, forward) <= reach)
+
+
+def cascade_bounds(center, radius, basis):
+    """World (low, high) corners of a cascade's box, including the padding towards the light."""
+    right, up, forward = basis
+    corners = [
+        tuple(center[k] + a * radius * right[k] + b * radius * up[k] + f * forward[k] for k in range(3))
+        for a in (-1, 1) for b in (-1, 1) for f in (-(radius + DEPTH_PADDING), radius)
+    ]
+    low = tuple(min(corner[k] for corner in corners) for k in range(3))
+    high = tuple(max(corner[k] for corner in corners) for k in range(3))
+    return low, high
+
+
+def _buckets(low_x, low_z, high_x, high_z):
+    for bx in range(math.floor(low_x / STATIC_BUCKET), math.floor(high_x / STATIC_BUCKET) + 1):
+        for bz in range(math.floor(low_z / STATIC_BUCKET), math.floor(high_z / STATIC_BUCKET) + 1):
+            yield bx, bz
+
+
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+
+def _dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+def _normalize(v):
+    length = math.sqrt(_dot(v, v))
+    return tuple(x / length for x in v)
+
+
+VERTEX_SHADER = '''
+#version 150
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelMatrix;
+uniform mat4 p3d_TextureMatrix;
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+in vec2 p3d_MultiTexCoord0;
+in vec4 p3d_Color;
+out vec3 world_position;
+out vec3 world_normal;
+out vec2 uv;
+out vec4 vertex_color;
+
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+    world_position = (p3d_ModelMatrix * p3d_Vertex).xyz;
+    world_normal = mat3(p3d_ModelMatrix) * p3d_Normal;
+    // Keeps texture_scale tiling (the ground repeats its texture hundreds of times)
+    uv = (p3d_TextureMatrix * vec4(p3d_MultiTexCoord0, 0.0, 1.0)).xy;
+    vertex_color = p3d_Color;
+}
+'''
+
+FRAGMENT_SHADER = '''
+#version 150
+uniform sampler2D p3d_Texture0;
+uniform vec4 p3d_ColorScale;
+uniform sampler2DShadow shadow_map0;
+uniform sampler2DShadow shadow_map1;
+uniform sampler2DShadow shadow_map2;
+uniform mat4 shadow_matrix0;
+uniform mat4 shadow_matrix1;
+uniform mat4 shadow_matrix2;
+uniform vec3 cascade_far;
+uniform vec3 texel_size;
+uniform vec3 view_position;
+uniform vec3 light_direction;
+// The scene's DirectionalLight and AmbientLight, the light's direction comes from set_light_direction
+uniform struct p3d_LightSourceParameters {
+    vec4 color;
+} p3d_LightSource[1];
+uniform struct p3d_LightModelParameters {
+    vec4 ambient;
+} p3d_LightModel;
+in vec3 world_position;
+in vec3 world_normal;
+in vec2 uv;
+in vec4 vertex_color;
+out vec4 fragment_color;
+
+float sample_shadow(sampler2DShadow map, mat4 matrix, float texel) {
+    // Push the lookup out along the normal to keep surfaces from shadowing themselves
+    vec4 p = matrix * vec4(world_position + normalize(world_normal) * texel * 1.5, 1.0);
+    p.xyz /= p.w;
+    if (p.x < 0.0 || p.x > 1.0 || p.y < 0.0 || p.y > 1.0 || p.z > 1.0) {
+        return 1.0;
+    }
+    return texture(map, vec3(p.xy, p.z - 0.0005));
+}
+
+void main() {
+    vec4 base = texture(p3d_Texture0, uv) * vertex_color * p3d_ColorScale;
+    // Models without normals (particle quads) are lit as if they faced the light
+    vec3 normal = length(world_normal) > 0.0 ? normalize(world_normal) : -light_direction;
+    float diffuse = max(dot(normal, -light_direction), 0.0);
+
+    float lit = 1.0;
+    float view_distance = distance(view_position, world_position);
+    if (diffuse > 0.0 && length(world_normal) > 0.0) {
+        if (view_distance < cascade_far.x) {
+            lit = sample_shadow(shadow_map0, shadow_matrix0, texel_size.x);
+        } else if (view_distance < cascade_far.y) {
+            lit = sample_shadow(shadow_map1, shadow_matrix1, texel_size.y);
+        } else if (view_distance < cascade_far.z) {
+            lit = sample_shadow(shadow_map2, shadow_matrix2, texel_size.z);
+        }
+    }
+    fragment_color = vec4(base.rgb * (p3d_LightModel.ambient.rgb + p3d_LightSource[0].color.rgb * diffuse * lit), base.a);
+}
+'''
+
+
+class CascadedShadows:
+    """Three camera-fitted shadow cascades drawn into their own depth maps."""
+
+    count = 3
+
+    def __init__(self, base, scene, light_direction, resolution=2048, far=300.0, near=1.0):
+        self.base = base
+        self.scene = scene
+        self.resolution = resolution
+        self.near = near
+        self.splits = split_distances(near, far, self.count)
+        self.light_direction = None
+        self.basis = None
+        self.casters = {}  # id(node) -> [node, center or None, radius, cascade bits], the moving casters
+        self.static_casters = {}  # id(node) -> (node, center, radius)
+        self.static_buckets = {}  # (x, z) bucket -> set of id(node)
+        self.static_shown = [set() for i in range(self.count)]  # Static casters each cascade draws
+        self.static_culled = [None] * self.count  # Fit each cascade last culled its static casters with
+        self.static_dirty = True
+        self.fits = [None] * self.count  # (center, radius) per cascade
+
+        # The main camera must not see the cascade bits, or hiding a caster from a cascade would hide it on screen too
+        main_camera = base.cam.node()
+        main_camera.set_camera_mask(main_camera.get_camera_mask() & ~self.all_cascades_mask())
+
+        self.cameras = []
+        self.buffers = []
+        self.maps = []
+        # The depth pass only needs depth, skip the scene shader and colour writes
+        depth_state = NodePath(PandaNode('shadow_depth_state'))
+        depth_state.set_shader_off(1000)
+        depth_state.set_attrib(ColorWriteAttrib.make(ColorWriteAttrib.C_off), 1000)
+        for i in range(self.count):
+            buffer = base.win.make_texture_buffer(f'shadow_cascade_{i}', resolution, resolution)
+            depth_map = Texture(f'shadow_cascade_{i}')
+            buffer.add_render_texture(depth_map, GraphicsOutput.RTM_bind_or_copy, GraphicsOutput.RTP_depth)
+            depth_map.set_minfilter(SamplerState.FT_shadow)
+            depth_map.set_magfilter(SamplerState.FT_shadow)
+            depth_map.set_wrap_u(SamplerState.WM_border_color)
+            depth_map.set_wrap_v(SamplerState.WM_border_color)
+            depth_map.set_border_color(Vec4(1, 1, 1, 1))
+            buffer.set_sort(-100 + i)
+
+            camera = base.make_camera(buffer, lens=OrthographicLens())
+            camera.reparent_to(scene)
+            camera.node().set_camera_mask(BitMask32.bit(SHADOW_BIT + i))
+            camera.node().set_initial_state(depth_state.get_state())
+            self.cameras.append(camera)
+            self.buffers.append(buffer)
+            self.maps.append(depth_map)
+
+        shader = Shader.make(Shader.SL_GLSL, VERTEX_SHADER, FRAGMENT_SHADER)
+        scene.set_shader(shader, 10)
+        scene.set_shader_input('cascade_far', Vec3(*self.splits))
+        for i, depth_map in enumerate(self.maps):
+            scene.set_shader_input(f'shadow_map{i}', depth_map)
+        self.set_light_direction(light_direction)
+
+    def all_cascades_mask(self):
+        mask = BitMask32()
+        for i in range(self.count):
+            mask |= BitMask32.bit(SHADOW_BIT + i)
+        return mask
+
+    def exclude(self, node):
+        """Never draw a node into the shadow maps (the ground, the sky)."""
+        node.hide(self.all_cascades_mask())
+
+    def set_light_direction(self, direction):
+        direction = tuple(float(d) for d in direction)
+        if direction == self.light_direction:
+            return
+        self.light_direction = direction
+        self.basis = light_basis(direction)
+        self.scene.set_shader_input('light_direction', Vec3(*self.basis[2]))
+        self.static_culled = [None] * self.count
+        self.static_dirty = True
+
+    def add_caster(self, node, radius, static=False, center=None):
+        """Register a shadow caster. Static casters need their center, they never move."""
+        if not static:
+            self.casters[id(node)] = [node, center, radius, self.all_cascades_mask()]
+            return
+        if center is None:
+            center = tuple(node.get_pos(self.scene))
+        key = id(node)
+        self.static_casters[key] = (node, center, radius)
+        for bucket in _buckets(center[0] - radius, center[2] - radius, center[0] + radius, center[2] + radius):
+            self.static_buckets.setdefault(bucket, set()).add(key)
+        # Drawn nowhere until the cascades cull it
+        node.hide(self.all_cascades_mask())
+        self.static_culled = [None] * self.count
+        self.static_dirty = True
+
+    def remove_caster(self, node):
+        key = id(node)
+        if self.casters.pop(key, None):
+            node.show(self.all_cascades_mask())
+            return
+        entry = self.static_casters.pop(key, None)
+        if entry:
+            center, radius = entry[1], entry[2]
+            for bucket in _buckets(center[0] - radius, center[2] - radius, center[0] + radius, center[2] + radius):
+                keys = self.static_buckets.get(bucket)
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del self.static_buckets[bucket]
+            for shown in self.static_shown:
+                shown.discard(key)
+            node.show(self.all_cascades_mask())
+            self.static_dirty = True
+
+    def _cull_static(self, i):
+        """Show cascade i the static casters in its box, and hide it the ones that left."""
+        center, radius = self.fits[i]
+        low, high = cascade_bounds(center, radius, self.basis)
+        wanted = set()
+        for bucket in _buckets(low[0], low[2], high[0], high[2]):
+            for key in self.static_buckets.get(bucket, ()):
+                if key not in wanted:
+                    node, caster_center, caster_radius = self.static_casters[key]
+                    if sphere_in_cascade(caster_center, caster_radius, center, radius, self.basis):
+                        wanted.add(key)
+        shown = self.static_shown[i]
+        if wanted != shown:
+            bit = BitMask32.bit(SHADOW_BIT + i)
+            for key in shown - wanted:
+                self.static_casters[key][0].hide(bit)
+            for key in wanted - shown:
+                self.static_casters[key][0].show(bit)
+            self.static_shown[i] = wanted
+            if i == self.count - 1:
+                self.static_dirty = True
+        self.static_culled[i] = self.fits[i]
+
+    def mark_static_dirty(self):
+        """Call when the static scene changed, the static cascade is re-rendered next frame."""
+        self.static_dirty = True
+
+    def _fit(self, i, position, forward, tan_x, tan_y):
+        near = self.near if i == 0 else self.splits[i - 1]
+        center, radius = slice_sphere(position, forward, near, self.splits[i], tan_x, tan_y)
+        if i == self.count - 1:
+            # The static cascade only moves in steps of a quarter of its size
+            step = radius / 4
+            center = tuple(round(c / step) * step for c in center)
+            radius *= 1.25
+        return snap_to_texels(center, radius, self.basis, self.resolution), radius
+
+    def _place_camera(self, i, center, radius):
+        camera = self.cameras[i]
+        lens = camera.node().get_lens()
+        lens.set_film_size(2 * radius, 2 * radius)
+        lens.set_near_far(0, 2 * radius + DEPTH_PADDING)
+        forward = self.basis[2]
+        camera.set_pos(self.scene, *(center[k] - forward[k] * (radius + DEPTH_PADDING) for k in range(3)))
+        camera.look_at(self.scene, Vec3(*center), Vec3(*self.basis[1]))
+
+        # World space to depth map texture coordinates
+        bias = Mat4.scale_mat(0.5, 0.5, 0.5) * Mat4.translate_mat(0.5, 0.5, 0.5)
+        matrix = self.scene.get_mat(camera) * lens.get_projection_mat() * bias
+        self.scene.set_shader_input(f'shadow_matrix{i}', matrix)
+
+    def update(self, camera_node):
+        """Refit the cascades to a camera NodePath and cull the casters for each of them."""
+        lens = camera_node.node().get_lens()
+        fov_x, fov_y = lens.get_fov()
+        tan_x = math.tan(math.radians(fov_x) / 2)
+        tan_y = math.tan(math.radians(fov_y) / 2)
+        position = tuple(camera_node.get_pos(self.scene))
+        forward = tuple(self.scene.get_relative_vector(camera_node, Vec3(0, 0, 1)))
+        forward = _normalize(forward)
+        self.scene.set_shader_input('view_position', Vec3(*position))
+
+        static = self.count - 1
+        for i in range(self.count):
+            fit = self._fit(i, position, forward, tan_x, tan_y)
+            if i == static:
+                if fit == self.fits[i] and not self.static_dirty:
+                    continue
+                self.static_dirty = True
+            self.fits[i] = fit
+            self._place_camera(i, *fit)
+        self.scene.set_shader_input('texel_size', Vec3(*(2 * fit[1] / self.resolution for fit in self.fits)))
+
+        for i in range(self.count):
+            if self.fits[i] != self.static_culled[i]:
+                self._cull_static(i)
+
+        for entry in self.casters.values():
+            node, center, radius, bits = entry
+            if center is None:
+                center = tuple(node.get_pos(self.scene))
+            wanted = BitMask32()
+            for i in range(static):  # Moving casters would make the static cascade dirty every frame
+                if sphere_in_cascade(center, radius, self.fits[i][0], self.fits[i][1], self.basis):
+                    wanted |= BitMask32.bit(SHADOW_BIT + i)
+            if wanted != bits:
+                if not (bits & ~wanted).is_zero():
+                    node.hide(bits & ~wanted)
+                if not (wanted & ~bits).is_zero():
+                    node.show(wanted & ~bits)
+                entry[3] = wanted
+
+        # Render the static cascade for one frame only when it has changed
+        if self.static_dirty:
+            self.buffers[static].set_one_shot(True)
+            self.buffers[static].set_active(True)
+        self.static_dirty = False
@@ -0,0 +1,154 @@
+import math
+
+# Enemy waves for game3DUFPSN.py.
+#
+# Spawn positions are picked from candidate points worked out once per map:
+# a grid over a ring around the middle of the train, minus every point a
+# placed object stands on. Enemies live in a SpatialHash, so checking that a
+# candidate is clear of them only looks at the few cells around it. The
+# director hands out at most a budget of spawns per tick and tries a bounded
+# number of candidates, so a wave of hundreds arrives over a few ticks instead
+# of in one long frame, and a crowded ring can never stall the game.
+#
+# The candidates are walked in an order shuffled by the caller's seeded
+# generator, so the same enemies and player position always give the same
+# spawns. That keeps recorded sessions replayable.
+
+SPAWN_INNER_RADIUS = 80
+SPAWN_OUTER_RADIUS = 120
+SPAWN_SPACING = 2.0  # Distance between candidate points
+OBSTACLE_CLEARANCE = 1.5  # Half a block plus the enemy's radius
+SPAWN_SPACE = 1.0  # Minimum distance from a new enemy to any other
+PLAYER_CLEARANCE = 25  # No spawning right next to the player
+SPAWNS_PER_TICK = 4
+TRIES_PER_TICK = 64
+
+
+class SpatialHash:
+    """Points on the ground plane bucketed into square cells."""
+
+    def __init__(self, cell_size=4.0):
+        self.cell_size = cell_size
+        self.cells = {}  # (cx, cz) -> {key: (x, z)}
+        self.keys = {}  # key -> cell
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _cell(self, x, z):
+        return (math.floor(x / self.cell_size), math.floor(z / self.cell_size))
+
+    def insert(self, key, x, z):
+        cell = self._cell(x, z)
+        self.cells.setdefault(cell, {})[key] = (x, z)
+        self.keys[key] = cell
+
+    def remove(self, key):
+        cell = self.keys.pop(key, None)
+        if cell is not None:
+            bucket = self.cells[cell]
+            del bucket[key]
+            if not bucket:
+                del self.cells[cell]
+
+    def move(self, key, x, z):
+        cell = self._cell(x, z)
+        if self.keys.get(key) == cell:
+            self.cells[cell][key] = (x, z)
+        else:
+            self.remove(key)
+            self.insert(key, x, z)
+
+    def clear(self):
+        self.cells.clear()
+        self.keys.clear()
+
+    def query(self, x, z, radius):
+        """Yield (key, (x, z)) of every point within radius of (x, z)."""
+        low_x, low_z = self._cell(x - radius, z - radius)
+        high_x, high_z = self._cell(x + radius, z + radius)
+        radius_sq = radius * radius
+        for cx in range(low_x, high_x + 1):
+            for cz in range(low_z, high_z + 1):
+                bucket = self.cells.get((cx, cz))
+                if not bucket:
+                    continue
+                for key, (px, pz) in bucket.items():
+                    if (px - x) ** 2 + (pz - z) ** 2 <= radius_sq:
+                        yield key, (px, pz)
+
+    def any_within(self, x, z, radius):
+        for _ in self.query(x, z, radius):
+            return True
+        return False
+
+
+def ring_points(obstacles, inner_radius=SPAWN_INNER_RADIUS, outer_radius=SPAWN_OUTER_RADIUS,
+                spacing=SPAWN_SPACING, clearance=OBSTACLE_CLEARANCE, extent=245):
+    """Return the (x, z) points of the spawn ring that no obstacle stands on, in grid order.
+
+    obstacles is a SpatialHash of the placed objects enemies can't stand in.
+    """
+    points = []
+    steps = int(outer_radius / spacing)
+    for i in range(-steps, steps + 1):
+        for j in range(-steps, steps + 1):
+            x = i * spacing
+            z = j * spacing
+            if not inner_radius <= math.hypot(x, z) <= outer_radius:
+                continue
+            if abs(x) > extent or abs(z) > extent or obstacles.any_within(x, z, clearance):
+                continue
+            points.append((x, z))
+    return points
+
+
+def wave_size(wave, first=5, growth=1.5):
+    """Enemies in a wave, growing by growth times per wave."""
+    return int(round(first * growth ** (wave - 1)))
+
+
+class WaveDirector:
+    """Queues waves of enemies and picks where they spawn, a few per tick."""
+
+    def __init__(self, points, first_wave=5, growth=1.5, max_wave=500,
+                 spawns_per_tick=SPAWNS_PER_TICK, tries_per_tick=TRIES_PER_TICK):
+        self.points = points
+        self.first_wave = first_wave
+        self.growth = growth
+        self.max_wave = max_wave
+        self.spawns_per_tick = spawns_per_tick
+        self.tries_per_tick = tries_per_tick
+        self.wave = 0
+        self.queued = 0  # Enemies of the current wave still to spawn
+        self.cursor = 0  # Next candidate to try
+
+    def next_wave(self):
+        self.wave += 1
+        self.queued = min(self.max_wave, wave_size(self.wave, self.first_wave, self.growth))
+        return self.queued
+
+    def spawns(self, enemies, player_position):
+        """Return up to a tick's worth of free spawn positions (x, z).
+
+        enemies is the SpatialHash of the living enemies.
+        """
+        budget = min(self.queued, self.spawns_per_tick)
+        if budget <= 0 or not self.points:
+            return []
+
+        found = []
+        px, pz = player_position
+        for _ in range(self.tries_per_tick):
+            x, z = self.points[self.cursor]
+            self.cursor = (self.cursor + 1) % len(self.points)
+            if (x - px) ** 2 + (z - pz) ** 2 < PLAYER_CLEARANCE ** 2:
+                continue
+            if enemies.any_within(x, z, SPAWN_SPACE) or any(
+                    (x - fx) ** 2 + (z - fz) ** 2 < SPAWN_SPACE ** 2 for fx, fz in found):
+                continue
+            found.append((x, z))
+            if len(found) == budget:
+                break
+        self.queued -= len(found)
+        return found
@@ -0,0 +1,81 @@
+import time
+from collections import deque
+
+# Startup timeline for the game and the editor.
+#
+# The scripts mark each stage of startup as they pass it (imports, window,
+# assets, map) and the first two frames mark the rest: the first update, and
+# the first frame actually drawn, which is when the player can interact. The
+# timeline is printed then and appended to startup.log, one line per launch,
+# so runs can be compared.
+#
+# Subsystems nothing needs on the first frame are deferred instead of built
+# at startup. A deferred job is a generator, each step does a small piece of
+# work (one cloud, say), and after the first frame the steps run within a
+# time budget per frame until every job is done.
+
+LOG_PATH = 'startup.log'
+DEFERRED_BUDGET = 0.004  # Seconds of deferred work per frame
+
+
+class StartupTimeline:
+    """Times the stages of startup and runs the deferred jobs after the first frame."""
+
+    def __init__(self, name, log_path=LOG_PATH):
+        self.name = name
+        self.log_path = log_path
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.stages = []  # (stage, seconds it took)
+        self.jobs = deque()  # (name, generator)
+        self.frames = 0
+        self.ready = False  # Every deferred job has finished
+
+    def mark(self, stage):
+        """End a stage, timed from the end of the one before."""
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def defer(self, name, job):
+        """Queue a generator to be stepped after the first frame."""
+        self.jobs.append((name, job))
+
+    def frame(self, budget=DEFERRED_BUDGET):
+        """Call once per frame from update()."""
+        self.frames += 1
+        if self.frames == 1:
+            self.mark('first update')
+            return
+        if self.frames == 2:
+            # update() runs before the frame is drawn, so the first frame is done by the second call
+            self.mark('first frame')
+            self.report()
+        if self.ready:
+            return
+
+        deadline = time.perf_counter() + budget
+        while self.jobs and time.perf_counter() < deadline:
+            job = self.jobs[0][1]
+            try:
+                next(job)
+            except StopIteration:
+                self.jobs.popleft()
+        if not self.jobs:
+            self.ready = True
+            print(f'Deferred startup work done {(time.perf_counter() - self.start) * 1000:.0f} ms after launch')
+
+    def summary(self):
+        lines = [f'{self.name} startup timeline:']
+        total = 0.0
+        for stage, seconds in self.stages:
+            total += seconds
+            lines.append(f'  {stage:<20} {seconds * 1000:8.1f} ms  {total * 1000:8.1f} ms')
+        return '\n'.join(lines)
+
+    def report(self):
+        print(self.summary())
+        if self.log_path:
+            fields = ' '.join(f'{stage.replace(" ", "_")}={seconds * 1000:.1f}' for stage, seconds in self.stages)
+            with open(self.log_path, 'a') as file:
+                file.write(f'{time.strftime("%Y-%m-%d %H:%M:%S")} {self.name} {fields}\n')
@@ -0,0 +1,39 @@
+import math
+
+from panda3d.core import CollisionBox, Point3
+from ursina.collider import Collider
+
+# Merged collision for the static map geometry.
+#
+# Instead of one box collider node per placed object, every axis aligned
+# object of a chunk is one solid of a single collision node, built from the
+# boxes the map bake stored for the chunk. The player controller's raycasts
+# then test a few dozen nodes, and Panda3D only looks at the solids of a node
+# whose bounds the ray reaches. The boxes don't keep their object ids: the
+# controller only needs to know it hit the map, and anything that has to know
+# which object was hit asks the StaticBVH.
+#
+# Bullets don't go through the scene graph at all: each tick's movement is a
+# segment tested against the baked StaticBVH, which returns the object id
+# and the normal of the face it hit.
+
+
+class BoxSetCollider(Collider):
+    """One collision node holding an axis aligned box per (object id, low, high)."""
+
+    def __init__(self, entity, boxes):
+        super().__init__(entity, [CollisionBox(Point3(*low), Point3(*high)) for object_id, low, high in boxes])
+        self.visible = False
+
+
+def sweep(bvh, start, end, radius=0.0):
+    """Return the nearest Hit of a sphere moving from start to end against a StaticBVH, or None.
+
+    The sphere is treated as a point whose path reaches radius further, which
+    is what a small fast bullet needs.
+    """
+    direction = (end[0] - start[0], end[1] - start[1], end[2] - start[2])
+    length = math.sqrt(direction[0] ** 2 + direction[1] ** 2 + direction[2] ** 2)
+    if length == 0:
+        return None
+    return bvh.raycast(start, direction, length + radius)
@@ -0,0 +1,140 @@
+import struct
+import time
+from multiprocessing import shared_memory
+
+# Shared-memory telemetry channel between the game and monitor.py.
+#
+# The game is the only writer. It packs one fixed-size record per frame into a
+# ring buffer and then bumps the write counter in the header, so it never
+# takes a lock. Readers copy records out and use the per-slot sequence number
+# to throw away anything the writer was overwriting while they read it.
+
+TELEMETRY_NAME = 'supe_telemetry'
+TELEMETRY_CAPACITY = 1024  # Number of frames kept in the ring
+
+MAGIC = 0x53555045  # 'SUPE'
+VERSION = 1
+
+# magic, version, record size, capacity, write counter
+HEADER = struct.Struct('<IIIIQ')
+
+# Field order of a telemetry record (after the sequence number)
+FIELDS = (
+    'timestamp',
+    'frame_time',
+    'entities',
+    'placed_objects',
+    'player_bullets',
+    'enemy_bullets',
+    'enemies',
+    'particles',
+    'map_load_progress',
+)
+RECORD = struct.Struct('<Qddiiiiiif')
+
+
+class TelemetryWriter:
+    """Publishes one telemetry record per frame into shared memory."""
+
+    def __init__(self, name=TELEMETRY_NAME, capacity=TELEMETRY_CAPACITY):
+        self.capacity = capacity
+        self.count = 0
+        size = HEADER.size + RECORD.size * capacity
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a game that crashed, reuse it
+            self.shm = shared_memory.SharedMemory(name=name)
+            if self.shm.size < size:
+                self.shm.close()
+                self.shm.unlink()
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        HEADER.pack_into(self.shm.buf, 0, MAGIC, VERSION, RECORD.size, capacity, 0)
+
+    def publish(self, frame_time=0.0, entities=0, placed_objects=0, player_bullets=0,
+                enemy_bullets=0, enemies=0, particles=0, map_load_progress=1.0):
+        """Write a record into the next slot and make it visible to readers."""
+        self.count += 1
+        offset = HEADER.size + ((self.count - 1) % self.capacity) * RECORD.size
+        # Zero the slot sequence while the payload is being written
+        RECORD.pack_into(
+            self.shm.buf, offset, 0, time.time(), frame_time, entities, placed_objects,
+            player_bullets, enemy_bullets, enemies, particles, map_load_progress
+        )
+        struct.pack_into('<Q', self.shm.buf, offset, self.count)
+        # Publish the record by moving the write counter last
+        struct.pack_into('<Q', self.shm.buf, HEADER.size - 8, self.count)
+
+    def close(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class TelemetryReader:
+    """Reads telemetry records published by a running game."""
+
+    def __init__(self, name=TELEMETRY_NAME):
+        self.shm = shared_memory.SharedMemory(name=name)
+        _untrack(self.shm)
+        magic, version, record_size, capacity, _ = HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            self.shm.close()
+            raise ValueError('Unsupported telemetry layout')
+        self.capacity = capacity
+        self.last_seq = 0
+
+    def write_count(self):
+        return struct.unpack_from('<Q', self.shm.buf, HEADER.size - 8)[0]
+
+    def read_new(self):
+        """Return the records written since the last call, oldest first."""
+        count = self.write_count()
+        if count < self.last_seq:
+            # The game was restarted and began counting again
+            self.last_seq = 0
+        first = max(self.last_seq + 1, count - self.capacity + 1, 1)
+        records = []
+        for seq in range(first, count + 1):
+            offset = HEADER.size + ((seq - 1) % self.capacity) * RECORD.size
+            values = RECORD.unpack_from(self.shm.buf, offset)
+            # The writer lapped us while we were reading, skip the torn slot
+            if values[0] != seq or struct.unpack_from('<Q', self.shm.buf, offset)[0] != seq:
+                continue
+            records.append(dict(zip(FIELDS, values[1:])))
+        self.last_seq = count
+        return records
+
+    def latest(self):
+        """Return the most recent record, or None if nothing was written yet."""
+        count = self.write_count()
+        if count == 0:
+            return None
+        offset = HEADER.size + ((count - 1) % self.capacity) * RECORD.size
+        values = RECORD.unpack_from(self.shm.buf, offset)
+        if values[0] != count:
+            return None
+        return dict(zip(FIELDS, values[1:]))
+
+    def close(self):
+        self.shm.close()
+
+
+def open_reader(name=TELEMETRY_NAME):
+    """Attach to the game's telemetry, returns None if the game isn't running."""
+    try:
+        return TelemetryReader(name)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _untrack(shm):
+    # On POSIX the resource tracker would unlink the segment when the monitor
+    # exits, taking it away from the game. Only the writer owns it.
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
@@ -0,0 +1,132 @@
+import argparse
+import glob
+import hashlib
+import os
+
+from panda3d.core import Filename, PNMImage, SamplerState, Texture as PandaTexture, TexturePool
+
+# Preprocessed textures.
+#
+# Loading a PNG at runtime means decoding it, then letting the driver build
+# the mipmap chain while it uploads. Instead every texture is converted once
+# into Panda3D's own .txo format, which holds the image exactly as it goes to
+# the GPU: already decoded, with the whole mip chain built here with proper
+# filtering, and block compressed (DXT1, or DXT5 when it has alpha) when this
+# Panda3D build can compress without a window. Compressed textures take a
+# quarter to an eighth of the video memory.
+#
+# The quality setting downscales the base level to half or a quarter of its
+# size before the mips are built, which saves another 4x or 16x. UI images
+# are always kept at full size and uncompressed, they're drawn pixel for pixel.
+#
+# Cache files are named after a hash of the source, so a changed PNG is
+# converted again and an unchanged one never is. Run this file to build the
+# whole cache ahead of time instead of on first use.
+
+CACHE_DIR = 'texture_cache'
+QUALITY_SCALES = {'full': 1, 'half': 2, 'quarter': 4}
+DEFAULT_QUALITY = 'full'
+
+quality = DEFAULT_QUALITY  # Set once at startup, before anything is loaded
+_loaded = {}  # (name, quality) -> ursina Texture, so entities share one copy
+
+
+def set_quality(level):
+    """Pick the QUALITY_SCALES level textures loaded from now on use."""
+    global quality
+    if level not in QUALITY_SCALES:
+        raise ValueError(f'Unknown texture quality {level!r}')
+    quality = level
+
+
+def _hash_file(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()[:12]
+
+
+def cache_path(path, quality, cache_dir=CACHE_DIR):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f'{stem}.{_hash_file(path)}.{quality}.txo')
+
+
+def build_texture(path, quality=DEFAULT_QUALITY, cache_dir=CACHE_DIR):
+    """Return the cache file of a PNG at a quality ('ui' or a QUALITY_SCALES key), converting it if missing."""
+    target = cache_path(path, quality, cache_dir)
+    if os.path.exists(target):
+        return target
+    os.makedirs(cache_dir, exist_ok=True)
+
+    image = PNMImage()
+    if not image.read(Filename.from_os_specific(path)):
+        raise IOError(f"Couldn't read texture {path}")
+    scale = QUALITY_SCALES.get(quality, 1)
+    if scale > 1:
+        small = PNMImage(max(1, image.get_x_size() // scale), max(1, image.get_y_size() // scale),
+                         image.get_num_channels(), image.get_maxval())
+        small.gaussian_filter_from(1.0, image)
+        image = small
+
+    texture = PandaTexture(os.path.basename(path))
+    texture.load(image)
+    if quality == 'ui':
+        texture.set_minfilter(SamplerState.FT_linear)
+    else:
+        texture.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+        texture.generate_ram_mipmap_images()
+        # Compresses every mip level, does nothing on builds without libsquish
+        texture.compress_ram_image(PandaTexture.CM_dxt5 if image.has_alpha() else PandaTexture.CM_dxt1)
+    texture.set_magfilter(SamplerState.FT_linear)
+
+    # Written aside and moved in place, so an interrupted run never leaves half a file
+    temporary = target + '.tmp'
+    if not texture.write(Filename.from_os_specific(temporary)):
+        raise IOError(f"Couldn't write {target}")
+    os.replace(temporary, target)
+    return target
+
+
+def cached_texture(name, ui=False):
+    """Return an ursina Texture for a PNG, loaded from the cache at the current quality."""
+    level = 'ui' if ui else quality
+    key = (name, level)
+    if key not in _loaded:
+        from ursina import Texture
+        panda_texture = TexturePool.load_texture(Filename.from_os_specific(build_texture(name, level)))
+        filtering = panda_texture.get_minfilter()
+        _loaded[key] = Texture(panda_texture)
+        # ursina resets the filters to its default, put back the ones that use the mips
+        panda_texture.set_minfilter(filtering)
+        panda_texture.set_magfilter(SamplerState.FT_linear)
+    return _loaded[key]
+
+
+def prune(cache_dir=CACHE_DIR):
+    """Delete cache files whose source PNG changed or is gone. Returns how many were deleted."""
+    current = set()
+    for path in glob.glob('*.png'):
+        digest = _hash_file(path)
+        current.add((os.path.splitext(path)[0], digest))
+    removed = 0
+    for path in glob.glob(os.path.join(cache_dir, '*.txo')):
+        stem, digest = os.path.basename(path).split('.')[:2]
+        if (stem, digest) not in current:
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the PNG textures into the preprocessed texture cache')
+    parser.add_argument('--quality', choices=sorted(QUALITY_SCALES), action='append',
+                        help='quality levels to build (default all)')
+    parser.add_argument('--ui', nargs='*', default=['crosshair.png', 'General.png', 'heart.png',
+                                                    'properties.png', 'material.png', 'volume.png'],
+                        help='images that are only used as UI')
+    args = parser.parse_args()
+
+    levels = args.quality or sorted(QUALITY_SCALES)
+    for path in sorted(glob.glob('*.png')):
+        for level in (['ui'] if path in args.ui else levels):
+            target = build_texture(path, level)
+            print(f'{path} ({level}): {os.path.getsize(path)} -> {os.path.getsize(target)} bytes')
+    print(f'Removed {prune()} stale cache files')
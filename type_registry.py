@@ -0,0 +1,74 @@
+import os
+
+from panda3d.core import NodePath
+from ursina import Entity, BoxCollider, load_texture
+
+from texture_cache import cached_texture
+
+# Prototypes of the placeable object types.
+#
+# Every type of models_data is loaded once into a hidden prototype entity,
+# with its texture and the box its collider needs worked out there. A new
+# object is a copy of the prototype's model node: the copy shares the
+# prototype's geometry, so nothing is looked up or loaded again, but it's a
+# node of its own, so colouring one object doesn't colour every other one.
+#
+# The registry also remembers the type of every object it made (or was told
+# about), so finding an object's type is one lookup instead of a search of
+# models_data.
+
+UNKNOWN_TYPE = ('cube', 'white_cube')  # Model and texture of types models_data doesn't know
+
+
+class TypeRegistry:
+    """Loads each type once and makes its objects from the prototype."""
+
+    def __init__(self, models_data):
+        self.models_data = models_data
+        self.prototypes = {}  # obj_type -> (model node or None, texture, collider (center, size) or None)
+        self.types = {}  # id(entity) -> obj_type
+        self.stash = NodePath('prototype copies')  # Copies wait here until their entity takes them
+
+    def __contains__(self, obj_type):
+        return obj_type in self.models_data
+
+    def models(self):
+        """Return obj_type -> model file (None for types without one), what map_bake wants."""
+        return {obj_type: model for obj_type, (model, texture) in self.models_data.items()}
+
+    def texture(self, obj_type):
+        return self.prototype(obj_type)[1]
+
+    def prototype(self, obj_type):
+        prototype = self.prototypes.get(obj_type)
+        if prototype is None:
+            model, texture = self.models_data.get(obj_type, UNKNOWN_TYPE)
+            # Files go through the texture cache, anything else is one of ursina's built in textures
+            texture = cached_texture(texture) if os.path.exists(texture) else load_texture(texture)
+            holder = Entity(model=model, enabled=False)
+            box = None
+            bounds = holder.model.get_tight_bounds() if holder.model else None
+            if bounds:
+                low, high = bounds
+                box = ((low + high) / 2, high - low)
+            prototype = self.prototypes[obj_type] = (holder.model, texture, box)
+        return prototype
+
+    def instantiate(self, obj_type, collider=False, **kwargs):
+        """Make an object of a type, kwargs are passed on to its Entity."""
+        model, texture, box = self.prototype(obj_type)
+        entity = Entity(model=model.copy_to(self.stash) if model else None, texture=texture, **kwargs)
+        if collider and box:
+            entity.collider = BoxCollider(entity, center=box[0], size=box[1])
+        self.types[id(entity)] = obj_type
+        return entity
+
+    def register(self, entity, obj_type):
+        """Remember the type of an object that wasn't made from a prototype."""
+        self.types[id(entity)] = obj_type
+
+    def type_of(self, entity):
+        return self.types.get(id(entity))
+
+    def forget(self, entity):
+        self.types.pop(id(entity), None)
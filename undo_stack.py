@@ -0,0 +1,118 @@
+from collections import deque, namedtuple
+
+# Undo/redo history for the map editor.
+#
+# A command is a tuple of EditRecords, one per object it touched. A record
+# only holds the object's id, its grid cell and its saved record before and
+# after the edit (type, position, rotation, colour and sound fields), with
+# None standing for "didn't exist". Undo applies the before states in reverse
+# order and redo applies the after states, so the cost of either is
+# proportional to the size of the edit and not to the size of the map.
+
+EditRecord = namedtuple('EditRecord', ['object_id', 'cell', 'before', 'after'])
+Command = namedtuple('Command', ['records', 'merge_key'])
+
+
+class UndoStack:
+    """Bounded undo/redo history of edit commands."""
+
+    def __init__(self, limit=200, max_records=200000):
+        self.limit = limit  # Commands kept
+        self.max_records = max_records  # Object records kept across all commands
+        self.undo_commands = deque()
+        self.redo_commands = []
+        self.record_count = 0
+        self.sealed = True
+
+    def push(self, records, merge_key=None):
+        """Add a command. Consecutive commands with the same merge_key are
+        folded into one (a gizmo drag or a slider sweep undoes in one step)."""
+        records = tuple(records)
+        if not records:
+            return
+        self._clear_redo()
+
+        top = self.undo_commands[-1] if self.undo_commands else None
+        if merge_key is not None and not self.sealed and top and top.merge_key == merge_key:
+            # Keep the oldest before state and the newest after state per object
+            merged = {record.object_id: record for record in top.records}
+            for record in records:
+                first = merged.get(record.object_id)
+                merged[record.object_id] = record._replace(before=first.before) if first else record
+            self.record_count += len(merged) - len(top.records)
+            self.undo_commands[-1] = Command(tuple(merged.values()), merge_key)
+        else:
+            self.undo_commands.append(Command(records, merge_key))
+            self.record_count += len(records)
+        self.sealed = False
+        self._trim()
+
+    def seal(self):
+        """Stop the next command from merging into the last one."""
+        self.sealed = True
+
+    def _trim(self):
+        while self.undo_commands and (len(self.undo_commands) > self.limit or self.record_count > self.max_records):
+            self.record_count -= len(self.undo_commands.popleft().records)
+
+    def _clear_redo(self):
+        for command in self.redo_commands:
+            self.record_count -= len(command.records)
+        self.redo_commands.clear()
+
+    def can_undo(self):
+        return bool(self.undo_commands)
+
+    def can_redo(self):
+        return bool(self.redo_commands)
+
+    def undo(self, apply):
+        """Revert the last command, apply(object_id, record) sets an object's state
+        (record None means delete). Returns the command or None."""
+        if not self.undo_commands:
+            return None
+        command = self.undo_commands.pop()
+        for record in reversed(command.records):
+            apply(record.object_id, record.before)
+        self.redo_commands.append(command)
+        self.sealed = True
+        return command
+
+    def redo(self, apply):
+        """Re-apply the last undone command. Returns the command or None."""
+        if not self.redo_commands:
+            return None
+        command = self.redo_commands.pop()
+        for record in command.records:
+            apply(record.object_id, record.after)
+        self.undo_commands.append(command)
+        self.sealed = True
+        return command
+
+    def remap_ids(self, mapping, allocate_id):
+        """Follow a renumbering of object ids (map compaction). Ids missing from
+        the mapping belong to deleted objects and get fresh ids from allocate_id."""
+        fresh = {}
+
+        def new_id(object_id):
+            if object_id in mapping:
+                return mapping[object_id]
+            if object_id not in fresh:
+                fresh[object_id] = allocate_id()
+            return fresh[object_id]
+
+        def remap(commands):
+            return [
+                Command(tuple(record._replace(object_id=new_id(record.object_id)) for record in command.records), command.merge_key)
+                for command in commands
+            ]
+
+        self.undo_commands = deque(remap(self.undo_commands))
+        self.redo_commands = remap(self.redo_commands)
+        self.sealed = True
+
+    def clear(self):
+        self.undo_commands.clear()
+        self.redo_commands.clear()
+        self.record_count = 0
+        self.sealed = True
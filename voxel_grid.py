@@ -0,0 +1,259 @@
+import math
+from collections import namedtuple
+
+# Sparse occupancy grid for grid-aligned blocks.
+#
+# Cells are keyed the same way snap_to_grid places blocks: x and z are the
+# rounded world coordinates and the vertical index is the stacking layer on
+# top of the train. Block models are 2 units wide, so a block centred on a
+# cell also covers half of each neighbouring cell; the raycast checks the 3x3
+# neighbourhood of every cell it walks through to account for that.
+
+GROUND_Y = 5.0  # Top of the train (y=0, scale_y=10)
+BASE_Y = GROUND_Y + 0.8  # Centre of a block standing on the train
+LAYER_HEIGHT = 2.03  # Stacking step used by place_object (scale_y + 0.23 + 0.8)
+BLOCK_HALF_EXTENT = 1.0  # Block models span -1..1 at scale 1
+BUCKET_SIZE = 16  # Cells per side of the columns the grid groups its cells into
+
+RayHit = namedtuple('RayHit', ['cell', 'item', 'point', 'normal', 'distance'])
+
+
+def cell_of(position):
+    """Return the grid cell of a world position."""
+    return (
+        int(round(position[0])),
+        int(round((position[1] - BASE_Y) / LAYER_HEIGHT)),
+        int(round(position[2])),
+    )
+
+
+def position_of(cell):
+    """Return the world position of the centre of a cell."""
+    return (float(cell[0]), BASE_Y + cell[1] * LAYER_HEIGHT, float(cell[2]))
+
+
+def _ray_box(origin, inv_dir, center, half):
+    # Slab test, returns (t_enter, axis) or None
+    t_near = -math.inf
+    t_far = math.inf
+    axis = 0
+    for i in range(3):
+        lo = center[i] - half[i]
+        hi = center[i] + half[i]
+        if inv_dir[i] is None:
+            if origin[i] < lo or origin[i] > hi:
+                return None
+            continue
+        t1 = (lo - origin[i]) * inv_dir[i]
+        t2 = (hi - origin[i]) * inv_dir[i]
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > t_near:
+            t_near = t1
+            axis = i
+        t_far = min(t_far, t2)
+        if t_near > t_far:
+            return None
+    if t_far < 0:
+        return None
+    return max(t_near, 0.0), axis
+
+
+def _column_of(cell):
+    return (cell[0] // BUCKET_SIZE, cell[2] // BUCKET_SIZE)
+
+
+class OccupancyGrid:
+    """Maps grid cells to the objects placed in them.
+
+    Objects can overlap (a small gizmo move into a taken cell, old maps), so
+    every cell holds a list of items. get() and raycasts return the newest.
+    """
+
+    def __init__(self):
+        self.cells = {}  # cell -> [items], newest last
+        self.columns = {}  # (x // BUCKET_SIZE, z // BUCKET_SIZE) -> set of occupied cells
+        self.item_cells = {}  # id(item) -> cell, so moved or deleted items can be found
+        self.min_layer = 0
+        self.max_layer = 0
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, cell):
+        return cell in self.cells
+
+    def get(self, cell):
+        items = self.cells.get(cell)
+        return items[-1] if items else None
+
+    def items_in(self, cell):
+        return self.cells.get(cell, ())
+
+    def add(self, cell, item):
+        """Put an item in a cell, on top of anything already there."""
+        self.remove_item(item)
+        if cell not in self.cells:
+            self.cells[cell] = []
+            self.columns.setdefault(_column_of(cell), set()).add(cell)
+        self.cells[cell].append(item)
+        self.item_cells[id(item)] = cell
+        self.min_layer = min(self.min_layer, cell[1])
+        self.max_layer = max(self.max_layer, cell[1])
+
+    def remove(self, cell):
+        """Empty a cell, returns the items that were in it."""
+        items = self.cells.pop(cell, [])
+        for item in items:
+            self.item_cells.pop(id(item), None)
+        if items:
+            self._forget_cell(cell)
+        return items
+
+    def remove_item(self, item):
+        cell = self.item_cells.pop(id(item), None)
+        items = self.cells.get(cell)
+        if items:
+            for i, other in enumerate(items):
+                if other is item:
+                    del items[i]
+                    break
+            if not items:
+                del self.cells[cell]
+                self._forget_cell(cell)
+        return cell
+
+    def _forget_cell(self, cell):
+        column = _column_of(cell)
+        cells = self.columns[column]
+        cells.discard(cell)
+        if not cells:
+            del self.columns[column]
+
+    def column_bounds(self):
+        """Yield (low, high, cells) of every column of occupied cells.
+
+        low and high are the world corners of a box around the centres of its
+        cells, so a caller can skip whole columns, say off screen ones.
+        """
+        low_y = BASE_Y + (self.min_layer - 0.5) * LAYER_HEIGHT
+        high_y = BASE_Y + (self.max_layer + 0.5) * LAYER_HEIGHT
+        for (cx, cz), cells in self.columns.items():
+            low = (cx * BUCKET_SIZE - 0.5, low_y, cz * BUCKET_SIZE - 0.5)
+            high = ((cx + 1) * BUCKET_SIZE - 0.5, high_y, (cz + 1) * BUCKET_SIZE - 0.5)
+            yield low, high, cells
+
+    def overlaps(self, cell, ignore=()):
+        """True if a block put in a cell would overlap anything placed, blocks are 2 cells wide.
+
+        Cells in ignore don't count.
+        """
+        x, layer, z = cell
+        for dx in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                key = (x + dx, layer, z + dz)
+                if key in self.cells and key not in ignore:
+                    return True
+        return False
+
+    def cell_of_item(self, item):
+        return self.item_cells.get(id(item))
+
+    def move_item(self, item, position):
+        """Re-key an item after it has been moved to a new world position."""
+        cell = cell_of(position)
+        if self.item_cells.get(id(item)) != cell:
+            self.add(cell, item)
+        return cell
+
+    def clear(self):
+        self.cells.clear()
+        self.columns.clear()
+        self.item_cells.clear()
+        self.min_layer = 0
+        self.max_layer = 0
+
+    def raycast(self, origin, direction, max_distance=500):
+        """Walk the cells along a ray (3D DDA) and return the first block hit.
+
+        The cost depends on the length of the ray, not on how many blocks exist.
+        """
+        length = math.sqrt(direction[0] ** 2 + direction[1] ** 2 + direction[2] ** 2)
+        if length == 0 or not self.cells:
+            return None
+        direction = (direction[0] / length, direction[1] / length, direction[2] / length)
+        inv_dir = tuple(1 / d if d != 0 else None for d in direction)
+        half = (BLOCK_HALF_EXTENT, BLOCK_HALF_EXTENT, BLOCK_HALF_EXTENT)
+
+        # Work in grid space where every cell is 1x1x1 and centred on integers
+        g_origin = (origin[0], (origin[1] - BASE_Y) / LAYER_HEIGHT, origin[2])
+        g_dir = (direction[0], direction[1] / LAYER_HEIGHT, direction[2])
+
+        cell = [int(math.floor(g_origin[i] + 0.5)) for i in range(3)]
+        step = [0, 0, 0]
+        t_max = [math.inf, math.inf, math.inf]
+        t_delta = [math.inf, math.inf, math.inf]
+        for i in range(3):
+            if g_dir[i] > 0:
+                step[i] = 1
+                t_max[i] = (cell[i] + 0.5 - g_origin[i]) / g_dir[i]
+                t_delta[i] = 1 / g_dir[i]
+            elif g_dir[i] < 0:
+                step[i] = -1
+                t_max[i] = (cell[i] - 0.5 - g_origin[i]) / g_dir[i]
+                t_delta[i] = -1 / g_dir[i]
+
+        best = None
+        tested = set()
+        t_cell = 0.0
+        while t_cell <= max_distance:
+            # A hit inside an earlier cell always beats anything further along
+            if best is not None and t_cell > best[0]:
+                break
+
+            # Stop once the ray has left the occupied layers for good
+            if (step[1] > 0 and cell[1] > self.max_layer) or (step[1] < 0 and cell[1] < self.min_layer):
+                break
+
+            for dx in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    key = (cell[0] + dx, cell[1], cell[2] + dz)
+                    if key in tested or key not in self.cells:
+                        continue
+                    tested.add(key)
+                    hit = _ray_box(origin, inv_dir, position_of(key), half)
+                    if hit is not None and hit[0] <= max_distance and (best is None or hit[0] < best[0]):
+                        best = (hit[0], hit[1], key)
+
+            axis = t_max.index(min(t_max))
+            t_cell = t_max[axis]
+            cell[axis] += step[axis]
+            t_max[axis] += t_delta[axis]
+
+        if best is None:
+            return None
+
+        t, axis, key = best
+        point = tuple(origin[i] + direction[i] * t for i in range(3))
+        normal = [0.0, 0.0, 0.0]
+        normal[axis] = -1.0 if direction[axis] > 0 else 1.0
+        return RayHit(key, self.get(key), point, tuple(normal), t)
+
+    def placement_cell(self, origin, direction, max_distance=500, ground_extent=250):
+        """Return the cell a new block should go in for a ray from the camera.
+
+        Hitting a block stacks on top of it like place_object always did,
+        otherwise the block lands on the train where the ray meets it.
+        """
+        hit = self.raycast(origin, direction, max_distance)
+        if hit is not None:
+            return (int(round(hit.point[0])), hit.cell[1] + 1, int(round(hit.point[2])))
+
+        if direction[1] >= 0:
+            return None
+        t = (GROUND_Y - origin[1]) / direction[1]
+        x = origin[0] + direction[0] * t
+        z = origin[2] + direction[2] * t
+        if abs(x) > ground_extent or abs(z) > ground_extent:
+            return None
+        return (int(round(x)), 0, int(round(z)))